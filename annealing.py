@@ -0,0 +1,140 @@
+"""
+File containing the cooling schedules of the simulated annealing mode of mcmc.mcmc.
+
+At temperature T a proposal that changes the score by delta is accepted with probability
+min(1, exp(delta / T)). T = 1 samples decryption ciphers in proportion to their likelihood, which
+is what mcmc does without a schedule. When only the single best cipher matters, starting hot and
+cooling down explores more at first and then climbs greedily, reaching the best cipher in fewer
+score evaluations. Schedules can be reheated when the chain stalls.
+"""
+import numpy as np
+
+
+class Schedule:
+    """
+    Base class of the cooling schedules, cooling from t_start to t_end over length iterations
+    and staying at t_end afterwards. Subclasses define the shape of the cooling in _cool, the
+    base class itself keeps a constant temperature of t_start (or of the reheated temperature)
+    ----------
+    params:
+        t_start (float): Initial temperature, default 5
+        t_end (float): Final temperature, default 0.05
+        length (int): Number of iterations of the cooling, default 10,000 (None for the number
+                      of iterations of the run)
+        reheat_factor (float): Fraction of t_start a reheated schedule restarts from, default 1
+    """
+    def __init__(self, t_start=5.0, t_end=0.05, length=10000, reheat_factor=1.0):
+        self.t_start = t_start
+        self.t_end = t_end
+        self.length = length
+        self.reheat_factor = reheat_factor
+        self._origin = 0
+        self._top = t_start
+
+    def start(self, iters):
+        """Called by the sampler before its first iteration with its number of iterations"""
+        if self.length is None:
+            self.length = max(iters, 1)
+        self._origin = 0
+        self._top = self.t_start
+
+    def reheat(self, iteration):
+        """Restarts the cooling from reheat_factor times the initial temperature"""
+        self._origin = iteration
+        self._top = max(self.t_start * self.reheat_factor, self.t_end)
+
+    def temperature(self, iteration, accepted):
+        """
+        Temperature of an iteration
+        ----------
+        params:
+            iteration (int): Number of the iteration, starting at 1
+            accepted (int): Number of proposals accepted before the iteration
+        returns:
+            temperature (float): The temperature
+        """
+        progress = min((iteration - self._origin) / self.length, 1.0)
+        return self._cool(progress)
+
+    def _cool(self, progress):
+        """
+        Temperature at a point of the cooling
+        ----------
+        params:
+            progress (float): Fraction of the cooling done, from 0 to 1
+        returns:
+            temperature (float): The temperature
+        """
+        return self._top
+
+
+class Geometric(Schedule):
+    """
+    Temperature decreasing by a constant factor every iteration,
+    T = t_start * (t_end / t_start)^(iteration / length)
+    """
+    def _cool(self, progress):
+        return self._top * (self.t_end / self._top) ** progress
+
+
+class Linear(Schedule):
+    """
+    Temperature decreasing by a constant amount every iteration
+    """
+    def _cool(self, progress):
+        return self._top + (self.t_end - self._top) * progress
+
+
+class Adaptive(Schedule):
+    """
+    Temperature adjusted every window iterations so that the acceptance rate follows a target
+    that decays geometrically from target_start to target_end over length iterations: the chain
+    cools down while it accepts more than the target and warms up while it accepts less
+    ----------
+    params:
+        t_start (float): Initial (and highest) temperature, default 5
+        t_end (float): Lowest temperature, default 0.05
+        length (int): Number of iterations of the decay of the target, default 10,000 (None for
+                      the number of iterations of the run)
+        reheat_factor (float): Fraction of t_start a reheated schedule restarts from, default 1
+        target_start (float): Initial target acceptance rate, default 0.1
+        target_end (float): Final target acceptance rate, default 0.001
+        window (int): Number of iterations between two adjustments, default 200
+        gain (float): Strength of the adjustments, default 0.5
+    """
+    def __init__(self, t_start=5.0, t_end=0.05, length=10000, reheat_factor=1.0,
+                 target_start=0.1, target_end=0.001, window=200, gain=0.5):
+        super().__init__(t_start, t_end, length, reheat_factor)
+        self.target_start = target_start
+        self.target_end = target_end
+        self.window = window
+        self.gain = gain
+        self._temperature = t_start
+        self._accepted = 0
+
+    def start(self, iters):
+        super().start(iters)
+        self._temperature = self.t_start
+        self._accepted = 0
+
+    def reheat(self, iteration):
+        super().reheat(iteration)
+        self._temperature = self._top
+
+    def temperature(self, iteration, accepted):
+        if (iteration - 1) % self.window == 0 and iteration > 1:
+            progress = min((iteration - self._origin) / self.length, 1.0)
+            target = self.target_start * (self.target_end / self.target_start) ** progress
+            rate = (accepted - self._accepted) / self.window
+            self._accepted = accepted
+
+            # Relative error of the acceptance rate, warming up by at most a factor e^gain
+            error = np.clip((target - rate) / target, -1.0, 1.0)
+            self._temperature = float(np.clip(
+                self._temperature * np.exp(self.gain * error), self.t_end, self.t_start
+            ))
+        return self._temperature
+
+
+# Schedules by name, used by the command line tools
+SCHEDULES = {'geometric': Geometric, 'linear': Linear, 'adaptive': Adaptive}
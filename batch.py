@@ -0,0 +1,209 @@
+"""
+File containing the non-interactive batch decipher command.
+
+Encrypted texts are read as JSON lines from a file or stdin, either as objects with a "text" field
+(and optionally an "id", which is copied to the result) or as plain JSON strings. They are deciphered
+concurrently on a pool of processes that each load the language model once, and one JSON result is
+written per input as soon as it finishes, so results do not come out in input order:
+
+    $ python batch.py messages.jsonl -o results.jsonl
+    $ cat messages.jsonl | python batch.py --workers 8 > results.jsonl
+
+Every result holds the id (or line number), best decryption key, plaintext, score, number of
+iterations run and time spent, or an error for lines that could not be read. Results are kept in
+the cache of cache.py, so texts seen before are answered without running any chain.
+"""
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+import runner
+import stopping
+import utils
+from cache import open_cache
+
+
+def decipher(encoded_text, seed, iters=20000, n_chains=4, stop=None, initial_keys=()):
+    """
+    Deciphers a single encrypted text with independent chains and keeps the best one. Uses the
+    model loaded by runner._init_worker.
+    ----------
+    params:
+        encoded_text (str): Passed encrypted text
+        seed (np.random.SeedSequence): Seed the chains' random number generators are spawned from
+        iters (int): Maximum number of MCMC iterations per chain, default 20,000
+        n_chains (int): Number of chains, default 4
+        stop (list): Per-chain stopping criteria from stopping.py
+        initial_keys (list): Decryption ciphers the first chains start from, the others start
+                             from random ciphers
+    returns:
+        result (dict): Best key, plaintext, score, total iterations of the chains and seconds spent
+    """
+    start = time.perf_counter()
+    initial_keys = list(initial_keys)[:n_chains]
+    initial_keys += [None] * (n_chains - len(initial_keys))
+
+    results = [
+        runner._run_chain(encoded_text, s, iters, stop, initial_key=key)
+        for s, key in zip(seed.spawn(n_chains), initial_keys)
+    ]
+    best = max(results, key=lambda result: result.best_score)
+
+    return {
+        'key': best.best_key,
+        'plaintext': utils.applyKey(best.best_key, encoded_text),
+        'score': float(best.best_score),
+        'iterations': sum(result.iterations for result in results),
+        'time': time.perf_counter() - start,
+    }
+
+
+def read_messages(lines):
+    """
+    Parses JSON lines of encrypted texts, skipping blank lines
+    ----------
+    params:
+        lines (iterable): Lines of JSON
+    returns:
+        messages (generator): (id, encrypted text, error) of every line, the text is None and the
+                              error is set for lines that could not be read
+    """
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+
+        try:
+            message = json.loads(line)
+            if isinstance(message, str):
+                message = {'text': message}
+            if not isinstance(message, dict) or not isinstance(message.get('text'), str):
+                raise ValueError('expected a JSON string or an object with a "text" string')
+        except ValueError as error:
+            yield number, None, f'line {number}: {error}'
+            continue
+
+        yield message.get('id', number), message['text'], None
+
+
+def run_batch(lines, output, workers=None, iters=20000, n_chains=4, patience=5000, seed=0,
+              model_path=None, cache=None):
+    """
+    Deciphers every encrypted text of a stream of JSON lines and writes one JSON result per text
+    as soon as it is done. At most a few texts per worker are in flight, so arbitrarily large
+    inputs are streamed rather than read at once.
+    ----------
+    params:
+        lines (iterable): Lines of JSON, see read_messages
+        output (file): Stream the JSON results are written to
+        workers (int): Number of worker processes, defaults to the number of CPUs. With a single
+                       worker the texts are deciphered in the current process
+        iters (int): Maximum number of MCMC iterations per chain, default 20,000
+        n_chains (int): Number of chains per text, default 4
+        patience (int): Stop a chain once its best score has not improved for this many
+                        iterations, default 5,000 (None to always run iters iterations)
+        seed (int): Seed of the chains, every text gets its own seed from its position in the
+                    input so results do not depend on the number of workers, default 0
+        model_path (str): Directory of the compiled language model, see model.load_model
+        cache (cache.ResultCache): Cache of previous results. Texts deciphered before with the
+                                   same parameters are answered from it (with "cached": true),
+                                   other texts are warm-started from the ciphers of cached texts
+                                   with similar statistics and their results are stored.
+                                   Default None (no cache)
+    returns:
+        count (int): Number of results written
+    """
+    stop = [stopping.ScorePlateau(patience)] if patience else None
+    params = {'iters': iters, 'chains': n_chains, 'patience': patience}
+    count = 0
+
+    def write(result):
+        nonlocal count
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+        count += 1
+
+    def jobs():
+        # Answers errors and cache hits right away and yields the texts left to decipher
+        for index, (name, text, error) in enumerate(read_messages(lines)):
+            if error is not None:
+                write({'id': name, 'error': error})
+                continue
+
+            if cache is None:
+                yield index, name, text, ()
+                continue
+
+            start = time.perf_counter()
+            hit = cache.get(text, params)
+            if hit is not None:
+                write({'id': name, 'key': hit[0], 'plaintext': utils.applyKey(hit[0], text),
+                       'score': hit[1], 'iterations': 0, 'time': time.perf_counter() - start,
+                       'cached': True})
+                continue
+            yield index, name, text, cache.similar(text)
+
+    def done(name, text, result):
+        if cache is not None:
+            cache.put(text, params, result['key'], result['score'])
+        write({'id': name, **result})
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1:
+        runner._init_worker(model_path)
+        for index, name, text, initial_keys in jobs():
+            seeds = np.random.SeedSequence([seed, index])
+            done(name, text, decipher(text, seeds, iters, n_chains, stop, initial_keys))
+        return count
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=runner._init_worker,
+                             initargs=(model_path,)) as executor:
+        pending = {}
+        for index, name, text, initial_keys in jobs():
+            seeds = np.random.SeedSequence([seed, index])
+            future = executor.submit(decipher, text, seeds, iters, n_chains, stop, initial_keys)
+            pending[future] = name, text
+
+            # Bound the number of texts in flight, writing the results that are done
+            if len(pending) >= 2 * workers:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done(*pending.pop(future), future.result())
+
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done(*pending.pop(future), future.result())
+
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Decipher JSON lines of encrypted texts')
+    parser.add_argument('input', nargs='?', default='-', help='JSON lines file, default stdin')
+    parser.add_argument('-o', '--output', default='-', help='JSON lines file of results, default stdout')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--iters', type=int, default=20000, help='maximum iterations per chain')
+    parser.add_argument('--chains', type=int, default=4, help='chains per text')
+    parser.add_argument('--patience', type=int, default=5000, help='stop a chain after this many iterations without improvement, 0 to disable')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--model', default=None, help='directory of the compiled language model')
+    parser.add_argument('--cache', default=None, help='result cache database, see cache.py')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or store cached results')
+    args = parser.parse_args()
+
+    infile = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+
+    results = None if args.no_cache else open_cache(args.cache, args.model)
+
+    with infile, outfile:
+        run_batch(infile, outfile, args.workers, args.iters, args.chains, args.patience, args.seed,
+                  args.model, results)
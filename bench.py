@@ -0,0 +1,409 @@
+"""
+File containing the benchmark suite of the decipher pipeline.
+
+Encrypted texts of several lengths are generated from seeded excerpts of the reference text and
+seeded ciphers from utils.generateEncryptionCipher. For every model order, text length, chain
+count and worker count the suite measures
+    - throughput: iterations per second of runner.run_chains over a fixed number of iterations
+    - score evaluations per second of the incremental scoring engine alone
+    - time to solution: total wall-clock time and total iterations of all the chains until they
+      reach the score of the true decryption cipher, whether they deciphered every letter
+      correctly, and the time and iterations of the fastest chain (chain_*_to_solution)
+Results are written as JSON, and can be compared against a stored baseline to flag regressions:
+
+    $ python bench.py -o baseline.json
+    $ python bench.py --baseline baseline.json
+"""
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+import annealing
+import model
+import mcmc
+import scoring
+import stopping
+import utils
+from cipher import Cipher
+from runner import run_chains
+
+
+# Reference text the benchmark excerpts are taken from
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'texts', 'war_and_peace.txt')
+
+# Metrics compared against a baseline, with whether higher values are better
+METRICS = {
+    'iterations_per_second': True,
+    'score_evaluations_per_second': True,
+    'iterations_to_solution': False,
+    'chain_time_to_solution': False,
+    'chain_iterations_to_solution': False,
+}
+
+# Directory the missing models are built in, outside of the repository
+MODEL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'mcmc-decipher', 'models')
+
+
+def model_path(order):
+    """
+    Finds the compiled model of an order next to the default model, or builds it from the
+    reference text in MODEL_CACHE_DIR if it is missing
+    ----------
+    params:
+        order (int): Length of the n-grams of the model
+    returns:
+        path (str): Directory of the compiled model
+    """
+    name = {2: 'bigram', 3: 'trigram', 4: 'quadgram'}.get(order, f'{order}gram')
+    path = os.path.join(os.path.dirname(model.DEFAULT_MODEL_PATH), f'{name}.model')
+    if os.path.exists(os.path.join(path, 'header.json')):
+        return path
+
+    path = os.path.join(MODEL_CACHE_DIR, f'{name}.model')
+    if not os.path.exists(os.path.join(path, 'header.json')):
+        from data import data as corpus
+        print(f'Building {path} from {os.path.basename(DEFAULT_CORPUS)}', file=sys.stderr)
+        corpus.buildModel([DEFAULT_CORPUS], path, order=order)
+
+    return path
+
+
+def generate_text(corpus, length, rng):
+    """
+    Takes a seeded excerpt of the reference text, reduced to upper case letters and single spaces
+    ----------
+    params:
+        corpus (str): Reduced reference text
+        length (int): Number of characters of the excerpt
+        rng (generator): Seeded random number generator
+    returns:
+        base (str): Plain text excerpt
+    """
+    start = int(rng.integers(0, len(corpus) - length))
+
+    # Start and end on word boundaries
+    start = corpus.find(' ', start) + 1
+    return corpus[start:start + length].strip()
+
+
+def load_corpus(path=DEFAULT_CORPUS):
+    """
+    Reads the reference text and reduces it to upper case letters and single spaces
+    """
+    with open(path, encoding='utf-8') as f:
+        classes = scoring.text_to_classes(f.read())
+
+    chars = np.frombuffer((scoring.ALPHABET + ' ').encode('ascii'), dtype=np.uint8)
+    return ' '.join(chars[classes].tobytes().decode('ascii').split())
+
+
+def score_evaluations(encoded_text, log_probs, rng, n=20000):
+    """
+    Measures the number of incremental score evaluations (scoring.delta_score) per second
+    ----------
+    params:
+        encoded_text (str): Encrypted text
+        log_probs (np.ndarray): Log transition probabilities of the model
+        rng (generator): Seeded random number generator
+        n (int): Number of evaluations timed, default 20,000
+    returns:
+        rate (float): Score evaluations per second
+    """
+    counts = scoring.text_statistics(encoded_text, log_probs.ndim)
+    state = scoring.ChainState(np.append(rng.permutation(26), scoring.SPACE), counts, log_probs)
+    first = rng.integers(0, 26, size=n).tolist()
+    second = rng.integers(0, 25, size=n)
+    second = (second + (second >= first)).tolist()
+
+    start = time.perf_counter()
+    for i, j in zip(first, second):
+        scoring.delta_score(state, i, j)
+    return n / (time.perf_counter() - start)
+
+
+def bench_case(base, encrypt_key, path, n_chains, workers, iters, max_iters, seed, schedule=None,
+               reheat=None, init='random', proposal='uniform'):
+    """
+    Runs the throughput and time to solution benchmarks of a single configuration
+    ----------
+    params:
+        base (str): Plain text
+        encrypt_key (str): Encryption cipher applied to the plain text
+        path (str): Directory of the compiled model
+        n_chains (int): Number of chains
+        workers (int): Number of worker processes
+        iters (int): Number of iterations per chain of the throughput run
+        max_iters (int): Maximum number of iterations per chain of the time to solution run
+        seed (int): Seed of the chains
+        schedule (annealing.Schedule): Cooling schedule of the time to solution run, default None
+        reheat (int): Iterations without improvement before the schedule is reheated
+        init (str): Initial cipher of the chains, see runner.run_chains
+        proposal (str): Swap proposals of the chains, see runner.run_chains
+    returns:
+        result (dict): Measured metrics
+    """
+    encoded_text = utils.applyKey(encrypt_key, base)
+    log_probs = model.load_model(path).log_probs
+
+    # Throughput over a fixed number of iterations, including the start of the pool
+    start = time.perf_counter()
+    throughput = run_chains(encoded_text, n_chains, iters, workers, seed, path, instrument=True,
+                            init=init, proposal=proposal)
+    wall_time = time.perf_counter() - start
+    total = sum(result.iterations for result in throughput)
+
+    # Time to solution, the chains stop once they reach the score of the true decryption cipher
+    counts = scoring.text_statistics(encoded_text, log_probs.ndim)
+    perm = scoring.key_to_perm(Cipher.from_key(encrypt_key).inverse.key)
+    target = scoring.score_perm(perm, counts, log_probs)
+
+    start = time.perf_counter()
+    solutions = run_chains(
+        encoded_text, n_chains, max_iters, workers, seed, path,
+        stop=[stopping.ScoreTarget(target)], instrument=True, schedule=schedule, reheat=reheat,
+        init=init, proposal=proposal
+    )
+    solve_time = time.perf_counter() - start
+
+    accuracies = [utils.testCipher(encrypt_key, base, result.best_key)[2] for result in solutions]
+    solved = [result for result, accuracy in zip(solutions, accuracies) if accuracy == 1.0]
+
+    return {
+        'iterations_per_second': total / wall_time,
+        'chain_iterations_per_second': float(np.mean([r.report['scores_per_second'] for r in throughput])),
+        'wall_time': wall_time,
+        'solved': len(solved),
+        'accuracy': float(np.mean(accuracies)),
+        # Total iterations of all the chains of the run until they stopped, None if no chain
+        # solved the text. solve_wall_time is the matching total time
+        'iterations_to_solution': sum(r.iterations for r in solutions) if solved else None,
+        'solve_wall_time': solve_time,
+        # Per chain figures of the first chain to solve the text, None if no chain did
+        'chain_time_to_solution': min((r.report['wall_time'] for r in solved), default=None),
+        'chain_iterations_to_solution': min((r.iterations for r in solved), default=None),
+    }
+
+
+def bench_samplers(base, encrypt_key, path, max_iters, hmc_iters, seed):
+    """
+    Compares Metropolis-Hastings with Hamiltonian Monte Carlo on a single chain started from the
+    same random decryption cipher, both stopping once they reach the score of the true cipher
+    ----------
+    params:
+        base (str): Plain text
+        encrypt_key (str): Encryption cipher applied to the plain text
+        path (str): Directory of the compiled (bigram) model
+        max_iters (int): Maximum number of Metropolis-Hastings iterations
+        hmc_iters (int): Maximum number of Hamiltonian Monte Carlo trajectories
+        seed (int): Seed of the chains
+    returns:
+        results (dict): Metrics of every sampler. Iterations are proposals for
+                        Metropolis-Hastings and trajectories for Hamiltonian Monte Carlo, whose
+                        cost in gradient evaluations is reported separately
+    """
+    encoded_text = utils.applyKey(encrypt_key, base)
+    log_probs = model.load_model(path).log_probs
+    counts = scoring.text_statistics(encoded_text, log_probs.ndim)
+    perm = scoring.key_to_perm(Cipher.from_key(encrypt_key).inverse.key)
+    target = scoring.score_perm(perm, counts, log_probs)
+
+    samplers = {
+        'metropolis_hastings': lambda key, rng: mcmc.mcmc(
+            key, encoded_text, rng, max_iters, log_probs, stop=[stopping.ScoreTarget(target)]
+        ),
+        'hamiltonian_monte_carlo': lambda key, rng: mcmc.hamiltonian_monte_carlo(
+            key, encoded_text, rng, hmc_iters, log_probs, stop=[stopping.ScoreTarget(target)]
+        ),
+    }
+
+    results = {}
+    for name, sampler in samplers.items():
+        rng = np.random.default_rng(seed)
+        initial_key = ''.join(rng.permutation(list(scoring.ALPHABET)))
+
+        start = time.perf_counter()
+        result = sampler(initial_key, rng)
+        wall_time = time.perf_counter() - start
+
+        solved = result.best_score >= target - 1e-6
+        results[name] = {
+            'solved': bool(solved),
+            'accuracy': utils.testCipher(encrypt_key, base, result.best_key)[2],
+            'best_score': float(result.best_score),
+            'target_score': float(target),
+            'iterations': result.iterations,
+            'wall_time': wall_time,
+            'iterations_to_solution': result.iterations if solved else None,
+            'time_to_solution': wall_time if solved else None,
+        }
+        if result.report is not None:
+            results[name]['gradient_evaluations'] = result.report['gradient_evaluations']
+
+    return results
+
+
+def run_benchmarks(lengths=(100, 300, 1000), chains=(1, 4), workers=(1, 4), orders=(2,),
+                   iters=10000, max_iters=50000, seed=0, schedule=None, reheat=None, hmc_iters=None,
+                   init='random', proposal='uniform'):
+    """
+    Runs the benchmark suite over every combination of model order, text length, chain count
+    and worker count
+    ----------
+    params:
+        lengths (iterable): Lengths of the encrypted texts, default (100, 300, 1000)
+        chains (iterable): Numbers of chains, default (1, 4)
+        workers (iterable): Numbers of worker processes, default (1, 4)
+        orders (iterable): Orders of the models, built from the reference text if missing,
+                           default (2,)
+        iters (int): Number of iterations per chain of the throughput runs, default 10,000
+        max_iters (int): Maximum number of iterations per chain of the time to solution runs,
+                         default 50,000
+        seed (int): Seed of the texts, ciphers and chains, default 0
+        schedule (str): Name of the cooling schedule of the time to solution runs, one of
+                        annealing.SCHEDULES, default None (sampling at temperature 1)
+        reheat (int): Iterations without improvement before the schedule is reheated
+        hmc_iters (int): Also compare Metropolis-Hastings with Hamiltonian Monte Carlo (run for
+                         at most this many trajectories) on every text, with the bigram model,
+                         default None (no comparison)
+        init (str): Initial cipher of the chains, 'random' or 'frequency', default 'random'
+        proposal (str): Swap proposals of the chains, 'uniform' or 'ranked', default 'uniform'
+    returns:
+        report (dict): Environment of the run and the results of every configuration
+    """
+    corpus = load_corpus()
+    results = []
+    samplers = []
+
+    for order in orders:
+        path = model_path(order)
+        log_probs = model.load_model(path).log_probs
+
+        for length in lengths:
+            # Same text and cipher for every order, chain count and worker count
+            rng = np.random.default_rng([seed, length])
+            base = generate_text(corpus, length, rng)
+            encrypt_key = utils.generateEncryptionCipher(rng)
+            evaluations = score_evaluations(utils.applyKey(encrypt_key, base), log_probs, rng)
+
+            if hmc_iters and order == 2:
+                print(f'Comparing samplers on length={length}', file=sys.stderr)
+                samplers.append({'length': length, **bench_samplers(
+                    base, encrypt_key, path, max_iters, hmc_iters, seed
+                )})
+
+            for n_chains in chains:
+                for n_workers in workers:
+                    name = f'order={order}/length={length}/chains={n_chains}/workers={n_workers}'
+                    print(f'Running {name}', file=sys.stderr)
+
+                    result = {'name': name, 'order': order, 'length': length, 'chains': n_chains,
+                              'workers': n_workers, 'score_evaluations_per_second': evaluations}
+                    result.update(bench_case(
+                        base, encrypt_key, path, n_chains, n_workers, iters, max_iters, seed,
+                        annealing.SCHEDULES[schedule]() if schedule else None, reheat, init,
+                        proposal
+                    ))
+                    results.append(result)
+
+    return {
+        'environment': {
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'parameters': {'iters': iters, 'max_iters': max_iters, 'seed': seed,
+                       'schedule': schedule, 'reheat': reheat, 'hmc_iters': hmc_iters,
+                       'init': init, 'proposal': proposal},
+        'results': results,
+        'samplers': samplers,
+    }
+
+
+def compare(report, baseline, tolerance=0.1):
+    """
+    Compares the results of a run with a stored baseline
+    ----------
+    params:
+        report (dict): Report of the current run, see run_benchmarks
+        baseline (dict): Report of the baseline run
+        tolerance (float): Relative change of a metric in the wrong direction above which it is
+                           flagged as a regression, default 0.1 (10%)
+    returns:
+        regressions (list): (name, metric, baseline value, current value) of every regression
+    """
+    previous = {result['name']: result for result in baseline['results']}
+    regressions = []
+
+    for result in report['results']:
+        if result['name'] not in previous:
+            continue
+
+        for metric, higher_is_better in METRICS.items():
+            old, new = previous[result['name']].get(metric), result.get(metric)
+
+            # A text solved in the baseline but not anymore is a regression
+            if old is not None and new is None:
+                regressions.append((result['name'], metric, old, new))
+                continue
+            if old is None or new is None:
+                continue
+
+            change = (new - old) / old if old else 0.0
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append((result['name'], metric, old, new))
+
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the throughput and time to solution of the decipher')
+    parser.add_argument('-o', '--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change flagged as a regression')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[100, 300, 1000])
+    parser.add_argument('--chains', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--orders', type=int, nargs='+', default=[2])
+    parser.add_argument('--iters', type=int, default=10000, help='iterations per chain of the throughput runs')
+    parser.add_argument('--max-iters', type=int, default=50000, help='iteration limit of the time to solution runs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--schedule', choices=sorted(annealing.SCHEDULES), default=None,
+                        help='anneal the time to solution runs with this cooling schedule')
+    parser.add_argument('--reheat', type=int, default=None, help='reheat after this many iterations without improvement')
+    parser.add_argument('--init', choices=['random', 'frequency'], default='random',
+                        help='initial cipher of the chains')
+    parser.add_argument('--proposal', choices=['uniform', 'ranked'], default='uniform',
+                        help='swap proposals of the chains')
+    parser.add_argument('--hmc', type=int, default=None, metavar='TRAJECTORIES',
+                        help='also compare Metropolis-Hastings with Hamiltonian Monte Carlo on every text')
+    args = parser.parse_args()
+
+    report = run_benchmarks(
+        args.lengths, args.chains, args.workers, args.orders, args.iters, args.max_iters, args.seed,
+        args.schedule, args.reheat, args.hmc, args.init, args.proposal
+    )
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+
+        for name, metric, old, new in regressions:
+            print(f'REGRESSION {name} {metric}: {old} -> {new}', file=sys.stderr)
+        print(f'{len(regressions)} regression(s) against {args.baseline}', file=sys.stderr)
+        sys.exit(1 if regressions else 0)
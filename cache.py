@@ -0,0 +1,253 @@
+"""
+File containing the persistent result cache.
+
+Best decryption ciphers are stored in an sqlite3 database, keyed by a hash of the normalized
+encrypted text, the contents of the language model and the sampler parameters, so an exact repeat
+of a text returns its stored cipher instantly. Every entry also keeps the bigram statistics of its
+encrypted text: texts encrypted with the same cipher have similar statistics, so the ciphers of
+the most similar cached texts make good initial ciphers when there is no exact match. The total
+size of the entries is bounded, the least recently used ones are evicted first.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+import model
+import scoring
+
+
+# Default location of the cache database
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'mcmc-decipher', 'results.sqlite')
+
+# Value of $MCMC_DECIPHER_CACHE that turns the cache off
+DISABLED = 'off'
+
+# Content hashes of the models loaded so far, by directory
+_model_digests = {}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    text_hash TEXT NOT NULL,
+    model TEXT NOT NULL,
+    params TEXT NOT NULL,
+    decrypt_key TEXT NOT NULL,
+    score REAL NOT NULL,
+    signature BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed);
+CREATE INDEX IF NOT EXISTS results_model ON results (model, accessed);
+"""
+
+
+def normalize(text):
+    """
+    Reduces a text to what the samplers see: upper case letters separated by single spaces
+    ----------
+    params:
+        text (str): Some string of text
+    returns:
+        normalized (str): The normalized text
+    """
+    chars = np.frombuffer((scoring.ALPHABET + ' ').encode('ascii'), dtype=np.uint8)
+    return ' '.join(chars[scoring.text_to_classes(text)].tobytes().decode('ascii').split())
+
+
+def model_digest(path=None):
+    """
+    Hashes every file of a compiled model (model.MODEL_FILES), so cached results are tied to the
+    exact model they were computed with
+    ----------
+    params:
+        path (str): Directory of the compiled model, see model.load_model
+    returns:
+        digest (str): Hex SHA-256 of the model
+    """
+    path = model.load_model(path).path
+    if path not in _model_digests:
+        digest = hashlib.sha256()
+        for name in model.MODEL_FILES:
+            if not os.path.exists(os.path.join(path, name)):
+                continue
+            digest.update(name.encode('ascii'))
+            with open(os.path.join(path, name), 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+        _model_digests[path] = digest.hexdigest()
+    return _model_digests[path]
+
+
+def signature(text):
+    """
+    Bigram statistics of a normalized encrypted text as a unit vector, texts encrypted with the
+    same cipher have a high cosine similarity
+    """
+    counts = scoring.bigram_counts(text).ravel().astype(np.float32)
+    norm = np.linalg.norm(counts)
+    return counts / norm if norm else counts
+
+
+def open_cache(path=None, model_path=None):
+    """
+    Opens a result cache, unless no path is given and $MCMC_DECIPHER_CACHE is set to 'off'
+    ----------
+    params:
+        path (str): sqlite3 database file, see ResultCache
+        model_path (str): Directory of the compiled model the results belong to
+    returns:
+        cache (ResultCache): The cache, None when it is turned off
+    """
+    if path is None and os.environ.get('MCMC_DECIPHER_CACHE') == DISABLED:
+        return None
+    return ResultCache(path, model_path=model_path)
+
+
+class ResultCache:
+    """
+    Persistent cache of the best decryption ciphers of encrypted texts
+    ----------
+    params:
+        path (str): sqlite3 database file, defaults to $MCMC_DECIPHER_CACHE or
+                    ~/.cache/mcmc-decipher/results.sqlite
+        max_bytes (int): Maximum total size of the entries, default 64 MiB
+        model_path (str): Directory of the compiled model the results belong to, see
+                          model.load_model
+    """
+    def __init__(self, path=None, max_bytes=64 << 20, model_path=None):
+        if path is None:
+            path = os.environ.get('MCMC_DECIPHER_CACHE', DEFAULT_CACHE_PATH)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.model = model_digest(model_path)
+        self._db = sqlite3.connect(path)
+        self._db.executescript(_SCHEMA)
+
+    def key(self, text, params):
+        """
+        Content address of a result
+        ----------
+        params:
+            text (str): Encrypted text
+            params (dict): Sampler parameters (JSON serializable)
+        returns:
+            key (str): Hex SHA-256 of the normalized text, the model and the parameters
+        """
+        text_hash = hashlib.sha256(normalize(text).encode('ascii')).hexdigest()
+        params = json.dumps(params, sort_keys=True)
+        return hashlib.sha256(f'{text_hash}:{self.model}:{params}'.encode('ascii')).hexdigest()
+
+    def get(self, text, params):
+        """
+        Looks up the stored result of an encrypted text
+        ----------
+        params:
+            text (str): Encrypted text
+            params (dict): Sampler parameters the result was computed with
+        returns:
+            result (tuple): (decryption cipher, score), None when the text is not cached
+        """
+        key = self.key(text, params)
+        row = self._db.execute('SELECT decrypt_key, score FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        with self._db:
+            self._db.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), key))
+        return row[0], row[1]
+
+    def put(self, text, params, decrypt_key, score):
+        """
+        Stores the result of an encrypted text and evicts the least recently used entries
+        beyond max_bytes
+        ----------
+        params:
+            text (str): Encrypted text
+            params (dict): Sampler parameters the result was computed with
+            decrypt_key (str): Best decryption cipher
+            score (float): Score of the decryption cipher
+        returns:
+            None
+        """
+        normalized = normalize(text)
+        text_hash = hashlib.sha256(normalized.encode('ascii')).hexdigest()
+        params_json = json.dumps(params, sort_keys=True)
+        blob = signature(normalized).tobytes()
+        size = len(blob) + len(params_json) + len(decrypt_key) + 3 * 64
+
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.key(text, params), text_hash, self.model, params_json, decrypt_key,
+                 float(score), blob, size, time.time())
+            )
+            self._evict()
+
+    def _evict(self):
+        """Deletes the least recently used entries until the cache fits in max_bytes"""
+        excess = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+
+        evicted = []
+        for key, size in self._db.execute('SELECT key, size FROM results ORDER BY accessed'):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self._db.executemany('DELETE FROM results WHERE key = ?', evicted)
+
+    def similar(self, text, k=4, threshold=0.6, candidates=1000):
+        """
+        Finds the decryption ciphers of the cached texts with the most similar statistics, to be
+        used as initial ciphers (see runner.run_chains)
+        ----------
+        params:
+            text (str): Encrypted text
+            k (int): Maximum number of ciphers returned, default 4
+            threshold (float): Minimum cosine similarity of the bigram statistics, default 0.6.
+                               Texts of a few hundred letters encrypted with the same cipher
+                               are typically above 0.8, with different ciphers below 0.4
+            candidates (int): Number of most recently used entries of the same model compared,
+                              default 1000
+        returns:
+            keys (list): Distinct decryption ciphers, most similar first
+        """
+        rows = self._db.execute(
+            'SELECT decrypt_key, signature FROM results WHERE model = ? ORDER BY accessed DESC LIMIT ?',
+            (self.model, candidates)
+        ).fetchall()
+        if not rows:
+            return []
+
+        signatures = np.frombuffer(b''.join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+        similarity = signatures @ signature(normalize(text))
+
+        keys = []
+        for n in np.argsort(-similarity, kind='stable'):
+            if similarity[n] < threshold or len(keys) == k:
+                break
+            if rows[n][0] not in keys:
+                keys.append(rows[n][0])
+        return keys
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def close(self):
+        """Closes the database"""
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,224 @@
+"""
+File containing the checkpoints of long MCMC runs.
+
+A Checkpointer passed to mcmc.mcmc periodically writes the full state of the sampler (current and
+best ciphers, cached score, iteration and acceptance counters, random number generator states,
+buffered proposals, recorded history, cooling schedule and stopping criteria) to a single .npz
+file. Files are written to a temporary file first and moved into place, so a killed process
+leaves either the previous or the new checkpoint behind, never a partial one. Running the same
+call again with the same Checkpointer resumes from the file and continues the exact same random
+trajectory, so a resumed run is bit-identical to an uninterrupted one.
+"""
+import hashlib
+import json
+import math
+import os
+import pickle
+import time
+
+import numpy as np
+
+
+# Version of the checkpoint layout, checkpoints of other versions are refused
+CHECKPOINT_VERSION = 2
+
+
+def fingerprint(encoded_text, iters, log_probs, perm=None, rng_state=None, proposals=None,
+                history=None, schedule=None, reheat=None):
+    """
+    Identifies a run, so a checkpoint is never resumed into a different one
+    ----------
+    params:
+        encoded_text (str): Encrypted text of the run, or its statistics
+        iters (int): Number of iterations of the run
+        log_probs (np.ndarray): Log transition probabilities of the model of the run
+        perm (np.ndarray): Initial permutation of the run
+        rng_state (dict): State of the bit generator of the run before its first draw
+        proposals (proposals.SwapProposals): Source of the proposals of the run, before its
+                                             first draw
+        history (recording.History): Recorder of the scores of the run
+        schedule (annealing.Schedule): Cooling schedule of the run, before it is started
+        reheat (int): Reheat setting of the run
+    returns:
+        fingerprint (str): Hex SHA-256 of all of the above
+    """
+    if isinstance(encoded_text, str):
+        digest = hashlib.sha256(encoded_text.encode('utf-8'))
+    else:
+        digest = hashlib.sha256(np.ascontiguousarray(getattr(encoded_text, 'grams', encoded_text)).tobytes())
+        digest.update(np.ascontiguousarray(getattr(encoded_text, 'weights', b'')).tobytes())
+    digest.update(str(iters).encode('ascii'))
+    digest.update(str(getattr(log_probs, 'order', log_probs.ndim)).encode('ascii'))
+    digest.update(np.ascontiguousarray(getattr(log_probs, 'log_probs', log_probs)).tobytes())
+
+    # Everything else that decides the trajectory of the run
+    if perm is not None:
+        digest.update(np.ascontiguousarray(perm, dtype=np.int64).tobytes())
+    digest.update(json.dumps(rng_state, sort_keys=True).encode('ascii'))
+    if proposals is not None:
+        digest.update(proposals.signature())
+    if history is not None:
+        digest.update(f'thin={history.thin} ring={history.ring} size={len(history.buffer)}'.encode('ascii'))
+    if schedule is not None:
+        digest.update(f'{type(schedule).__name__} {sorted(vars(schedule).items())!r}'.encode('utf-8'))
+    digest.update(f'reheat={reheat}'.encode('ascii'))
+    return digest.hexdigest()
+
+
+class Checkpointer:
+    """
+    Writes periodic checkpoints of a run and resumes runs from them
+    ----------
+    params:
+        path (str): Checkpoint file (.npz)
+        every (int): Minimum number of iterations between two checkpoints, default 10,000
+        max_overhead (float): Maximum fraction of the run time spent writing checkpoints, the
+                              next checkpoint is postponed until the run has gone on for long
+                              enough after a slow write, default 0.01 (1%)
+        resume (bool): Resume from the file if it exists, default True
+    """
+    def __init__(self, path, every=10000, max_overhead=0.01, resume=True):
+        self.path = path
+        self.every = every
+        self.max_overhead = max_overhead
+        self.resume = resume
+        self.next = every
+        self.writes = 0
+        self.write_time = 0.0
+        self._last = None
+
+    def load(self, fingerprint):
+        """
+        Reads the checkpoint of a run
+        ----------
+        params:
+            fingerprint (str): Fingerprint of the run, see fingerprint()
+        returns:
+            state (dict): Saved state of the sampler, None when there is nothing to resume
+        """
+        if not self.resume or not os.path.exists(self.path):
+            return None
+
+        with np.load(self.path) as f:
+            state = {name: f[name] for name in f.files}
+
+        meta = json.loads(str(state.pop('meta')))
+        if meta['version'] != CHECKPOINT_VERSION:
+            raise ValueError(f'{self.path} has checkpoint version {meta["version"]}, expected {CHECKPOINT_VERSION}')
+        if meta['fingerprint'] != fingerprint:
+            raise ValueError(
+                f'{self.path} is a checkpoint of a different run (the text, iterations, model, '
+                'initial cipher, seed, proposals, thinning, schedule or reheat differ), remove it '
+                'or use another checkpoint directory'
+            )
+
+        state.update(meta)
+        state['objects'] = pickle.loads(state['objects'].tobytes())
+        self.next = state['iteration'] + self.every
+        self._last = time.perf_counter(), state['iteration']
+        return state
+
+    def start(self, iteration=0):
+        """Called by the sampler before its first iteration"""
+        self.next = iteration + self.every
+        self._last = time.perf_counter(), iteration
+
+    def save(self, iteration, fingerprint, finished, state, best, counters, proposals, rng,
+             history, objects):
+        """
+        Atomically writes the state of the sampler and schedules the next checkpoint
+        ----------
+        params:
+            iteration (int): Number of iterations run so far
+            fingerprint (str): Fingerprint of the run, see fingerprint()
+            finished (bool): Whether the run is over (stopped early or at its last iteration)
+            state (scoring.ChainState): Current decryption cipher and its cached score
+            best (tuple): (permutation, score, iteration) of the best decryption cipher
+            counters (dict): Integer counters of the sampler (e.g. accepted proposals)
+            proposals (proposals.SwapProposals): Source of the proposals
+            rng (generator): Random number generator of the run
+            history (recording.History): Recorder of the scores
+            objects (dict): Other stateful objects of the run (schedule, stopping criteria),
+                            pickled
+        returns:
+            None
+        """
+        start = time.perf_counter()
+        streams = proposals.get_state()
+        meta = {
+            'version': CHECKPOINT_VERSION,
+            'fingerprint': fingerprint,
+            'iteration': iteration,
+            'finished': bool(finished),
+            'score': state.score,
+            'best_score': best[1],
+            'best_at': best[2],
+            'counters': counters,
+            'rng': rng.bit_generator.state,
+            'pair_rng': streams['pair'],
+            'uniform_rng': streams['uniform'],
+            'pos': streams['pos'],
+            'history_count': history.count,
+        }
+        arrays = {
+            'meta': np.array(json.dumps(meta)),
+            'perm': state.perm,
+            'best_perm': best[0],
+            'block_first': streams['block'][0],
+            'block_second': streams['block'][1],
+            'block_log_u': streams['block'][2],
+            'history': np.asarray(history.buffer[:min(history.count, len(history.buffer))]),
+            'objects': np.frombuffer(pickle.dumps(objects), dtype=np.uint8),
+        }
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+        # Postpone the next checkpoint so that writing them stays within max_overhead of the run
+        now = time.perf_counter()
+        cost = now - start
+        self.writes += 1
+        self.write_time += cost
+
+        last_time, last_iteration = self._last
+        per_iteration = (start - last_time) / max(iteration - last_iteration, 1)
+        wait = math.ceil(cost / self.max_overhead / per_iteration) if per_iteration > 0 else 0
+        self.next = iteration + max(self.every, wait)
+        self._last = now, iteration
+
+
+def restore(saved, state, proposals, rng, history):
+    """
+    Puts the saved state back into the objects of a resumed run
+    ----------
+    params:
+        saved (dict): State returned by Checkpointer.load
+        state (scoring.ChainState): Chain state of the run
+        proposals (proposals.SwapProposals): Source of the proposals of the run
+        rng (generator): Random number generator of the run
+        history (recording.History): Recorder of the scores of the run
+    returns:
+        best (tuple): (permutation, score, iteration) of the best decryption cipher
+    """
+    # The cached score is restored as is, rescoring could differ in the last bits
+    state.perm[:] = saved['perm']
+    state.score = saved['score']
+
+    proposals.set_state({
+        'pair': saved['pair_rng'],
+        'uniform': saved['uniform_rng'],
+        'block': (saved['block_first'], saved['block_second'], saved['block_log_u']),
+        'pos': saved['pos'],
+    })
+    if rng is not None:
+        rng.bit_generator.state = saved['rng']
+
+    samples = saved['history']
+    history.buffer[:len(samples)] = samples
+    history.count = saved['history_count']
+
+    return saved['best_perm'].copy(), saved['best_score'], saved['best_at']
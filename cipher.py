@@ -0,0 +1,167 @@
+"""
+File containing the Cipher type, a substitution cipher backed by a permutation array.
+
+Keys are passed around the code as 26-character strings, where the i-th character is the letter
+the i-th letter of the alphabet is substituted with. A Cipher holds the same permutation as a
+uint8 array and precompiles the translation tables of the substitution and of its inverse, so
+that applying it to a text is a single str.translate (or bytes.translate for ASCII text) call
+instead of a Python loop. Like utils.applyKey, letters are substituted independently of case,
+the result is upper case and every other character becomes a space.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+from scoring import ALPHABET
+
+
+# Byte value of the letters of the alphabet
+_LETTER_BYTES = np.frombuffer(ALPHABET.encode('ascii'), dtype=np.uint8)
+
+
+class _Translation(dict):
+    """
+    str.translate table of a substitution. Characters outside the table are looked up once
+    from their upper case form (so 'ß', whose upper case is 'SS', becomes a space exactly like
+    in utils.applyKey) and remembered.
+    """
+    __slots__ = ('letters',)
+
+    def __init__(self, letters):
+        super().__init__()
+        self.letters = letters
+
+    def __missing__(self, code):
+        value = self.letters.get(chr(code).upper(), ' ')
+        self[code] = value
+        return value
+
+
+class Cipher:
+    """
+    Substitution cipher with precompiled translation tables
+    ----------
+    params:
+        perm (array-like): Permutation of range(26), letter i of the alphabet is substituted
+                           with letter perm[i]
+    """
+    __slots__ = ('perm', '_key', '_inverse', '_bytes_table', '_str_table')
+
+    def __init__(self, perm):
+        perm = np.array(perm, dtype=np.uint8)
+        if perm.shape != (26,) or not np.array_equal(np.sort(perm), np.arange(26)):
+            raise ValueError('A cipher is a permutation of the 26 letters of the alphabet')
+        perm.flags.writeable = False
+
+        self.perm = perm
+        self._key = (_LETTER_BYTES[perm]).tobytes().decode('ascii')
+        self._inverse = None
+
+        # Every byte becomes a space except the letters, in both cases
+        table = bytearray(b' ' * 256)
+        table[65:91] = table[97:123] = self._key.encode('ascii')
+        self._bytes_table = bytes(table)
+        self._str_table = None
+
+    @classmethod
+    def from_key(cls, key):
+        """
+        Builds the cipher of a string key, memoized so that repeated keys share their tables
+        ----------
+        params:
+            key (str or Cipher): String representation of the cipher
+        returns:
+            cipher (Cipher): The cipher
+        """
+        if isinstance(key, cls):
+            return key
+        return _from_key(key)
+
+    @classmethod
+    def random(cls, rng):
+        """Draws a uniformly random cipher from a seeded random number generator"""
+        return cls(rng.permutation(26))
+
+    @property
+    def key(self):
+        """String representation of the cipher"""
+        return self._key
+
+    @property
+    def inverse(self):
+        """Cipher that undoes this one, e.g. the decryption cipher of an encryption cipher"""
+        if self._inverse is None:
+            self._inverse = Cipher(np.argsort(self.perm))
+            self._inverse._inverse = self
+        return self._inverse
+
+    def apply(self, text):
+        """
+        Substitutes every letter of a text, exactly like utils.applyKey(self.key, text)
+        ----------
+        params:
+            text (str): Some string of text
+        returns:
+            transformed (str): The transformed text
+        """
+        if text.isascii():
+            return text.encode('ascii').translate(self._bytes_table).decode('ascii')
+
+        # Slow path for non-ASCII text, the table is only built when needed
+        if self._str_table is None:
+            self._str_table = _Translation(dict(zip(ALPHABET, self._key)))
+        return text.translate(self._str_table)
+
+    def apply_many(self, texts):
+        """
+        Substitutes every letter of many texts with a single translation of their concatenation
+        ----------
+        params:
+            texts (iterable): Strings of text
+        returns:
+            transformed (list): The transformed texts, in order
+        """
+        texts = list(texts)
+        if not all(text.isascii() for text in texts):
+            return [self.apply(text) for text in texts]
+
+        transformed = self.apply(''.join(texts))
+        ends = np.cumsum([len(text) for text in texts]).tolist()
+        return [transformed[start:end] for start, end in zip([0] + ends, ends)]
+
+    def encrypt(self, text):
+        """Encrypts a text with this (encryption) cipher"""
+        return self.apply(text)
+
+    def decrypt(self, text):
+        """Decrypts a text encrypted with this (encryption) cipher"""
+        return self.inverse.apply(text)
+
+    def decrypt_many(self, texts):
+        """Decrypts many texts encrypted with this (encryption) cipher in one call"""
+        return self.inverse.apply_many(texts)
+
+    def __str__(self):
+        return self._key
+
+    def __repr__(self):
+        return f'Cipher.from_key({self._key!r})'
+
+    def __eq__(self, other):
+        if isinstance(other, Cipher):
+            return self._key == other._key
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __reduce__(self):
+        return _from_key, (self._key,)
+
+
+@lru_cache(maxsize=1024)
+def _from_key(key):
+    """Memoized Cipher.from_key for string keys"""
+    if len(key) != 26 or not key.isascii():
+        raise ValueError(f'{key!r} is not a cipher of the 26 letters of the alphabet')
+    return Cipher(np.frombuffer(key.encode('ascii'), dtype=np.uint8) - ord('A'))
@@ -1,64 +1,193 @@
-import numpy as numpy
-from collections import defaultdict
+import numpy as np
 import pickle
 import os.path
+import sys
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
-def generateFreqCounts(textFiles):
+# The model format lives in the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import model
+import scoring
+
+
+# Number of bytes of a file counted by a single task
+SHARD_SIZE = 1 << 22
+
+# Class given to UTF-8 continuation bytes, which are dropped so that every non-ASCII character
+# counts as a single non-letter
+_SKIP = 255
+
+# Lookup table from byte value to character class
+_BYTE_CLASSES = np.full(256, scoring.SPACE, dtype=np.uint8)
+_BYTE_CLASSES[0x80:0xC0] = _SKIP
+for _i, _letter in enumerate(scoring.ALPHABET):
+    _BYTE_CLASSES[ord(_letter)] = _i
+    _BYTE_CLASSES[ord(_letter.lower())] = _i
+
+
+def _countShard(textfile, start, end, order=2):
     """
-    Takes a list of .txt file and generates a dictionary with the frequencies of
-    every two letter pairs in the given text files.
+    Counts the n-grams ending in bytes [start, end) of a file. The bytes just before the shard
+    are read as well, so n-grams that cross shard boundaries are counted exactly once.
     ---------
     parameters:
-        textFiles (list): list of paths to text files
+        textfile (str): path to a text file
+        start, end (int): byte range of the shard
+        order (int): length of the n-grams, default 2
     ---------
     returns:
-        freq_dict (dict): frequency of all bigram character pairs
+        counts (np.ndarray or model.SparseCounts): dense 27**order array of n-gram counts, or
+                                                   sparse counts above model.DENSE_MAX_ORDER
     """
-    # Initialize table of frequencies
-    freq_dict = defaultdict(int)
+    lo = max(0, start - 4 * (order - 1))
+
+    with open(textfile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        classes = _BYTE_CLASSES[np.frombuffer(buf[lo:end], dtype=np.uint8)]
+
+    # Drop continuation bytes, remembering where the remaining characters came from
+    keep = np.flatnonzero(classes != _SKIP)
+    classes = classes[keep].astype(np.int64)
+    first = max(np.searchsorted(keep + lo, start), order - 1)
+
+    # Encode every n-gram ending inside the shard as a single integer
+    codes = np.zeros(max(len(classes) - first, 0), dtype=np.int64)
+    for k in range(order):
+        codes = codes * scoring.N_CLASSES + classes[first - (order - 1) + k:len(classes) - (order - 1) + k]
+
+    if order > model.DENSE_MAX_ORDER:
+        return model.SparseCounts(order, *np.unique(codes, return_counts=True))
 
-    # Set of English alphabet characters
-    chars = set(['A','B','C','D','E','F','G','H','I','J','K','L','M',
-                 'N','O','P','Q','R','S','T','U','V','W','X','Y','Z'])
+    size = scoring.N_CLASSES ** order
+    return np.bincount(codes, minlength=size).reshape((scoring.N_CLASSES,) * order)
 
-    # Iterate through each file in textFiles
+
+def buildCounts(textFiles, workers=None, order=2):
+    """
+    Counts the n-grams of all the given text files. Files are memory-mapped and split into
+    shards that are counted in a pool of processes, bytes are mapped to character classes
+    through a lookup table and counted with np.bincount. Unlike the previous line by line
+    version, n-grams that cross line breaks are counted and no character is dropped.
+    ---------
+    parameters:
+        textFiles (list): list of paths to text files
+        workers (int): number of worker processes, defaults to the number of CPUs
+        order (int): length of the n-grams, default 2
+    ---------
+    returns:
+        counts (np.ndarray or model.SparseCounts): dense 27**order array of n-gram counts, or
+                                                   sparse counts above model.DENSE_MAX_ORDER
+    """
+    shards = []
     for textfile in textFiles:
-        # Open the current textfile
-        f = open(textfile)
+        size = os.path.getsize(textfile)
+        for start in range(0, size, SHARD_SIZE):
+            shards.append((textfile, start, min(start + SHARD_SIZE, size)))
 
-        # Iterate through each line in the txt file
-        for line in f:
-            # Conver to upper case
-            line = str.upper(line)
+    if order > model.DENSE_MAX_ORDER:
+        counts = model.SparseCounts(order, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    else:
+        counts = np.zeros((scoring.N_CLASSES,) * order, dtype=np.int64)
+    if not shards:
+        return counts
 
-            # Remove '\n' characters
-            line = line[0:len(line)-1]
+    if workers is None:
+        workers = os.cpu_count() or 1
 
-            # Count the frequency of bigram characters
-            for i in range(len(line)-1):
-                bigram = line[i] + line[i+1]
+    if workers <= 1 or len(shards) == 1:
+        for shard in shards:
+            counts = counts + _countShard(*shard, order)
+        return counts
 
-                # Non-letter + letter
-                if (line[i] not in chars) and (line[i+1] in chars):
-                    bigram = ' ' + line[i+1]
+    with ProcessPoolExecutor(max_workers=min(workers, len(shards))) as executor:
+        for shard_counts in executor.map(_countShard, *zip(*shards), repeat(order)):
+            counts = counts + shard_counts
+    return counts
 
-                # Letter + non-letter
-                elif (line[i] in chars) and (line[i+1] not in chars):
-                    bigram = line[i] + ' '
 
-                # Two non-letters
-                elif (line[i] not in chars) and (line[i+1] not in chars):
-                    bigram = '  '
-                
-                # Increment bigram occurrence
-                freq_dict[bigram] += 1
+def buildModel(textFiles, path, workers=None, order=2, smoothing=1.0, dtype='float64'):
+    """
+    Builds a compiled language model (see model.py) from the given text files
+    ---------
+    parameters:
+        textFiles (list): list of paths to text files
+        path (str): directory to write the model to
+        workers (int): number of worker processes, defaults to the number of CPUs
+        order (int): length of the n-grams, default 2
+        smoothing (float): pseudo-count added to every n-gram, default 1
+        dtype (str): floating point type of the stored log probabilities, default float64
+    ---------
+    returns:
+        header (dict): contents of the written model header
+    """
+    counts = buildCounts(textFiles, workers, order)
+    sources = [os.path.basename(textfile) for textfile in textFiles]
+    return model.save_model(path, counts, smoothing, dtype, source=sources)
+
+
+def updateModel(textFiles, path, workers=None):
+    """
+    Merges the n-gram counts of new text files into an existing compiled model without
+    re-reading the texts it was built from
+    ---------
+    parameters:
+        textFiles (list): list of paths to new text files
+        path (str): directory of the model to update
+        workers (int): number of worker processes, defaults to the number of CPUs
+    ---------
+    returns:
+        header (dict): contents of the updated model header
+    """
+    old = model.load_model(path)
+    counts = buildCounts(textFiles, workers, old.order) + old.counts
+    sources = old.header['source'] + [os.path.basename(textfile) for textfile in textFiles]
+    return model.save_model(path, counts, old.header['smoothing'], old.header['dtype'], source=sources)
+
+
+def generateFreqCounts(textFiles):
+    """
+    Takes a list of .txt file and generates a dictionary with the frequencies of
+    every two letter pairs in the given text files.
+    ---------
+    parameters:
+        textFiles (list): list of paths to text files
+    ---------
+    returns:
+        freq_dict (dict): frequency of all bigram character pairs
+    """
+    counts = buildCounts(textFiles)
+    classes = scoring.ALPHABET + ' '
+
+    # Convert to the dictionary format
+    freq_dict = {
+        classes[a] + classes[b]: int(counts[a, b])
+        for a, b in zip(*np.nonzero(counts))
+    }
 
     # Pickle freq_dict
     with open('freq_dict.pkl', 'wb') as f:
         pickle.dump(freq_dict, f)
-        
+
+    return freq_dict
+
 
 if __name__ == "__main__":
-    if not os.path.exists('freq_dict.pkl'):
-        textFiles = ['texts/war_and_peace.txt', 'texts/bible.txt']
-        generateFreqCounts(textFiles)
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build a compiled language model from text files')
+    parser.add_argument('texts', nargs='*', default=['texts/war_and_peace.txt', 'texts/bible.txt'])
+    parser.add_argument('-o', '--output', default=None, help='model directory, default <name>.model')
+    parser.add_argument('--order', type=int, default=2, help='length of the n-grams')
+    parser.add_argument('--update', action='store_true', help='merge the texts into the existing model')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.output is None:
+        name = {2: 'bigram', 3: 'trigram', 4: 'quadgram'}.get(args.order, f'{args.order}gram')
+        args.output = f'{name}.model'
+
+    if args.update:
+        updateModel(args.texts, args.output, args.workers)
+    else:
+        buildModel(args.texts, args.output, args.workers, args.order)
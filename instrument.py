@@ -0,0 +1,89 @@
+"""
+File containing the opt-in instrumentation of the samplers.
+
+An Instrumentation object passed to a sampler collects cumulative per-phase timings with
+time.perf_counter_ns, counts proposals, acceptances and rejections, and can optionally run the
+whole chain under cProfile. Samplers that are not given one skip every timer call.
+"""
+import cProfile
+import io
+import pstats
+import time
+
+
+class Instrumentation:
+    """
+    Collects timings and counters of a single run
+    ----------
+    params:
+        profile (bool): Also run the chain under cProfile, default False
+        profile_lines (int): Number of functions kept in the cProfile report, default 25
+    """
+    # Phases of one iteration of the samplers
+    PHASES = ('propose', 'score', 'accept', 'record')
+
+    def __init__(self, profile=False, profile_lines=25):
+        self.timings = dict.fromkeys(self.PHASES, 0)
+        self.proposals = 0
+        self.accepted = 0
+        self.profile = profile
+        self.profile_lines = profile_lines
+        self._profiler = None
+        self._start = None
+        self._elapsed = 0
+
+    def start(self):
+        """Called by the sampler before its first iteration"""
+        if self.profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._start = time.perf_counter_ns()
+
+    def stop(self):
+        """Called by the sampler after its last iteration"""
+        self._elapsed += time.perf_counter_ns() - self._start
+        if self._profiler is not None:
+            self._profiler.disable()
+
+    def add(self, phase, start):
+        """
+        Adds the time since start to a phase and returns the current time, so that consecutive
+        phases can be chained
+        ----------
+        params:
+            phase (str): Name of the phase, one of PHASES
+            start (int): Value of time.perf_counter_ns() at the start of the phase
+        returns:
+            now (int): Value of time.perf_counter_ns() at the end of the phase
+        """
+        now = time.perf_counter_ns()
+        self.timings[phase] += now - start
+        return now
+
+    def report(self):
+        """
+        Builds the structured report of the run
+        ----------
+        returns:
+            report (dict): Per-phase timings in seconds, proposal, acceptance and rejection
+                           counts, acceptance rate, wall time, scores per second and, when
+                           profiling, the text of the cProfile report
+        """
+        seconds = self._elapsed / 1e9
+        report = {
+            'timings': {phase: ns / 1e9 for phase, ns in self.timings.items()},
+            'proposals': self.proposals,
+            'accepted': self.accepted,
+            'rejected': self.proposals - self.accepted,
+            'acceptance_rate': self.accepted / self.proposals if self.proposals else 0.0,
+            'wall_time': seconds,
+            'scores_per_second': self.proposals / seconds if seconds else 0.0,
+        }
+
+        if self._profiler is not None:
+            stream = io.StringIO()
+            stats = pstats.Stats(self._profiler, stream=stream)
+            stats.sort_stats('cumulative').print_stats(self.profile_lines)
+            report['profile'] = stream.getvalue()
+
+        return report
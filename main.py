@@ -1,4 +1,6 @@
-from mcmc import mcmc
+from runner import run_chains
+from cache import open_cache
+from cipher import Cipher
 import utils
 import numpy as np
 
@@ -28,77 +30,93 @@ dummy = """
 chars = ['A','B','C','D','E','F','G','H','I','J','K','L','M',
          'N','O','P','Q','R','S','T','U','V','W','X','Y','Z']
 
-# Generate a random encryption cipher
-encrypt_key = utils.generateEncryptionCipher(rng)
 
-# Prompt user if they want to use the predefined text or put in their own input
-prompt = input('Would you like to use predefined text? [Y/N]\n')
+def main():
+    # Generate a random encryption cipher
+    encrypt_key = Cipher.from_key(utils.generateEncryptionCipher(rng))
 
-# Use dummy text if user presses Y or y, otherwise use user input
-if prompt == 'Y' or prompt == 'y':
-    # Boolean flag indicating whether we used the full or reduced version
-    full = True
-    prompt = input('Would you like to use the full sample prompt? [Y/N]\n')
+    # Prompt user if they want to use the predefined text or put in their own input
+    prompt = input('Would you like to use predefined text? [Y/N]\n')
+
+    # Use dummy text if user presses Y or y, otherwise use user input
     if prompt == 'Y' or prompt == 'y':
-        user_input = dummy
+        # Boolean flag indicating whether we used the full or reduced version
+        full = True
+        prompt = input('Would you like to use the full sample prompt? [Y/N]\n')
+        if prompt == 'Y' or prompt == 'y':
+            user_input = dummy
+        else:
+            user_input = dummy_less
+            full = False
+
+    # Prompt user for some text to be encrypted
+    else:
+        user_input = input("Type text you wish to be encrypted:\n")
+
+    # Apply the key
+    encoded_text = encrypt_key.encrypt(user_input)
+
+    # Display user input and encrypted input
+    print(f'\nUnencrypted text: \n{user_input}\n')
+    print(f'Encrypted text:\n{encoded_text}\n')
+
+    # An exact repeat (the predefined texts are encrypted with the same seeded cipher on every run)
+    # is answered from the result cache, unless MCMC_DECIPHER_CACHE=off
+    params = {'iters': 10000, 'chains': 10, 'init': 'frequency', 'proposal': 'ranked'}
+    cache = open_cache()
+    hit = cache.get(encoded_text, params) if cache is not None else None
+    if cache is not None:
+        print(f'Results are cached in {cache.path} (set MCMC_DECIPHER_CACHE=off to disable)\n')
+
+    if hit is not None:
+        print('Found in the cache, skipping MCMC\n')
+        ciphers = [hit]
     else:
-        user_input = dummy_less
-        full = False
-        
-# Prompt user for some text to be encrypted
-else:
-    user_input = input("Type text you wish to be encrypted:\n")
-
-# Apply the key
-encoded_text = utils.applyKey(encrypt_key, user_input)
-
-# Display user input and encrypted input
-print(f'\nUnencrypted text: \n{user_input}\n')
-print(f'Encrypted text:\n{encoded_text}\n')
-
-# Initialize array to store decryption ciphers and history curves
-ciphers, histories = [], []
-
-# 10 Runs of MCMC
-for _ in range(10):
-    # Generate a random decryption key
-    decrypt_list = list(rng.choice(chars, size=26, replace=False))
-    decrypt_key = "".join(decrypt_list)
-
-    # Convert decryption key to position representation
-    position = utils.toPosition(decrypt_key)
-
-    # Run MCMC
-    decrypt_key, history, score = mcmc(decrypt_key, encoded_text, rng, 10000)
-
-    # Record the decryption cipher and history
-    ciphers.append((decrypt_key, score))
-    histories.append(history)
-
-# Output the history curve
-if full:
-    filepath = 'plots/plot_full.png'
-else:
-    filepath = 'plots/plot_reduce.png'
-utils.plotHistories(histories, filepath)
-
-# Print decrypted text after MCMC
-ciphers.sort(key=lambda x: x[1])
-decrypt_key = ciphers[0][0]
-decoded_text = utils.applyKey(decrypt_key, encoded_text)
-print('----------------------')
-print(f'Original text:\n{user_input}\n')
-print(f'Final decrypted text:\n{decoded_text}\n')
-
-# Calculate the number of correct letters
-guess, count, percent = utils.testCipher(encrypt_key, alphabet, decrypt_key)
-
-# Print the true alphabet, decrypted alphabet, and correct decryptions
-print(f'Correct alphabet:\n{alphabet}\n')
-print(f'Encryption Key {encrypt_key}\n')
-print(f'Decrypted alphabet:\n{guess}\n')
-print(f'Number of correctly decoded letters:\n{count}\n')
-print(f'Percentage of correctly decoded letters:\n{percent * 100:.2f}%\n')
-
-# Generate summary statistics
-utils.summary(encrypt_key, alphabet, ciphers)
\ No newline at end of file
+        # 10 Runs of MCMC, spread over all available cores. Chains are warm-started from the
+        # decryption ciphers of previously deciphered texts with similar statistics, the others
+        # start near the cipher aligning letter frequencies, and swaps favour letters of similar
+        # frequency
+        initial_keys = cache.similar(encoded_text) if cache is not None else ()
+        results = run_chains(encoded_text, params['chains'], params['iters'], initial_keys=initial_keys,
+                             init=params['init'], proposal=params['proposal'])
+
+        # Record the decryption ciphers and history curves
+        ciphers = [(result.key, result.score) for result in results]
+        histories = [result.history for result in results]
+
+        # Output the history curve
+        if full:
+            filepath = 'plots/plot_full.png'
+        else:
+            filepath = 'plots/plot_reduce.png'
+        utils.plotHistories(histories, filepath, max_points=2000)
+
+    # Print decrypted text after MCMC
+    ciphers.sort(key=lambda x: x[1], reverse=True)
+    decrypt_key = Cipher.from_key(ciphers[0][0])
+    if cache is not None:
+        if hit is None:
+            cache.put(encoded_text, params, decrypt_key.key, ciphers[0][1])
+        cache.close()
+    decoded_text = decrypt_key.apply(encoded_text)
+    print('----------------------')
+    print(f'Original text:\n{user_input}\n')
+    print(f'Final decrypted text:\n{decoded_text}\n')
+
+    # Calculate the number of correct letters
+    guess, count, percent = utils.testCipher(encrypt_key, alphabet, decrypt_key)
+
+    # Print the true alphabet, decrypted alphabet, and correct decryptions
+    print(f'Correct alphabet:\n{alphabet}\n')
+    print(f'Encryption Key {encrypt_key}\n')
+    print(f'Decrypted alphabet:\n{guess}\n')
+    print(f'Number of correctly decoded letters:\n{count}\n')
+    print(f'Percentage of correctly decoded letters:\n{percent * 100:.2f}%\n')
+
+    # Generate summary statistics over the chains that were run
+    if hit is None:
+        utils.summary(encrypt_key, alphabet, ciphers)
+
+
+if __name__ == "__main__":
+    main()
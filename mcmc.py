@@ -1,167 +1,710 @@
 """
 File containing functions that run MCMC to find decryption cipher. 
 """
-from matplotlib.pyplot import step
 import utils
-import scipy.stats as st
-import autograd.numpy as np
-from autograd import grad
+import scoring
+import model
+import stopping
+import recording
+import observers as obs
+import proposals as prop
+import checkpoint as ckpt
+import relaxation
+import transposition as tp
+from time import perf_counter_ns
+import numpy as np
+from collections import namedtuple
 
 
-def mcmc(decrypt_key, encoded_text, rng, iters=50000):
+# Result of a single MCMC run, the key and score are the final ones, best_key and best_score the
+# best ever seen
+ChainResult = namedtuple(
+    'ChainResult', ['key', 'history', 'score', 'iterations', 'report', 'best_key', 'best_score'],
+    defaults=(None, None, None)
+)
+
+# Result of a parallel tempering run, the key, history and score belong to the coldest rung
+TemperingResult = namedtuple('TemperingResult', [
+    'key', 'history', 'score', 'best_key', 'best_score',
+    'temperatures', 'acceptance_rates', 'swap_rates'
+])
+
+# Result of a transposition run, order is the transposition key (the reading order of the columns)
+# and key the decryption cipher of the substitution
+TranspositionResult = namedtuple('TranspositionResult', [
+    'key', 'order', 'history', 'score', 'iterations', 'report', 'best_key', 'best_order', 'best_score'
+])
+
+
+def mcmc(decrypt_key, encoded_text, rng, iters=50000, log_probs=None, observers=(), stop=None,
+         history=None, instrument=None, proposals=None, schedule=None, reheat=None,
+         checkpoint=None):
     """
     Function that uses the Metroplis-Hastings algorithm for our Markov Chain 
     Monte Carlo implementation.
     ----------
     params:
         decrypt_key (str): String representation of the decryption cipher
-        encoded_text (str): Passed encrypted text
+        encoded_text (str): Passed encrypted text, or its statistics (see streaming.py)
         rng (generator): Seeded random number generator
         iters (int): Number of MCMC iterations, default 50,000
+        log_probs (np.ndarray): Log transition probabilities of the reference text (of any
+                                order), loaded from the default compiled model if not given
+        observers (iterable): Observers from observers.py notified of the progress of the run,
+                              e.g. observers.TextPrinter(encoded_text) to print the decrypted
+                              text every 500 iterations, default none
+        stop (list): Stopping criteria from stopping.py, the run ends as soon as one fires
+        history (recording.History): Recorder for the scores, e.g. to thin them or write them
+                                     to a file, default keeps every score in memory
+        instrument (instrument.Instrumentation): Collects per-phase timings and counters of
+                                                 the run, default None (no instrumentation)
+        proposals (proposals.SwapProposals): Buffered source of the swaps and acceptance
+                                             uniforms, default one drawn from rng
+        schedule (annealing.Schedule): Cooling schedule that turns the run into simulated
+                                       annealing, to find the single best decryption cipher
+                                       rather than sample them, default None (temperature 1)
+        reheat (int): Reheat the schedule once the best score has not improved for this many
+                      iterations, default None (never)
+        checkpoint (checkpoint.Checkpointer): Writes periodic checkpoints of the run and resumes
+                                              it from its file if it exists, default None
     returns:
-        decrypt_key (str): Decryption cipher sampled from MCMC
-        history (list): History of the scores during the MCMC run
+        ChainResult (key, history, score, iterations, report, best_key, best_score): Decryption
+            cipher sampled from MCMC, the array of recorded scores, the final score, the number
+            of iterations run, the instrumentation report (or None) and the best decryption
+            cipher seen during the run with its score
     """
-    # Get the character frequencies
-    freqDict = utils.loadFreqDict()
+    # Reduce the encrypted text and the reference text to their n-gram statistics once
+    if log_probs is None:
+        log_probs = model.load_model().log_probs
+    counts = scoring.text_statistics(encoded_text, log_probs.ndim)
+
+    # Chain state caches the score of the current decryption cipher
+    state = scoring.ChainState(scoring.key_to_perm(decrypt_key), counts, log_probs)
+    initial_perm, initial_rng = state.perm.copy(), rng.bit_generator.state
+
+    # Recorder to store the scores
+    if history is None:
+        history = recording.History(iters)
+
+    # Swaps and acceptance uniforms are drawn in blocks
+    if proposals is None:
+        proposals = prop.SwapProposals(rng)
 
-    # Array to store the scores
-    history = []
+    # Observers are only notified when they are due
+    watch = obs.Dispatcher(observers, iters)
+    accepted = 0
+
+    # Best decryption cipher seen so far and the iteration it was found at
+    best_perm, best_score, best_at = state.perm.copy(), state.score, 0
+
+    # Without a schedule every proposal is tested at temperature 1
+    annealing = schedule is not None
+
+    # Resume from the last checkpoint of the run, if there is one
+    start, finished, saved = 0, False, None
+    if checkpoint is not None:
+        run = ckpt.fingerprint(
+            encoded_text, iters, log_probs, initial_perm, initial_rng, proposals, history,
+            schedule, reheat
+        )
+        saved = checkpoint.load(run)
+
+    if saved is not None:
+        best_perm, best_score, best_at = ckpt.restore(saved, state, proposals, rng, history)
+        accepted = saved['counters']['accepted']
+        start, finished = saved['iteration'], saved['finished']
+        schedule, stop = saved['objects']['schedule'], saved['objects']['stop']
+        watch.resume(start)
+    else:
+        if annealing:
+            schedule.start(iters)
+        if checkpoint is not None:
+            checkpoint.start()
+
+    # Timers are only read when instrumented
+    timed = instrument is not None
+    if timed:
+        instrument.start()
 
-    print('Running Markov Chain Monte Carlo')
     # Run the MCMC for the passed number of iterations
-    for i in range(iters):
-        # Make proposal
-        proposal = utils.proposeKey(decrypt_key, rng)
-        # Calculate the quality of the current decryption cipher
-        curr_score = utils.score(decrypt_key, encoded_text, freqDict)
-        # Calculate the quality of the proposed decryption cipher
-        new_score = utils.score(proposal, encoded_text, freqDict)
+    for i in range(start, start if finished else iters):
+        if timed:
+            t = perf_counter_ns()
 
-        # Calculate the acceptance probability (ratio between the current
-        # score and proposed score)
-        accept_ratio = min(1, np.exp(new_score - curr_score))
+        # Make proposal (swap the letters at two random positions of the cipher), together
+        # with log(u) for a uniform u in [0,1)
+        first, second, log_u = proposals.draw()
+        if timed:
+            t = instrument.add('propose', t)
 
-        # Sample randomly from [0,1]
-        randnum = rng.uniform()
+        # Change in quality between the proposed and current decryption cipher
+        delta = scoring.delta_score(state, first, second)
+        if timed:
+            t = instrument.add('score', t)
 
-        # Boolean flag denoting if we should accept the proposal
-        acceptProposal = False if randnum > accept_ratio else True
+        # Boolean flag denoting if we should accept the proposal: u <= exp(delta / T) (the
+        # acceptance probability) is tested in log space, which needs no exp or clipping
+        if annealing:
+            acceptProposal = log_u * schedule.temperature(i+1, accepted) <= delta
+        else:
+            acceptProposal = log_u <= delta
 
         # Use new decryption cipher if we accept proposal
         if acceptProposal:
-            decrypt_key = proposal
+            state.swap(first, second, delta)
+            accepted += 1
+
+            # Keep the best decryption cipher
+            if state.score > best_score:
+                best_perm, best_score, best_at = state.perm.copy(), state.score, i+1
+
+        # Reheat the schedule when the chain stalls
+        if reheat and annealing and i+1 - best_at >= reheat:
+            schedule.reheat(i+1)
+            best_at = i+1
+        if timed:
+            t = instrument.add('accept', t)
 
         # Record the score of the decryption cipher
-        history.append(utils.score(decrypt_key, encoded_text, freqDict))
-        # Print every 500th iteration
-        if (i+1) == 1 or (i+1) % 500 == 0:
-            decode = utils.applyKey(decrypt_key, encoded_text)
-            score = utils.score(decrypt_key, encoded_text, freqDict)
-            print(f'Iteration {i+1:>5} -> Score: {score:.2f}\n')
-            print(f'Decrypted text:\n{decode}\n')
+        history.record(i+1, state.score)
+        # Notify the observers
+        if i+1 == watch.next:
+            watch.notify(obs.Event(i+1, iters, state.perm, state.score, accepted))
+
+        # Stop early once a stopping criterion fires
+        done = stop and stopping.check(stop, i+1, state.score, acceptProposal)
+        if timed:
+            instrument.add('record', t)
+        if done:
+            break
+
+        # Save the state of the sampler when a checkpoint is due
+        if checkpoint is not None and i+1 == checkpoint.next:
+            checkpoint.save(
+                i+1, run, False, state, (best_perm, best_score, best_at), {'accepted': accepted},
+                proposals, rng, history, {'schedule': schedule, 'stop': stop}
+            )
     
     # Return the final decryption cipher, the history of scores, and the final score
-    return decrypt_key, history, utils.score(decrypt_key, encoded_text, freqDict)
-
-# Initial position should be initial decryption cipher guess?
-def hamiltonian_monte_carlo(
-    n_samples,
-    potential,
-    position,
-    path_len,
-    step_size,
-    encoded_text
-    ):
+    iterations = i+1 if iters > start and not finished else start
+    if checkpoint is not None:
+        checkpoint.save(
+            iterations, run, True, state, (best_perm, best_score, best_at), {'accepted': accepted},
+            proposals, rng, history, {'schedule': schedule, 'stop': stop}
+        )
+
+    report = None
+    if timed:
+        instrument.stop()
+        instrument.proposals += iterations
+        instrument.accepted += accepted
+        report = instrument.report()
+
+    watch.finish(obs.Event(iterations, iters, state.perm, state.score, accepted))
+    history.close()
+    return ChainResult(
+        state.key, history.array, state.score, iterations, report,
+        scoring.perm_to_key(best_perm), best_score
+    )
+
+
+def mcmc_ensemble(encoded_text, n_chains, rng, iters=50000, log_probs=None, observers=(), stop=None,
+                  history=None, instrument=None):
     """
-    Function that uses Hamiltonian Monte Carlo to sample decryption ciphers.
-    -------------
+    Lockstep version of mcmc that runs an ensemble of independent Metropolis-Hastings chains as
+    one (N, 27) array of permutations. Every iteration draws one swap proposal per chain,
+    scores all of them with a single vectorized delta and accepts or rejects them at once.
+    A step costs far more than a step of mcmc but covers every chain: 1000 chains x 2000
+    iterations of the bigram model take about 1.6 s (1.3M proposals per second, 1.2 s of it
+    scoring) where 5 sequential chains x 2000 iterations take about 0.35 s (30k per second).
+    ----------
     params:
-    n_samples (int)
-        Number of samples (i.e., iterations) to run
-    
-    potential (callable)
-        Potential energy representation of the decryption cipher (i.e., negative log likelihood?)
+        encoded_text (str): Passed encrypted text, or its statistics (see streaming.py)
+        n_chains (int): Number of chains in the ensemble
+        rng (generator): Seeded random number generator
+        iters (int): Number of MCMC iterations, default 50,000
+        log_probs (np.ndarray): Log transition probabilities of the reference text (of any
+                                order), loaded from the default compiled model if not given
+        observers (iterable): Observers from observers.py notified of the progress of the run,
+                              their events hold one entry per chain, default none
+        stop (list): Stopping criteria from stopping.py. Per-chain criteria freeze the chains
+                     they fire for, ensemble criteria (GelmanRubin) stop every chain
+        history (recording.History): Recorder for the scores created with n_chains, default
+                                     keeps every score in memory
+        instrument (instrument.Instrumentation): Collects per-phase timings and counters of
+                                                 the whole ensemble, default None
+    returns:
+        results (list): ChainResult of every chain, in chain order. Every result shares the
+                        report of the ensemble
+    """
+    # Reduce the encrypted text and the reference text to their n-gram statistics once
+    if log_probs is None:
+        log_probs = model.load_model().log_probs
+    counts = scoring.text_statistics(encoded_text, log_probs.ndim)
+
+    # Random initial decryption ciphers, the space class always maps to itself
+    perms = np.empty((n_chains, scoring.N_CLASSES), dtype=int)
+    perms[:, :26] = np.argsort(rng.random((n_chains, 26)), axis=1)
+    perms[:, 26] = scoring.SPACE
+    scores = scoring.score_perms(perms, counts, log_probs)
+    best_perms, best_scores = perms.copy(), scores.copy()
+
+    # Recorder to store the scores of every chain
+    if history is None:
+        history = recording.History(iters, n_chains=n_chains)
+    chains = np.arange(n_chains)
+
+    # Chains that are still running and the iteration at which each chain stopped
+    active = np.ones(n_chains, dtype=bool)
+    stopped_at = np.full(n_chains, iters)
+
+    # Swaps and acceptance uniforms are drawn in blocks
+    proposals = prop.SwapProposals(rng, block_size=max(4096, n_chains))
+
+    # Observers are only notified when they are due
+    watch = obs.Dispatcher(observers, iters)
+    n_accepted = np.zeros(n_chains, dtype=int)
+
+    # Timers are only read when instrumented
+    timed = instrument is not None
+    if timed:
+        instrument.start()
+
+    for it in range(iters):
+        if timed:
+            t = perf_counter_ns()
+
+        # Make one proposal per chain (two distinct random positions to swap)
+        first, second, log_u = proposals.take(n_chains)
+        if timed:
+            t = instrument.add('propose', t)
+
+        # Change in quality between the proposed and current decryption ciphers
+        delta = scoring.delta_scores(perms, first, second, counts, log_probs)
+        if timed:
+            t = instrument.add('score', t)
+
+        # Metropolis-Hastings acceptance test for every running chain at once
+        accepted = active & (log_u <= delta)
+        accept = chains[accepted]
+
+        # Swap the letters of the accepted proposals
+        a, b = first[accept], second[accept]
+        perms[accept, a], perms[accept, b] = perms[accept, b], perms[accept, a]
+        scores[accept] += delta[accept]
+        n_accepted[accept] += 1
+
+        # Keep the best decryption cipher of every chain
+        improved = accept[scores[accept] > best_scores[accept]]
+        best_perms[improved], best_scores[improved] = perms[improved], scores[improved]
+        if timed:
+            t = instrument.add('accept', t)
+            instrument.proposals += int(active.sum())
+
+        # Record the scores of the decryption ciphers
+        history.record(it+1, scores)
+        if it+1 == watch.next:
+            watch.notify(obs.Event(it+1, iters, perms, scores, n_accepted))
+
+        # Freeze the chains for which a stopping criterion fired
+        if stop:
+            fired = active & stopping.check(stop, it+1, scores, accepted)
+            stopped_at[fired] = it+1
+            active &= ~fired
+        if timed:
+            instrument.add('record', t)
+        if not active.any():
+            break
 
-    position (np.array)
-        Position to sample from
+    report = None
+    if timed:
+        instrument.stop()
+        instrument.accepted += int(n_accepted.sum())
+        report = instrument.report()
 
-    path_len (float)
-        Length of each integration path. Smaller is faster and more correlated
+    watch.finish(obs.Event(int(stopped_at.max()) if iters else 0, iters, perms, scores, n_accepted))
 
-    step_size (float)
-        Size of each integration step. Smaller is slower and more accurate
-    -------------
+    # Chains that stopped early keep their frozen score until the end of the run, drop it
+    # unless only the most recent samples are kept
+    history.close()
+    samples = history.array
+    if history.ring is None:
+        ends = [history.samples(stopped_at[n]) for n in range(n_chains)]
+    else:
+        ends = [len(samples)] * n_chains
+
+    return [
+        ChainResult(
+            scoring.perm_to_key(perms[n]), samples[:ends[n], n], float(scores[n]), int(stopped_at[n]), report,
+            scoring.perm_to_key(best_perms[n]), float(best_scores[n])
+        )
+        for n in range(n_chains)
+    ]
+
+
+def parallel_tempering(encoded_text, rng, iters=50000, temperatures=(1, 1.5, 2.25, 3.4, 5),
+                       swap_interval=10, log_probs=None, observers=(), history=None):
+    """
+    Replica-exchange version of mcmc. A ladder of chains samples the score raised to 1 / T for
+    each temperature T, and every swap_interval iterations neighbouring rungs propose to exchange
+    their ciphers. Hot rungs move freely between local optima and hand good ciphers down to the
+    cold rung (T = 1), which samples the same target as mcmc.
+    ----------
+    params:
+        encoded_text (str): Passed encrypted text, or its statistics (see streaming.py)
+        rng (generator): Seeded random number generator
+        iters (int): Number of MCMC iterations, default 50,000
+        temperatures (iterable): Increasing temperature ladder, the first rung should be 1
+        swap_interval (int): Number of iterations between exchange moves, default 10
+        log_probs (np.ndarray): Log transition probabilities of the reference text (of any
+                                order), loaded from the default compiled model if not given
+        observers (iterable): Observers from observers.py notified of the progress of the cold
+                              rung, default none
+        history (recording.History): Recorder for the scores of the cold rung, default keeps
+                                     every score in memory
     returns:
-    position (np.array)
-        Final position (i.e., decryption cipher) generated by Hamiltonian Monte Carlo
+        TemperingResult: Cipher, history and score of the cold rung, the best cipher seen on any
+                         rung, the temperatures, the acceptance rate of every rung and the swap
+                         rate of every pair of neighbouring rungs
     """
-    # Get the character frequencies
-    freqDict = utils.loadFreqDict()
-
-    # Initialize autograd
-    dVdq = grad(potential)
-
-    # Initialize momementum sampler
-    momentum = st.norm(0,1)
-
-    # Initial position is 26d vector? Fill in comments later
-    size = (n_samples, ) + position.shape[:1]
-
-    for p0 in momentum.rvs(size=size):
-        # Integrate over path to generate new position and momentum
-        q_new, p_new = leapfrog(
-            position,
-            p0,
-            dVdq,
-            path_len,
-            step_size
+    # Reduce the encrypted text and the reference text to their n-gram statistics once
+    if log_probs is None:
+        log_probs = model.load_model().log_probs
+    counts = scoring.text_statistics(encoded_text, log_probs.ndim)
+
+    temperatures = np.asarray(temperatures, dtype=float)
+    n_rungs = len(temperatures)
+    rungs = np.arange(n_rungs)
+
+    # Random initial decryption ciphers, the space class always maps to itself
+    perms = np.empty((n_rungs, scoring.N_CLASSES), dtype=int)
+    perms[:, :26] = np.argsort(rng.random((n_rungs, 26)), axis=1)
+    perms[:, 26] = scoring.SPACE
+    scores = scoring.score_perms(perms, counts, log_probs)
+
+    best = int(np.argmax(scores))
+    best_perm, best_score = perms[best].copy(), float(scores[best])
+
+    # Acceptance and exchange counters
+    accepted = np.zeros(n_rungs, dtype=int)
+    swaps_tried = np.zeros(max(n_rungs - 1, 0), dtype=int)
+    swaps_accepted = np.zeros(max(n_rungs - 1, 0), dtype=int)
+
+    # Recorder to store the scores of the cold rung
+    if history is None:
+        history = recording.History(iters)
+
+    # Swaps and acceptance uniforms are drawn in blocks
+    proposals = prop.SwapProposals(rng)
+
+    # Observers are only notified when they are due
+    watch = obs.Dispatcher(observers, iters)
+
+    for it in range(iters):
+        # Metropolis-Hastings step on every rung at its own temperature
+        first, second, log_u = proposals.take(n_rungs)
+        delta = scoring.delta_scores(perms, first, second, counts, log_probs)
+        accept = rungs[log_u <= delta / temperatures]
+
+        a, b = first[accept], second[accept]
+        perms[accept, a], perms[accept, b] = perms[accept, b], perms[accept, a]
+        scores[accept] += delta[accept]
+        accepted[accept] += 1
+
+        # Exchange moves between neighbouring rungs, alternating even and odd pairs
+        if n_rungs > 1 and (it+1) % swap_interval == 0:
+            lower = np.arange((it // swap_interval) % 2, n_rungs - 1, 2)
+            upper = lower + 1
+            log_ratio = (1 / temperatures[lower] - 1 / temperatures[upper]) * (scores[upper] - scores[lower])
+            exchange = rng.random(len(lower)) < np.exp(np.minimum(log_ratio, 0))
+            swaps_tried[lower] += 1
+            swaps_accepted[lower[exchange]] += 1
+
+            lo, hi = lower[exchange], upper[exchange]
+            perms[lo], perms[hi] = perms[hi], perms[lo]
+            scores[lo], scores[hi] = scores[hi], scores[lo]
+
+        # Keep track of the best decryption cipher on any rung
+        top = int(np.argmax(scores))
+        if scores[top] > best_score:
+            best_perm, best_score = perms[top].copy(), float(scores[top])
+
+        history.record(it+1, scores[0])
+        if it+1 == watch.next:
+            watch.notify(obs.Event(it+1, iters, perms[0], scores[0], accepted[0]))
+
+    watch.finish(obs.Event(iters, iters, perms[0], scores[0], accepted[0]))
+    history.close()
+    return TemperingResult(
+        scoring.perm_to_key(perms[0]), history.array, float(scores[0]),
+        scoring.perm_to_key(best_perm), best_score, temperatures,
+        accepted / max(iters, 1), swaps_accepted / np.maximum(swaps_tried, 1)
+    )
+
+
+def hamiltonian_monte_carlo(decrypt_key, encoded_text, rng, iters=1000, log_probs=None, stop=None,
+                            history=None, path_len=1.0, step_size=0.1, temperature=0.003, tau=1.0,
+                            sinkhorn_iters=20, prior_scale=10.0, warmup=100, target_accept=0.65):
+    """
+    Function that uses Hamiltonian Monte Carlo to sample relaxed decryption ciphers (see
+    relaxation.py). Every iteration draws a Gaussian momentum, integrates the Hamiltonian
+    dynamics of the relaxed cipher with leapfrog steps and accepts the end point with the
+    Metropolis-Hastings criterion. The position is rounded to the closest decryption cipher
+    after every iteration, and its exact score is what gets recorded.
+    ----------
+    params:
+        decrypt_key (str): String representation of the initial decryption cipher
+        encoded_text (str): Passed encrypted text, or its statistics (see streaming.py)
+        rng (generator): Seeded random number generator
+        iters (int): Number of trajectories, default 1,000
+        log_probs (np.ndarray): Log transition probabilities of the reference text (bigram
+                                models only), loaded from the default compiled model if not given
+        stop (list): Stopping criteria from stopping.py, updated with the rounded cipher
+        history (recording.History): Recorder for the scores of the rounded ciphers
+        path_len (float): Length of each integration path. Smaller is faster and more
+                          correlated, default 1
+        step_size (float): Initial size of each integration step, adapted during warmup towards
+                           target_accept. Smaller is slower and more accurate, default 0.1
+        temperature (float): Temperature of the relaxed target, default 0.003
+        tau (float): Temperature of the Sinkhorn relaxation, default 1
+        sinkhorn_iters (int): Number of Sinkhorn iterations, default 20
+        prior_scale (float): Standard deviation of the Gaussian prior on the position, default 10
+        warmup (int): Number of trajectories during which the step size is adapted, default 100
+        target_accept (float): Acceptance rate the step size is adapted to, default 0.65
+    returns:
+        ChainResult (key, history, score, iterations, report, best_key, best_score): Rounded
+            decryption cipher of the final position, the array of recorded scores, its score,
+            the number of trajectories run, a report (acceptance rate, number of gradient
+            evaluations, final step size and wall time) and the best rounded decryption cipher
+            seen during the run with its score
+    """
+    # Reduce the encrypted text and the reference text to their bigram statistics once
+    if log_probs is None:
+        log_probs = model.load_model().log_probs
+    counts = scoring.text_statistics(encoded_text, log_probs.ndim)
+    potential = relaxation.SinkhornPotential(
+        counts, log_probs, temperature, tau, sinkhorn_iters, prior_scale
+    )
+
+    # Recorder to store the scores
+    if history is None:
+        history = recording.History(iters)
+
+    # The initial cipher is a weak preference on top of a nearly uniform relaxed cipher
+    position = utils.toPosition(decrypt_key, scale=0.1)
+    energy, grad = potential(position)
+
+    key = utils.toDecryptKey(position)
+    score = scoring.score_perm(scoring.key_to_perm(key), counts, log_probs)
+    best_key, best_score = key, score
+
+    started = perf_counter_ns()
+    accepted, evaluations = 0, 0
+    for i in range(iters):
+        # Draw a momentum and integrate over the path to generate a new position
+        momentum = rng.standard_normal(position.shape)
+        n_steps = max(int(round(path_len / step_size)), 1)
+        q_new, p_new, energy_new, grad_new = leapfrog(
+            position, momentum, potential, n_steps, step_size, grad
         )
+        evaluations += n_steps
 
-        # Calculate log likelihood of current position and proposed position
-        curr_log_p = 0  # TODO
-        new_log_p = 0   # TODO
+        # Apply the Metropolis-Hastings criterion to the change of the total energy
+        log_accept = energy + np.sum(momentum ** 2) / 2 - energy_new - np.sum(p_new ** 2) / 2
+        if not np.isfinite(log_accept):
+            log_accept = -np.inf
+        acceptProposal = np.log(rng.random()) < log_accept
+        if acceptProposal:
+            position, energy, grad = q_new, energy_new, grad_new
+            accepted += 1
+
+        # Adapt the step size towards the target acceptance rate during warmup
+        if i < warmup:
+            step_size *= np.exp(0.05 * (np.exp(min(log_accept, 0.0)) - target_accept))
+
+        # Round the relaxed cipher and keep the best decryption cipher
+        changed = False
+        if acceptProposal:
+            rounded = utils.toDecryptKey(position)
+            changed = rounded != key
+            if changed:
+                key = rounded
+                score = scoring.score_perm(scoring.key_to_perm(key), counts, log_probs)
+                if score > best_score:
+                    best_key, best_score = key, score
 
-        # Apply Metroplis Hastings acceptance criterion
-        if np.log(rng.rand()) < curr_log_p - new_log_p:
-            position = q_new
+        history.record(i+1, score)
 
+        # Stop early once a stopping criterion fires
+        if stop and stopping.check(stop, i+1, score, changed):
+            break
 
-    # Return the final position (decryption cipher)
-    return position
-        
+    iterations = i+1 if iters else 0
+    report = {
+        'proposals': iterations,
+        'accepted': accepted,
+        'acceptance_rate': accepted / iterations if iterations else 0.0,
+        'gradient_evaluations': evaluations,
+        'step_size': float(step_size),
+        'wall_time': (perf_counter_ns() - started) / 1e9,
+    }
 
-def leapfrog(q, p, dVdq, path_len, step_size):
+    history.close()
+    return ChainResult(key, history.array, score, iterations, report, best_key, best_score)
+
+
+def leapfrog(q, p, potential, n_steps, step_size, grad=None):
     """
     Helper function for Hamiltonian Monte Carlo that uses leapfrog integration to numerically integrate
-    differential equations. To avoid the accumulation of systematic errors, update the momentum using
-    a half step, then the position at a full step. Finish updating p with another half step. 
-    The loop you can perform steps normally (investigate further). Finally, flip the momentum so that our process
-    has a non-zero, symmetric, probability of moving back to some initial distribution.
+    the Hamiltonian dynamics. To avoid the accumulation of systematic errors, the momentum is updated
+    with a half step, then the position and momentum with full steps, and the momentum with a final
+    half step. Finally, flip the momentum so that the proposal is its own inverse and the
+    Metropolis-Hastings criterion needs no correction.
     ----------
     params:
-        q (np.float64): initial position
-        p (np.float64): initial momentum
-        dVdq (callable): gradient of the velocity
-        path_len (float): how long to integrate for
+        q (np.ndarray): initial position
+        p (np.ndarray): initial momentum
+        potential (callable): returns the potential energy of a position and its gradient
+        n_steps (int): number of integration steps
         step_size (float): how long each integration step should be
+        grad (np.ndarray): gradient of the potential at q, computed if not given
 
     returns:
-        q, p (np.float64, np.float64): updated position and momentum
+        q, p, energy, grad (np.ndarray, np.ndarray, float, np.ndarray): updated position and
+            momentum, and the potential energy and its gradient at the new position
     """
-    # Create shallow copies of the values q and p
-    q = np.copy(q)
-    p = np.copy(p)
-
-    # Calculate velocity
-    velocity = dVdq(q)
-
-    # Take step in direction of the gradient of the velocity * step_size
-    for _ in range(int(path_len / step_size) - 1):
-        p -= step_size * velocity / 2   # half step
-        q += step_size * p              # whole step
-        velocity = dVdq(q)              # recalculate velocity
-        p -= step_size * velocity / 2   # half step
-
-    # Momentum flip
-    return q, -p
\ No newline at end of file
+    if grad is None:
+        _, grad = potential(q)
+
+    # Half step of the momentum, then alternating full steps
+    p = p - step_size * grad / 2
+    for n in range(n_steps):
+        q = q + step_size * p
+        energy, grad = potential(q)
+        if n < n_steps - 1:
+            p = p - step_size * grad
+
+    # Final half step of the momentum, and momentum flip
+    p = p - step_size * grad / 2
+    return q, -p, energy, grad
+
+
+def mcmc_transposition(encoded_text, n_columns, rng, iters=50000, log_probs=None, substitution=True,
+                       decrypt_key=None, order=None, stop=None, history=None, schedule=None,
+                       weights=(1, 1, 1)):
+    """
+    Function that uses the Metropolis-Hastings algorithm to decipher a columnar transposition
+    cipher, or a substitution-transposition cipher (see transposition.py). Iterations rearrange
+    the columns of the grid with a swap, reversal or slide, and in the substitution-transposition
+    mode alternate with swaps of two letters of the substitution. Both moves are scored against
+    the same bigram counts, which rearrangements update column boundary by column boundary.
+    ----------
+    params:
+        encoded_text (str): Passed encrypted text
+        n_columns (int): Number of columns of the transposition
+        rng (generator): Seeded random number generator
+        iters (int): Number of MCMC iterations, default 50,000
+        log_probs (np.ndarray): Log transition probabilities of the reference text (bigram
+                                models only), loaded from the default compiled model if not given
+        substitution (bool): Also search for a substitution cipher, default True. Otherwise the
+                             text is only transposed
+        decrypt_key (str): Initial decryption cipher of the substitution, default a random one
+                           (the identity without substitution)
+        order (array-like): Initial transposition key, default a random one
+        stop (list): Stopping criteria from stopping.py, the run ends as soon as one fires
+        history (recording.History): Recorder for the scores, default keeps every score in memory
+        schedule (annealing.Schedule): Cooling schedule that turns the run into simulated
+                                       annealing, default None (temperature 1)
+        weights (tuple): Relative frequencies of column swaps, reversals and slides, default
+                         (1, 1, 1)
+    returns:
+        TranspositionResult (key, order, history, score, iterations, report, best_key, best_order,
+            best_score): Decryption cipher of the substitution and transposition key sampled from
+            MCMC, the array of recorded scores, the final score, the number of iterations run,
+            a report (proposals and acceptance rate of every kind of move and wall time) and the
+            best decryption cipher and transposition key seen during the run with their score
+    """
+    if not isinstance(encoded_text, str):
+        raise ValueError('Transposition ciphers need the encrypted text, not its statistics')
+
+    # Reduce the reference text to its bigram statistics once
+    if log_probs is None:
+        log_probs = model.load_model().log_probs
+
+    # Initial transposition and substitution
+    if order is None:
+        order = rng.permutation(n_columns)
+    if decrypt_key is None:
+        decrypt_key = scoring.perm_to_key(rng.permutation(26)) if substitution else scoring.ALPHABET
+
+    # Chain state caches the bigram counts of the decrypted text and its score
+    state = tp.TranspositionState(
+        scoring.text_to_classes(encoded_text), np.argsort(order), scoring.key_to_perm(decrypt_key),
+        log_probs
+    )
+
+    # Recorder to store the scores
+    if history is None:
+        history = recording.History(iters)
+
+    # Column rearrangements, and letter swaps in the substitution-transposition mode
+    columns = tp.TranspositionProposals(rng, n_columns, weights)
+    swaps = prop.SwapProposals(rng) if substitution else None
+    kinds = columns.KINDS + ('substitution',)
+    proposed, accepted = dict.fromkeys(kinds, 0), dict.fromkeys(kinds, 0)
+
+    # Best decryption seen so far
+    best_perm, best_layout, best_score = state.perm.copy(), state.layout, state.score
+
+    annealing = schedule is not None
+    if annealing:
+        schedule.start(iters)
+
+    started = perf_counter_ns()
+    for i in range(iters):
+        # Alternate the two kinds of moves, with log(u) for a uniform u in [0,1)
+        if substitution and i % 2 == 0:
+            kind = 'substitution'
+            first, second, log_u = swaps.draw()
+            delta = scoring.delta_score(state, first, second)
+        else:
+            kind, index, log_u = columns.draw()
+            delta, change = state.delta_rearrange(index)
+        proposed[kind] += 1
+
+        # Same acceptance test as mcmc
+        if annealing:
+            acceptProposal = log_u * schedule.temperature(i+1, sum(accepted.values())) <= delta
+        else:
+            acceptProposal = log_u <= delta
+
+        if acceptProposal:
+            if kind == 'substitution':
+                state.swap(first, second, delta)
+            else:
+                state.rearrange(change, delta)
+            accepted[kind] += 1
+
+            # Keep the best decryption
+            if state.score > best_score:
+                best_perm, best_layout, best_score = state.perm.copy(), state.layout, state.score
+
+        history.record(i+1, state.score)
+
+        # Stop early once a stopping criterion fires
+        if stop and stopping.check(stop, i+1, state.score, acceptProposal):
+            break
+
+    iterations = i+1 if iters else 0
+    report = {
+        'proposals': proposed,
+        'accepted': accepted,
+        'acceptance_rates': {kind: accepted[kind] / max(proposed[kind], 1) for kind in kinds},
+        'wall_time': (perf_counter_ns() - started) / 1e9,
+    }
+
+    history.close()
+    return TranspositionResult(
+        state.key, tuple(state.order.tolist()), history.array, state.score, iterations, report,
+        scoring.perm_to_key(best_perm), tuple(np.argsort(best_layout).tolist()), best_score
+    )
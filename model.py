@@ -0,0 +1,310 @@
+"""
+File containing the compiled language model format used during MCMC.
+
+A compiled model is a directory with a versioned JSON header and .npy arrays:
+    header.json     format name, version, order, storage, smoothing and dtype of the model
+    counts.npy      raw n-gram counts of the reference text
+    log_probs.npy   smoothed log transition probabilities, ready to be used for scoring
+
+Models up to order DENSE_MAX_ORDER store dense arrays with one axis of 27 classes per character.
+Higher orders use sparse storage: the arrays only hold the n-grams seen in the reference text,
+keyed by the sorted codes in codes.npy (see scoring.encode_ngrams), together with the penalty of
+unseen n-grams for every seen context in context_codes.npy and unseen_log_probs.npy.
+
+The arrays are memory-mapped when loaded, so startup is near-instant and every worker process
+shares one page-cached copy of the model.
+"""
+import json
+import os
+import pickle
+
+import numpy as np
+
+import scoring
+
+
+# Name and version written to the header of every compiled model
+MODEL_FORMAT = 'mcmc-decipher-model'
+MODEL_VERSION = 1
+
+# Default location of the compiled model, can be overridden with the MCMC_DECIPHER_MODEL
+# environment variable
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'bigram.model')
+
+# Every file of a compiled model, the sparse arrays only exist in sparse models
+MODEL_FILES = ('header.json', 'counts.npy', 'log_probs.npy', 'codes.npy', 'context_codes.npy',
+               'unseen_log_probs.npy')
+
+# Highest order stored as dense 27**n arrays
+DENSE_MAX_ORDER = 4
+
+
+class SparseCounts:
+    """
+    n-gram counts of a reference text stored as sorted n-gram codes and their counts
+    ----------
+    params:
+        order (int): Length of the n-grams
+        codes (np.ndarray): Sorted int64 codes of the seen n-grams
+        counts (np.ndarray): Number of occurrences of each n-gram
+    """
+    def __init__(self, order, codes, counts):
+        self.order = order
+        self.codes = codes
+        self.counts = counts
+
+    @property
+    def ndim(self):
+        """Length of the n-grams, mirrors the number of axes of dense counts"""
+        return self.order
+
+    def __add__(self, other):
+        codes, inverse = np.unique(np.concatenate((self.codes, other.codes)), return_inverse=True)
+        counts = np.zeros(len(codes), dtype=np.int64)
+        np.add.at(counts, inverse, np.concatenate((self.counts, other.counts)))
+        return SparseCounts(self.order, codes, counts)
+
+
+class SparseLogProbs:
+    """
+    Sparse table of log transition probabilities for high order models
+    ----------
+    params:
+        order (int): Length of the n-grams
+        codes (np.ndarray): Sorted int64 codes of the seen n-grams
+        log_probs (np.ndarray): Smoothed log probability of each seen n-gram
+        context_codes (np.ndarray): Sorted codes of the seen (n-1)-gram contexts
+        unseen_log_probs (np.ndarray): Log probability of an unseen n-gram in each context
+    """
+    def __init__(self, order, codes, log_probs, context_codes, unseen_log_probs):
+        self.order = order
+        self.codes = codes
+        self.log_probs = log_probs
+        self.context_codes = context_codes
+        self.unseen_log_probs = unseen_log_probs
+
+    @property
+    def ndim(self):
+        """Length of the n-grams, mirrors the number of axes of dense log probabilities"""
+        return self.order
+
+    def lookup(self, grams):
+        """
+        Looks up the log probability of n-grams
+        ----------
+        params:
+            grams (np.ndarray): Array of class indices whose last axis runs over the n-gram
+        returns:
+            log_probs (np.ndarray): log P of the last character given the others
+        """
+        codes = scoring.encode_ngrams(grams)
+
+        idx = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+        seen = self.codes[idx] == codes
+
+        # Unseen n-grams get the smoothed penalty of their context, or a uniform
+        # probability if the context was never seen either
+        contexts = codes // scoring.N_CLASSES
+        cidx = np.minimum(np.searchsorted(self.context_codes, contexts), len(self.context_codes) - 1)
+        unseen = np.where(
+            self.context_codes[cidx] == contexts,
+            self.unseen_log_probs[cidx],
+            -np.log(scoring.N_CLASSES)
+        )
+
+        return np.where(seen, self.log_probs[idx], unseen)
+
+
+def sparse_log_probs(counts, smoothing=1.0):
+    """
+    Sparse version of scoring.log_probs_from_counts
+    ----------
+    params:
+        counts (SparseCounts): n-gram counts of the reference text
+        smoothing (float): Pseudo-count added to every n-gram, default 1
+    returns:
+        log_probs (SparseLogProbs): Smoothed log transition probabilities
+    """
+    context_codes, inverse = np.unique(counts.codes // scoring.N_CLASSES, return_inverse=True)
+    totals = np.bincount(inverse, weights=counts.counts, minlength=len(context_codes))
+    log_totals = np.log(totals + smoothing * scoring.N_CLASSES)
+
+    return SparseLogProbs(
+        counts.order,
+        counts.codes,
+        np.log(counts.counts + smoothing) - log_totals[inverse],
+        context_codes,
+        np.log(smoothing) - log_totals
+    )
+
+
+class LanguageModel:
+    """
+    Loaded language model
+    ----------
+    params:
+        path (str): Directory of the compiled model
+        header (dict): Contents of the model header
+        log_probs (np.ndarray or SparseLogProbs): Smoothed log transition probabilities
+    """
+    def __init__(self, path, header, log_probs):
+        self.path = path
+        self.header = header
+        self.log_probs = log_probs
+
+    @property
+    def order(self):
+        """Length of the n-grams in the model"""
+        return self.header['order']
+
+    @property
+    def counts(self):
+        """Raw n-gram counts of the reference text (memory-mapped, read on first access)"""
+        counts = np.load(os.path.join(self.path, 'counts.npy'), mmap_mode='r')
+        if self.header.get('storage', 'dense') == 'sparse':
+            codes = np.load(os.path.join(self.path, 'codes.npy'), mmap_mode='r')
+            return SparseCounts(self.order, codes, counts)
+        return counts
+
+    @property
+    def letter_counts(self):
+        """Number of n-grams of the reference text starting with each character class"""
+        counts = self.counts
+        if isinstance(counts, SparseCounts):
+            first = counts.codes // scoring.N_CLASSES ** (self.order - 1)
+            return np.bincount(first, weights=counts.counts, minlength=scoring.N_CLASSES)
+        return np.asarray(counts, dtype=float).reshape(scoring.N_CLASSES, -1).sum(axis=1)
+
+
+def _atomic_save(path, array):
+    """
+    Writes an array to a .npy file through a temporary file so readers never see a partial file
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp, path)
+
+
+def save_model(path, counts, smoothing=1.0, dtype='float64', source=None):
+    """
+    Compiles n-gram counts of a reference text into a model directory
+    ----------
+    params:
+        path (str): Directory to write the model to, created if it does not exist
+        counts (np.ndarray or SparseCounts): n-gram counts of the reference text, dense arrays
+                                             have one axis per character of the n-gram
+        smoothing (float): Pseudo-count added to every n-gram, default 1
+        dtype (str): Floating point type of the stored log probabilities, default float64
+        source (list): Optional description of the texts the counts were built from
+    returns:
+        header (dict): Contents of the written model header
+    """
+    os.makedirs(path, exist_ok=True)
+    sparse = isinstance(counts, SparseCounts)
+    if not sparse:
+        counts = np.asarray(counts, dtype=np.int64)
+
+    header = {
+        'format': MODEL_FORMAT,
+        'version': MODEL_VERSION,
+        'order': counts.ndim,
+        'storage': 'sparse' if sparse else 'dense',
+        'alphabet': scoring.ALPHABET + ' ',
+        'smoothing': smoothing,
+        'dtype': np.dtype(dtype).name,
+        'total': int(counts.counts.sum() if sparse else counts.sum()),
+        'source': source or [],
+    }
+
+    if sparse:
+        log_probs = sparse_log_probs(counts, smoothing)
+        _atomic_save(os.path.join(path, 'codes.npy'), counts.codes)
+        _atomic_save(os.path.join(path, 'counts.npy'), counts.counts)
+        _atomic_save(os.path.join(path, 'log_probs.npy'), log_probs.log_probs.astype(dtype))
+        _atomic_save(os.path.join(path, 'context_codes.npy'), log_probs.context_codes)
+        _atomic_save(os.path.join(path, 'unseen_log_probs.npy'), log_probs.unseen_log_probs.astype(dtype))
+    else:
+        _atomic_save(os.path.join(path, 'counts.npy'), counts)
+        _atomic_save(
+            os.path.join(path, 'log_probs.npy'),
+            scoring.log_probs_from_counts(counts, smoothing).astype(dtype)
+        )
+
+    # The header is written last, a model without a header is incomplete
+    tmp = os.path.join(path, 'header.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(header, f, indent=4)
+    os.replace(tmp, os.path.join(path, 'header.json'))
+
+    return header
+
+
+def load_model(path=None, mmap=True):
+    """
+    Loads a compiled language model
+    ----------
+    params:
+        path (str): Directory of the compiled model, defaults to $MCMC_DECIPHER_MODEL or
+                    data/bigram.model
+        mmap (bool): Memory-map the arrays instead of reading them, default True
+    returns:
+        model (LanguageModel): The loaded model
+    """
+    if path is None:
+        path = os.environ.get('MCMC_DECIPHER_MODEL', DEFAULT_MODEL_PATH)
+
+    with open(os.path.join(path, 'header.json')) as f:
+        header = json.load(f)
+
+    if header.get('format') != MODEL_FORMAT:
+        raise ValueError(f'{path} is not a compiled language model')
+    if header.get('version') != MODEL_VERSION:
+        raise ValueError(
+            f'{path} has model format version {header.get("version")}, expected {MODEL_VERSION}'
+        )
+
+    def load(name):
+        # Plain ndarray views of the memory maps, np.memmap indexing is much slower
+        return np.asarray(np.load(os.path.join(path, name), mmap_mode='r' if mmap else None))
+
+    log_probs = load('log_probs.npy')
+
+    if header.get('storage', 'dense') == 'sparse':
+        log_probs = SparseLogProbs(
+            header['order'], load('codes.npy'), log_probs, load('context_codes.npy'), load('unseen_log_probs.npy')
+        )
+
+    return LanguageModel(path, header, log_probs)
+
+
+def convert_pickle(pickle_path, path, smoothing=1.0, dtype='float64'):
+    """
+    Builds a compiled model from a pickled frequency dictionary (e.g. data/freq_dict.pkl)
+    ----------
+    params:
+        pickle_path (str): Path to the pickled frequency dictionary
+        path (str): Directory to write the model to
+        smoothing (float): Pseudo-count added to every bigram, default 1
+        dtype (str): Floating point type of the stored log probabilities, default float64
+    returns:
+        header (dict): Contents of the written model header
+    """
+    with open(pickle_path, 'rb') as f:
+        freq_dict = pickle.load(f)
+
+    counts = scoring.freq_dict_counts(freq_dict)
+    return save_model(path, counts, smoothing, dtype, source=[os.path.basename(pickle_path)])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compile a pickled frequency dictionary into a language model')
+    parser.add_argument('pickle', nargs='?', default=os.path.join(os.path.dirname(DEFAULT_MODEL_PATH), 'freq_dict.pkl'))
+    parser.add_argument('output', nargs='?', default=DEFAULT_MODEL_PATH)
+    parser.add_argument('--smoothing', type=float, default=1.0)
+    parser.add_argument('--dtype', choices=['float32', 'float64'], default='float64')
+    args = parser.parse_args()
+
+    convert_pickle(args.pickle, args.output, args.smoothing, args.dtype)
@@ -0,0 +1,197 @@
+"""
+File containing the observers that report on the progress of MCMC runs.
+
+Samplers notify their observers every `every` iterations (and on the first one) with an Event that
+holds the state they already computed, so observing a run never rescores a decryption cipher.
+Without observers the samplers stay silent and only pay for a single integer comparison per
+iteration.
+"""
+import json
+import sys
+import time
+
+import numpy as np
+
+import scoring
+import utils
+
+
+class Event:
+    """
+    State of a sampler at a given iteration. For ensembles, perm, score and accepted hold one
+    entry per chain.
+    ----------
+    params:
+        iteration (int): Number of iterations run so far
+        iters (int): Maximum number of iterations of the run
+        perm (np.ndarray): Permutation representation of the current decryption cipher(s)
+        score (float or np.ndarray): Current score(s)
+        accepted (int or np.ndarray): Number of accepted proposals so far
+        elapsed (float): Seconds since the start of the run
+    """
+    __slots__ = ('iteration', 'iters', 'perm', 'score', 'accepted', 'elapsed')
+
+    def __init__(self, iteration, iters, perm, score, accepted, elapsed=0.0):
+        self.iteration = iteration
+        self.iters = iters
+        self.perm = perm
+        self.score = score
+        self.accepted = accepted
+        self.elapsed = elapsed
+
+    @property
+    def key(self):
+        """String representation of the current decryption cipher (a list for ensembles)"""
+        if np.ndim(self.perm) == 2:
+            return [scoring.perm_to_key(perm) for perm in self.perm]
+        return scoring.perm_to_key(self.perm)
+
+    @property
+    def best_score(self):
+        """Current score, or the best current score of an ensemble"""
+        return float(np.max(self.score))
+
+    @property
+    def acceptance_rate(self):
+        """Fraction of proposals accepted so far (averaged over the chains of an ensemble)"""
+        return float(np.mean(self.accepted)) / max(self.iteration, 1)
+
+    @property
+    def iterations_per_second(self):
+        """Average number of iterations per second since the start of the run"""
+        return self.iteration / self.elapsed if self.elapsed > 0 else float('inf')
+
+
+class Observer:
+    """
+    Base class of the observers, notified every `every` iterations. Does nothing by default.
+    ----------
+    params:
+        every (int): Number of iterations between two notifications, default 500
+    """
+    def __init__(self, every=500):
+        self.every = every
+
+    def notify(self, event):
+        """Called with the current Event every `every` iterations and on the first one"""
+
+    def finish(self, event):
+        """Called once with the final Event when the run ends"""
+
+
+class ProgressMeter(Observer):
+    """
+    Quiet single-line progress meter
+    ----------
+    params:
+        stream (file): Stream to write to, default sys.stderr
+        every (int): Number of iterations between two updates (keyword only), default 500
+        width (int): Width of the progress bar in characters (keyword only), default 30
+    """
+    def __init__(self, stream=None, *, every=500, width=30):
+        super().__init__(every)
+        self.stream = stream
+        self.width = width
+
+    def notify(self, event):
+        stream = self.stream or sys.stderr
+        filled = int(self.width * event.iteration / max(event.iters, 1))
+        stream.write(
+            f'\r[{"#" * filled}{" " * (self.width - filled)}] {event.iteration}/{event.iters} '
+            f'score {event.best_score:.2f}, {event.iterations_per_second:.0f} it/s'
+        )
+        stream.flush()
+
+    def finish(self, event):
+        self.notify(event)
+        (self.stream or sys.stderr).write('\n')
+
+
+class JsonLinesMetrics(Observer):
+    """
+    Emits one JSON object per notification with the iteration, score, acceptance rate and
+    iterations per second of the run
+    ----------
+    params:
+        stream (file): Stream to write to, default sys.stdout
+        every (int): Number of iterations between two lines (keyword only), default 500
+    """
+    def __init__(self, stream=None, *, every=500):
+        super().__init__(every)
+        self.stream = stream
+        self._last = None
+
+    def notify(self, event):
+        self._last = event.iteration
+        stream = self.stream or sys.stdout
+        stream.write(json.dumps({
+            'iteration': event.iteration,
+            'score': event.best_score,
+            'acceptance_rate': event.acceptance_rate,
+            'iterations_per_second': event.iterations_per_second,
+        }) + '\n')
+
+    def finish(self, event):
+        if event.iteration != self._last:
+            self.notify(event)
+        (self.stream or sys.stdout).flush()
+
+
+class TextPrinter(Observer):
+    """
+    Prints the score and the decrypted text, like mcmc used to do every 500 iterations
+    ----------
+    params:
+        encoded_text (str): Encrypted text being deciphered
+        every (int): Number of iterations between two prints, default 500
+    """
+    def __init__(self, encoded_text, every=500):
+        super().__init__(every)
+        self.encoded_text = encoded_text
+
+    def notify(self, event):
+        if np.ndim(event.perm) == 2:
+            best = int(np.argmax(event.score))
+            key, score = scoring.perm_to_key(event.perm[best]), float(event.score[best])
+        else:
+            key, score = event.key, float(event.score)
+
+        decode = utils.applyKey(key, self.encoded_text)
+        print(f'Iteration {event.iteration:>5} -> Score: {score:.2f}\n')
+        print(f'Decrypted text:\n{decode}\n')
+
+
+class Dispatcher:
+    """
+    Notifies a group of observers at their cadence. Samplers compare the iteration with `next`
+    and only build an Event when it is due.
+    ----------
+    params:
+        observers (iterable): Observers to notify
+        iters (int): Maximum number of iterations of the run
+    """
+    def __init__(self, observers, iters):
+        self.observers = list(observers)
+        self.iters = iters
+        self.next = 1 if self.observers else -1
+        self._start = time.perf_counter()
+
+    def notify(self, event):
+        """Notifies the observers that are due and schedules the next notification"""
+        event.elapsed = time.perf_counter() - self._start
+        for observer in self.observers:
+            if event.iteration == 1 or event.iteration % observer.every == 0:
+                observer.notify(event)
+
+        self.next = min((event.iteration // o.every + 1) * o.every for o in self.observers)
+
+    def resume(self, iteration):
+        """Schedules the next notification after an iteration, for runs resumed from a checkpoint"""
+        if self.observers:
+            self.next = min((iteration // o.every + 1) * o.every for o in self.observers)
+
+    def finish(self, event):
+        """Gives every observer the final state of the run"""
+        event.elapsed = time.perf_counter() - self._start
+        for observer in self.observers:
+            observer.finish(event)
@@ -0,0 +1,200 @@
+"""
+File containing the proposal generators used by the samplers.
+
+Drawing two positions and one uniform per iteration through separate Generator calls costs more
+than the arithmetic of a swap, so proposals are drawn in large vectorized blocks and consumed from
+a buffer. Swap positions and acceptance uniforms come from two independent streams spawned from the
+sampler's generator, which makes the sequence of proposals the same for every block size.
+
+RankedSwapProposals favours swapping letters of similar frequency in the encrypted text. Their
+decryptions are far more often mistaken for each other than letters of very different frequency,
+so fewer proposals are wasted on swaps that are certain to be rejected.
+"""
+import numpy as np
+
+
+class SwapProposals:
+    """
+    Buffered source of uniformly random swaps of two distinct positions of a cipher, each paired
+    with log(u) for a uniform u used in the acceptance test
+    ----------
+    params:
+        rng (generator): Seeded random number generator the proposal streams are spawned from
+        block_size (int): Number of proposals drawn at once, default 4096
+        n_positions (int): Number of positions of the cipher, default 26
+    """
+    def __init__(self, rng, block_size=4096, n_positions=26):
+        self.block_size = block_size
+        self.n_positions = n_positions
+
+        # Independent streams for the positions and the uniforms
+        pair_seed, uniform_seed = np.random.SeedSequence(rng.integers(0, 2**63, size=4)).spawn(2)
+        self._pair_rng = np.random.default_rng(pair_seed)
+        self._uniform_rng = np.random.default_rng(uniform_seed)
+
+        self._block = (np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0))
+        self._first = self._second = self._log_u = []
+        self._pos = 0
+
+    def _draw_pairs(self, size):
+        """
+        Draws size pairs of distinct positions, returns them as two arrays
+        """
+        pairs = self._pair_rng.integers(0, (self.n_positions, self.n_positions - 1), size=(size, 2))
+        first, second = pairs[:, 0], pairs[:, 1]
+        second += second >= first
+        return first, second
+
+    def _refill(self):
+        """
+        Draws the next block of proposals into the buffer
+        """
+        first, second = self._draw_pairs(self.block_size)
+        log_u = np.log1p(-self._uniform_rng.random(self.block_size))
+        self._block = (first, second, log_u)
+
+        # Python lists make indexing single proposals cheap
+        self._first, self._second, self._log_u = first.tolist(), second.tolist(), log_u.tolist()
+        self._pos = 0
+
+    def draw(self):
+        """
+        Takes the next proposal from the buffer
+        ----------
+        returns:
+            (int, int, float): The two positions to swap and log(u) for the acceptance test
+        """
+        if self._pos == len(self._first):
+            self._refill()
+        k = self._pos
+        self._pos += 1
+        return self._first[k], self._second[k], self._log_u[k]
+
+    def take(self, n):
+        """
+        Takes the next n proposals from the buffer, e.g. one per chain of an ensemble
+        ----------
+        params:
+            n (int): Number of proposals
+        returns:
+            (np.ndarray, np.ndarray, np.ndarray): Positions to swap and log(u) of every proposal
+        """
+        parts = []
+        while n > 0:
+            if self._pos == len(self._first):
+                self._refill()
+            end = min(self._pos + n, len(self._first))
+            parts.append([array[self._pos:end] for array in self._block])
+            n -= end - self._pos
+            self._pos = end
+
+        if len(parts) == 1:
+            return tuple(parts[0])
+        return tuple(np.concatenate(arrays) for arrays in zip(*parts))
+
+    def signature(self):
+        """
+        Identifies the distribution of the proposals, for checkpoint.fingerprint
+        ----------
+        returns:
+            signature (bytes): Kind of proposals and their parameters
+        """
+        return f'{type(self).__name__} n_positions={self.n_positions}'.encode('ascii')
+
+    def get_state(self):
+        """
+        State of the proposal streams and of the buffer, to checkpoint a run
+        ----------
+        returns:
+            state (dict): Bit generator states of both streams, the buffered block and the
+                          position of the next proposal in it
+        """
+        return {
+            'pair': self._pair_rng.bit_generator.state,
+            'uniform': self._uniform_rng.bit_generator.state,
+            'block': self._block,
+            'pos': self._pos,
+        }
+
+    def set_state(self, state):
+        """
+        Restores a state returned by get_state, the following proposals are then exactly those
+        that followed it
+        ----------
+        params:
+            state (dict): State of the proposal streams and of the buffer
+        returns:
+            None
+        """
+        self._pair_rng.bit_generator.state = state['pair']
+        self._uniform_rng.bit_generator.state = state['uniform']
+        self._block = tuple(np.asarray(array) for array in state['block'])
+        self._first, self._second, self._log_u = (array.tolist() for array in self._block)
+        self._pos = int(state['pos'])
+
+
+def rank_pair_weights(letters, scale=6.0, uniform=0.1, n_positions=26):
+    """
+    Probabilities of swapping each pair of positions for RankedSwapProposals
+    ----------
+    params:
+        letters (np.ndarray): Occurrences of every class in the encrypted text, see
+                              scoring.letter_counts
+        scale (float): Number of frequency ranks over which the weight of a pair drops by a
+                       factor e, default 6
+        uniform (float): Share of the proposals drawn uniformly over all pairs, which keeps every
+                         swap possible, default 0.1
+        n_positions (int): Number of positions of the cipher, default 26
+    returns:
+        first, second (np.ndarray): Positions of every pair (first < second)
+        weights (np.ndarray): Probability of every pair
+    """
+    order = np.argsort(-np.asarray(letters[:n_positions], dtype=float), kind='stable')
+    ranks = np.empty(n_positions)
+    ranks[order] = np.arange(n_positions)
+
+    first, second = np.triu_indices(n_positions, 1)
+    weights = np.exp(-np.abs(ranks[first] - ranks[second]) / scale)
+    weights = (1 - uniform) * weights / weights.sum() + uniform / len(weights)
+    return first, second, weights
+
+
+class RankedSwapProposals(SwapProposals):
+    """
+    Buffered source of swaps that favour positions of similar frequency rank in the encrypted
+    text, each paired with log(u) for a uniform u used in the acceptance test.
+
+    The probability of proposing a pair depends only on the encrypted text, never on the
+    current cipher, and a swap is undone by the same pair. The proposal is therefore
+    symmetric, q(x -> x') = q(x' -> x), so the Hastings correction is zero and the usual
+    acceptance test samples the same target as with uniform swaps.
+    ----------
+    params:
+        rng (generator): Seeded random number generator the proposal streams are spawned from
+        letters (np.ndarray): Occurrences of every class in the encrypted text, see
+                              scoring.letter_counts
+        scale (float): Number of frequency ranks over which the weight of a pair drops by a
+                       factor e, default 6
+        uniform (float): Share of the proposals drawn uniformly over all pairs, default 0.1
+        block_size (int): Number of proposals drawn at once, default 4096
+        n_positions (int): Number of positions of the cipher, default 26
+    """
+    def __init__(self, rng, letters, scale=6.0, uniform=0.1, block_size=4096, n_positions=26):
+        super().__init__(rng, block_size, n_positions)
+        self._pairs_first, self._pairs_second, weights = rank_pair_weights(
+            letters, scale, uniform, n_positions
+        )
+        self._cdf = np.cumsum(weights)
+        self._cdf[-1] = 1.0
+
+    def signature(self):
+        """Kind of proposals and the probability of every pair"""
+        return super().signature() + self._cdf.tobytes()
+
+    def _draw_pairs(self, size):
+        """
+        Draws size pairs of distinct positions from the rank weights, by inverting their
+        cumulative distribution
+        """
+        pairs = np.searchsorted(self._cdf, self._pair_rng.random(size), side='right')
+        return self._pairs_first[pairs], self._pairs_second[pairs]
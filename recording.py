@@ -0,0 +1,100 @@
+"""
+File containing the history recorder used to keep the scores of MCMC runs.
+"""
+import os
+
+import numpy as np
+
+
+class History:
+    """
+    Records the score of one chain (or of every chain of an ensemble) into a preallocated
+    buffer. Supports thinning (only every thin-th iteration is kept), a fixed-size ring buffer
+    that only keeps the most recent samples, and spilling to a .npy file through np.memmap for
+    very long runs. Files written this way can be passed straight to utils.plotHistories.
+    ----------
+    params:
+        iters (int): Maximum number of iterations of the run
+        thin (int): Keep one sample every thin iterations (iterations 1, 1+thin, ...), default 1
+        ring (int): Only keep the last ring samples, default None (keep everything)
+        path (str): Write the samples to this .npy file instead of memory, default None
+        n_chains (int): Number of chains for ensembles, default None (a single chain)
+    """
+    def __init__(self, iters, thin=1, ring=None, path=None, n_chains=None):
+        if ring is not None and path is not None:
+            raise ValueError('A ring buffer cannot be written to a file')
+
+        self.thin = thin
+        self.ring = ring
+        self.path = path
+        self.count = 0
+
+        capacity = ring if ring is not None else (iters + thin - 1) // thin
+        shape = (capacity,) if n_chains is None else (capacity, n_chains)
+
+        if path is not None:
+            self.buffer = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=shape)
+        else:
+            self.buffer = np.empty(shape)
+
+    def record(self, iteration, score):
+        """
+        Records the score of an iteration, unless it is thinned out
+        ----------
+        params:
+            iteration (int): Number of the iteration, starting at 1
+            score (float or np.ndarray): Score of the chain(s) after the iteration
+        returns:
+            None
+        """
+        if (iteration - 1) % self.thin:
+            return
+        self.buffer[self.count % len(self.buffer)] = score
+        self.count += 1
+
+    def samples(self, iteration):
+        """
+        Number of samples recorded up to and including an iteration (before ring wrap-around)
+        """
+        return (iteration + self.thin - 1) // self.thin
+
+    @property
+    def array(self):
+        """Recorded samples in chronological order"""
+        if self.ring is not None and self.count > self.ring:
+            return np.roll(self.buffer, -(self.count % self.ring), axis=0)
+        return self.buffer[:self.count]
+
+    @property
+    def iterations(self):
+        """Iteration number of every recorded sample"""
+        first = max(self.count - len(self.buffer), 0)
+        return 1 + self.thin * np.arange(first, self.count)
+
+    def close(self):
+        """
+        Flushes a file-backed history to disk. When the run stopped early the file is
+        shortened to the recorded samples, so it can be read back with np.load.
+        """
+        if self.path is None:
+            return
+
+        self.buffer.flush()
+        if self.count < len(self.buffer):
+            tmp = self.path + '.tmp'
+            shortened = np.lib.format.open_memmap(
+                tmp, mode='w+', dtype=np.float64, shape=(self.count,) + self.buffer.shape[1:]
+            )
+            shortened[:] = self.buffer[:self.count]
+            shortened.flush()
+            del shortened
+            self.buffer = None
+            os.replace(tmp, self.path)
+
+        self.buffer = np.load(self.path, mmap_mode='r')
+
+    def __len__(self):
+        return min(self.count, len(self.buffer))
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.array, dtype=dtype)
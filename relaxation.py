@@ -0,0 +1,131 @@
+"""
+File containing the continuous relaxation of decryption ciphers used by Hamiltonian Monte Carlo.
+
+A decryption cipher is a permutation of the 26 letters. It is relaxed to a 26x26 matrix of real
+numbers (the position), turned into a doubly stochastic matrix P by Sinkhorn normalization, where
+P[a, x] is the weight of cipher letter a decrypting to plain letter x. The space class always maps
+to itself. The expected log likelihood of the encrypted text under P is a quadratic form in P,
+
+    E(P) = sum_ab counts[a, b] (F log_probs F^T)[a, b],   F = P extended with the space class
+
+which equals scoring.score_perm when P is a permutation matrix. The potential energy sampled by
+Hamiltonian Monte Carlo is -E / temperature plus a Gaussian prior on the position, and its
+gradient is computed in closed form: dE/dF = counts F log_probs^T + counts^T F log_probs, carried
+back through the unrolled Sinkhorn iterations.
+"""
+import numpy as np
+
+import scoring
+
+
+def _logsumexp(z, axis):
+    """Numerically stable log(sum(exp(z))) along an axis, keeping the axis"""
+    top = z.max(axis=axis, keepdims=True)
+    return top + np.log(np.exp(z - top).sum(axis=axis, keepdims=True))
+
+
+def sinkhorn(position, tau=1.0, n_iters=20):
+    """
+    Turns a position into a doubly stochastic matrix by alternately normalizing its rows and
+    columns, in log space
+    ----------
+    params:
+        position (np.ndarray): 26x26 real matrix
+        tau (float): Temperature of the relaxation, smaller values give matrices closer to a
+                     permutation, default 1
+        n_iters (int): Number of row and column normalizations, default 20
+    returns:
+        P (np.ndarray): 26x26 doubly stochastic matrix (exactly column stochastic)
+        steps (list): Normalized matrices of every half iteration, used by sinkhorn_grad
+    """
+    z = position / tau
+    steps = []
+    for _ in range(n_iters):
+        z = z - _logsumexp(z, 1)
+        steps.append(np.exp(z))
+        z = z - _logsumexp(z, 0)
+        steps.append(np.exp(z))
+    return steps[-1], steps
+
+
+def sinkhorn_grad(grad_p, steps, tau=1.0):
+    """
+    Gradient of a function of the output of sinkhorn with respect to its position
+    ----------
+    params:
+        grad_p (np.ndarray): Gradient of the function with respect to P
+        steps (list): Normalized matrices returned by sinkhorn
+        tau (float): Temperature sinkhorn was called with
+    returns:
+        grad (np.ndarray): Gradient of the function with respect to the position
+    """
+    # Through P = exp(z), then through every z <- z - logsumexp(z) back to front, whose
+    # Jacobian-vector product is g - softmax(z) * sum(g)
+    grad = grad_p * steps[-1]
+    for k in range(len(steps) - 1, -1, -1):
+        axis = 1 if k % 2 == 0 else 0
+        grad = grad - steps[k] * grad.sum(axis=axis, keepdims=True)
+    return grad / tau
+
+
+class SinkhornPotential:
+    """
+    Potential energy of the relaxed decryption ciphers of an encrypted text
+    ----------
+    params:
+        counts (np.ndarray): 27x27 bigram count matrix of the encrypted text
+        log_probs (np.ndarray): 27x27 log transition probabilities of the reference text
+        temperature (float): Divides the expected log likelihood, low values make the potential
+                             steeper around good ciphers, default 0.003
+        tau (float): Temperature of the Sinkhorn relaxation, default 1
+        n_iters (int): Number of Sinkhorn iterations, default 20
+        prior_scale (float): Standard deviation of the Gaussian prior on the position, which
+                             keeps the (otherwise shift invariant) target proper, default 10
+    """
+    def __init__(self, counts, log_probs, temperature=0.003, tau=1.0, n_iters=20, prior_scale=10.0):
+        if isinstance(counts, scoring.NgramCounts) or np.ndim(log_probs) != 2:
+            raise ValueError('Hamiltonian Monte Carlo only supports bigram models')
+
+        self.counts = np.asarray(counts, dtype=float)
+        self.log_probs = np.asarray(log_probs, dtype=float)
+        self.temperature = temperature
+        self.tau = tau
+        self.n_iters = n_iters
+        self.prior_scale = prior_scale
+
+    def expected_score(self, P):
+        """
+        Expected log likelihood of the encrypted text under a doubly stochastic matrix
+        ----------
+        params:
+            P (np.ndarray): 26x26 doubly stochastic matrix
+        returns:
+            score (float): E(P), equal to scoring.score_perm for permutation matrices
+            grad (np.ndarray): Gradient of E with respect to P
+        """
+        F = np.zeros((scoring.N_CLASSES, scoring.N_CLASSES))
+        F[:scoring.SPACE, :scoring.SPACE] = P
+        F[scoring.SPACE, scoring.SPACE] = 1.0
+
+        CF = self.counts @ F
+        score = np.sum(CF * (F @ self.log_probs))
+        grad = CF @ self.log_probs.T + self.counts.T @ F @ self.log_probs
+        return float(score), grad[:scoring.SPACE, :scoring.SPACE]
+
+    def __call__(self, position):
+        """
+        Potential energy of a position and its gradient
+        ----------
+        params:
+            position (np.ndarray): 26x26 real matrix
+        returns:
+            potential (float): -E(sinkhorn(position)) / temperature plus the Gaussian prior
+            grad (np.ndarray): Gradient of the potential with respect to the position
+        """
+        P, steps = sinkhorn(position, self.tau, self.n_iters)
+        score, grad_p = self.expected_score(P)
+
+        variance = self.prior_scale ** 2
+        potential = -score / self.temperature + np.sum(position * position) / (2 * variance)
+        grad = -sinkhorn_grad(grad_p, steps, self.tau) / self.temperature + position / variance
+        return potential, grad
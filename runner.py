@@ -0,0 +1,192 @@
+"""
+File containing functions that run many independent MCMC chains on a process pool.
+"""
+import os
+import copy
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+import model
+import scoring
+import recording
+from checkpoint import Checkpointer
+from instrument import Instrumentation
+from mcmc import mcmc
+from proposals import RankedSwapProposals, rank_pair_weights
+
+
+# Reference model of the current worker process, loaded once by _init_worker
+_model = None
+_log_probs = None
+
+# Letter frequencies of the reference model, computed the first time a chain needs them
+_reference_letters = None
+
+# Number of ranked swaps applied to the frequency-aligned cipher, so that every chain starts from
+# its own point near it
+FREQUENCY_SWAPS = 3
+
+
+def _init_worker(model_path=None):
+    """
+    Pool initializer that loads the reference model once per worker process. The model is
+    memory-mapped, so all workers share one page-cached copy.
+    """
+    global _model, _log_probs, _reference_letters
+    _model = model.load_model(model_path)
+    _log_probs = _model.log_probs
+    _reference_letters = None
+
+
+def _frequency_key(letters, rng):
+    """
+    Decryption cipher aligning the letter frequencies of the encrypted text with those of the
+    reference model of the worker, perturbed by FREQUENCY_SWAPS swaps of letters of similar
+    frequency drawn from the chain's generator
+    """
+    global _reference_letters
+    if _reference_letters is None:
+        _reference_letters = _model.letter_counts
+    perm = scoring.frequency_perm(letters, _reference_letters)
+
+    first, second, weights = rank_pair_weights(letters)
+    for pair in rng.choice(len(weights), size=FREQUENCY_SWAPS, p=weights):
+        i, j = first[pair], second[pair]
+        perm[i], perm[j] = perm[j], perm[i]
+    return scoring.perm_to_key(perm)
+
+
+def _run_chain(encoded_text, seed, iters, stop=None, thin=1, instrument=False, profile=False,
+               initial_key=None, schedule=None, reheat=None, checkpoint=None, init='random',
+               proposal='uniform'):
+    """
+    Runs a single chain from a random (or given) decryption cipher. Everything random in the
+    chain, including its initial cipher, is drawn from the chain's own seed.
+    ----------
+    params:
+        encoded_text (str): Passed encrypted text, or its statistics (see streaming.py)
+        seed (np.random.SeedSequence): Seed of the chain's random number generator
+        iters (int): Number of MCMC iterations
+        stop (list): Stopping criteria, copied so that every chain starts from a fresh state
+        thin (int): Keep the score of one iteration out of thin in the history
+        instrument (bool): Collect per-phase timings and counters of the chain
+        profile (bool): Also run the chain under cProfile (implies instrument)
+        initial_key (str): Decryption cipher the chain starts from, default a random one
+        schedule (annealing.Schedule): Cooling schedule, copied like the stopping criteria
+        reheat (int): Iterations without improvement before the schedule is reheated
+        checkpoint (checkpoint.Checkpointer): Checkpoints of the chain, default None
+        init (str): Initial cipher of a chain that is not warm-started, 'random' or
+                    'frequency' (aligned with the letter frequencies of the model, then
+                    perturbed by a few seeded swaps of letters of similar frequency)
+        proposal (str): Swap proposals, 'uniform' or 'ranked' (proposals.RankedSwapProposals)
+    returns:
+        ChainResult (key, history, score, iterations, report): Result of the MCMC run
+    """
+    rng = np.random.default_rng(seed)
+
+    # Letter frequencies of the encrypted text, for the guided initial cipher and proposals
+    letters = None
+    if init == 'frequency' or proposal == 'ranked':
+        letters = scoring.letter_counts(scoring.text_statistics(encoded_text, _log_probs.ndim))
+
+    # Generate a random decryption key, unless the chain is warm-started
+    decrypt_key = "".join(rng.permutation(list(scoring.ALPHABET)))
+    if initial_key is not None:
+        decrypt_key = initial_key
+    elif init == 'frequency':
+        decrypt_key = _frequency_key(letters, rng)
+
+    proposals = None
+    if proposal == 'ranked':
+        proposals = RankedSwapProposals(rng, letters)
+
+    return mcmc(
+        decrypt_key, encoded_text, rng, iters, log_probs=_log_probs,
+        stop=copy.deepcopy(stop), history=recording.History(iters, thin),
+        instrument=Instrumentation(profile) if instrument or profile else None,
+        proposals=proposals, schedule=copy.deepcopy(schedule), reheat=reheat,
+        checkpoint=checkpoint
+    )
+
+
+def run_chains(encoded_text, n_chains, iters, workers=None, seed=0, model_path=None, stop=None,
+               thin=1, instrument=False, profile=False, initial_keys=(), schedule=None,
+               reheat=None, checkpoint_dir=None, checkpoint_every=10000, init='random',
+               proposal='uniform'):
+    """
+    Runs independent MCMC chains on the encrypted text, spread over a pool of processes. Every
+    chain gets its own random number generator spawned from the seed, so the results only depend
+    on the seed and not on the number of workers or the order in which the chains finish.
+    ----------
+    params:
+        encoded_text (str): Passed encrypted text, or its statistics (see streaming.py)
+        n_chains (int): Number of chains to run
+        iters (int): Number of MCMC iterations per chain
+        workers (int): Number of worker processes, defaults to the number of CPUs. With a
+                       single worker the chains run in the current process
+        seed (int): Seed the chains' random number generators are spawned from, default 0
+        model_path (str): Directory of the compiled language model, see model.load_model
+        stop (list): Per-chain stopping criteria from stopping.py, every chain stops on its own
+                     and reports the iteration it stopped at. Cross-chain criteria such as
+                     GelmanRubin need the chains in lockstep, use mcmc.mcmc_ensemble for those
+        thin (int): Keep the score of one iteration out of thin in the histories, default 1
+        instrument (bool): Collect per-phase timings and counters of every chain and return
+                           them in ChainResult.report, default False
+        profile (bool): Also run every chain under cProfile and add the text of its report
+                        (implies instrument), default False
+        initial_keys (list): Decryption ciphers the first chains start from, e.g. warm starts
+                             from cache.ResultCache.similar. The remaining chains start from
+                             random ciphers
+        schedule (annealing.Schedule): Cooling schedule that turns every chain into simulated
+                                       annealing, see mcmc.mcmc, default None
+        reheat (int): Reheat the schedule of a chain once its best score has not improved for
+                      this many iterations, default None (never)
+        checkpoint_dir (str): Directory of the checkpoints of the chains (chain-<n>.npz), runs
+                              killed before the end resume from them when called again with
+                              the same arguments, default None (no checkpoints)
+        checkpoint_every (int): Minimum number of iterations between two checkpoints of a
+                                chain, default 10,000
+        init (str): Initial cipher of the chains that are not warm-started, 'random' (default)
+                    or 'frequency', which maps the k-th most frequent letter of the encrypted
+                    text to the k-th most frequent letter of the model. Each chain then applies
+                    FREQUENCY_SWAPS swaps of letters of similar frequency drawn from its own
+                    generator, so the chains start from different points
+        proposal (str): Swap proposals of the chains, 'uniform' (default) or 'ranked', which
+                        favours swapping letters of similar frequency (see
+                        proposals.RankedSwapProposals)
+    returns:
+        results (list): ChainResult of every chain, in chain order
+    """
+    seeds = np.random.SeedSequence(seed).spawn(n_chains)
+    initial_keys = list(initial_keys)[:n_chains]
+    initial_keys += [None] * (n_chains - len(initial_keys))
+
+    checkpoints = [None] * n_chains
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        checkpoints = [
+            Checkpointer(os.path.join(checkpoint_dir, f'chain-{n}.npz'), checkpoint_every)
+            for n in range(n_chains)
+        ]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, n_chains)
+
+    if workers <= 1:
+        _init_worker(model_path)
+        return [
+            _run_chain(encoded_text, s, iters, stop, thin, instrument, profile, key, schedule,
+                       reheat, ck, init, proposal)
+            for s, key, ck in zip(seeds, initial_keys, checkpoints)
+        ]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(model_path,)) as executor:
+        return list(executor.map(
+            _run_chain, repeat(encoded_text), seeds, repeat(iters), repeat(stop), repeat(thin),
+            repeat(instrument), repeat(profile), initial_keys, repeat(schedule), repeat(reheat),
+            checkpoints, repeat(init), repeat(proposal)
+        ))
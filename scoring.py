@@ -0,0 +1,466 @@
+"""
+File containing the sufficient-statistics scoring engine used during MCMC.
+
+The encrypted text is reduced once to a 27x27 matrix of bigram counts (26 letters plus one class
+shared by spaces and every other non-letter), and the reference text to a dense 27x27 matrix of
+log transition probabilities. Scoring a decryption cipher is then a permuted gather and sum over
+those two matrices, so its cost no longer depends on the length of the encrypted text.
+"""
+import numpy as np
+
+
+# English alphabet, the class index of a letter is its position in this string
+ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+# Class index shared by spaces and all other non-letters
+SPACE = 26
+
+# Number of character classes (26 letters + space)
+N_CLASSES = 27
+
+# Lookup table from letter to class index
+_CLASS_INDEX = {letter: i for i, letter in enumerate(ALPHABET)}
+
+# Lookup table from byte value to class index (upper and lower case letters map to the same class)
+_BYTE_CLASSES = np.full(256, SPACE, dtype=np.uint8)
+for _i, _letter in enumerate(ALPHABET):
+    _BYTE_CLASSES[ord(_letter)] = _i
+    _BYTE_CLASSES[ord(_letter.lower())] = _i
+
+
+def text_to_classes(text):
+    """
+    Converts a string of text to an array of character class indices. Letters are mapped
+    independently of case and everything else is mapped to the space class, exactly like
+    utils.applyKey does.
+    ----------
+    params:
+        text (str): Some string of text
+    returns:
+        classes (np.ndarray): uint8 array with the class index of every character
+    """
+    if text.isascii():
+        return _BYTE_CLASSES[np.frombuffer(text.encode('ascii'), dtype=np.uint8)]
+
+    # Slow path for non-ASCII text
+    return np.array([_CLASS_INDEX.get(str.upper(c), SPACE) for c in text], dtype=np.uint8)
+
+
+def _strip(classes):
+    """
+    Removes leading and trailing non-letters from an array of character classes
+    """
+    letters = np.flatnonzero(classes != SPACE)
+    if len(letters) == 0:
+        return classes[:0]
+    return classes[letters[0]:letters[-1] + 1]
+
+
+def bigram_counts(text):
+    """
+    Reduces a text to its bigram count matrix. Leading and trailing non-letters are ignored, as
+    in utils.score.
+    ----------
+    params:
+        text (str): Encrypted text
+    returns:
+        counts (np.ndarray): 27x27 integer matrix where counts[a, b] is the number of times
+                             class a is followed by class b
+    """
+    classes = _strip(text_to_classes(text)).astype(np.intp)
+
+    # Count every (current, next) pair in one pass
+    pairs = classes[:-1] * N_CLASSES + classes[1:]
+    return np.bincount(pairs, minlength=N_CLASSES ** 2).reshape(N_CLASSES, N_CLASSES)
+
+
+def encode_ngrams(grams):
+    """
+    Encodes n-grams of character classes as single integers in base 27
+    ----------
+    params:
+        grams (np.ndarray): Array of class indices whose last axis runs over the n-gram
+    returns:
+        codes (np.ndarray): int64 code of every n-gram
+    """
+    codes = np.zeros(grams.shape[:-1], dtype=np.int64)
+    for k in range(grams.shape[-1]):
+        codes = codes * N_CLASSES + grams[..., k]
+    return codes
+
+
+def decode_ngrams(codes, order):
+    """
+    Inverse of encode_ngrams
+    ----------
+    params:
+        codes (np.ndarray): int64 codes of n-grams
+        order (int): Length of the n-grams
+    returns:
+        grams (np.ndarray): Array of shape codes.shape + (order,) with the class indices
+    """
+    grams = np.empty(codes.shape + (order,), dtype=np.intp)
+    for k in range(order - 1, -1, -1):
+        codes, grams[..., k] = np.divmod(codes, N_CLASSES)
+    return grams
+
+
+class NgramCounts:
+    """
+    Sparse n-gram statistics of an encrypted text, used with models of order 3 and higher where
+    a dense count array would mostly hold zeros.
+    ----------
+    params:
+        grams (np.ndarray): (M, n) array with every distinct n-gram of the text
+        weights (np.ndarray): Number of times each n-gram occurs in the text
+    """
+    def __init__(self, grams, weights):
+        self.grams = grams
+        self.weights = weights
+
+        # contains[m, a] is True when the m-th n-gram contains class a
+        self.contains = np.zeros((len(grams), N_CLASSES), dtype=bool)
+        self.contains[np.arange(len(grams))[:, None], grams] = True
+
+        # Indices of the n-grams that contain each class, used by delta_score
+        self.by_class = [np.flatnonzero(self.contains[:, a]) for a in range(N_CLASSES)]
+
+    @property
+    def order(self):
+        """Length of the n-grams"""
+        return self.grams.shape[1]
+
+
+def ngram_counts(text, order):
+    """
+    Reduces a text to the distinct n-grams it contains and their number of occurrences.
+    Leading and trailing non-letters are ignored, as in bigram_counts.
+    ----------
+    params:
+        text (str): Encrypted text
+        order (int): Length of the n-grams
+    returns:
+        counts (NgramCounts): n-gram statistics of the text
+    """
+    classes = _strip(text_to_classes(text)).astype(np.int64)
+    windows = max(len(classes) - order + 1, 0)
+
+    codes = np.zeros(windows, dtype=np.int64)
+    for k in range(order):
+        codes = codes * N_CLASSES + classes[k:k + windows]
+
+    codes, weights = np.unique(codes, return_counts=True)
+    return NgramCounts(decode_ngrams(codes, order), weights)
+
+
+def text_statistics(text, order=2):
+    """
+    Reduces a text to the sufficient statistics used to score it with a model of the given
+    order: a dense count matrix for bigrams and NgramCounts for longer n-grams
+    ----------
+    params:
+        text (str): Encrypted text, or its statistics already computed (e.g. by
+                    streaming.text_statistics for texts too large to hold in memory)
+        order (int): Order of the language model, default 2
+    returns:
+        counts (np.ndarray or NgramCounts): Statistics of the text
+    """
+    if not isinstance(text, str):
+        given = text.order if isinstance(text, NgramCounts) else text.ndim
+        if given != order:
+            raise ValueError(f'statistics of order {given} given for a model of order {order}')
+        return text
+
+    if order == 2:
+        return bigram_counts(text)
+    return ngram_counts(text, order)
+
+
+def lookup_log_probs(log_probs, grams):
+    """
+    Looks up the log probability of n-grams in a language model
+    ----------
+    params:
+        log_probs (np.ndarray or model.SparseLogProbs): Dense array with one axis per character
+                                                        of the n-gram, or a sparse table
+        grams (np.ndarray): Array of class indices whose last axis runs over the n-gram
+    returns:
+        log_probs (np.ndarray): log P of the last character given the others, for every n-gram
+    """
+    if isinstance(log_probs, np.ndarray):
+        return log_probs[tuple(np.moveaxis(grams, -1, 0))]
+    return log_probs.lookup(grams)
+
+
+def freq_dict_counts(freq_dict):
+    """
+    Converts the frequency dictionary of the reference text to a dense bigram count matrix
+    ----------
+    params:
+        freq_dict (dict): Dictionary of frequency counts generated from the reference text
+    returns:
+        counts (np.ndarray): 27x27 integer matrix of bigram counts
+    """
+    counts = np.zeros((N_CLASSES, N_CLASSES), dtype=np.int64)
+    for bigram, count in freq_dict.items():
+        a, b = (_CLASS_INDEX.get(c, SPACE) for c in bigram)
+        counts[a, b] += count
+    return counts
+
+
+def log_probs_from_counts(counts, smoothing=1.0):
+    """
+    Converts the dense n-gram counts of the reference text to log transition probabilities of
+    the last character given the others, e.g. log P(b | a) for bigrams. Additive smoothing keeps
+    unseen n-grams at a finite penalty.
+    ----------
+    params:
+        counts (np.ndarray): Dense n-gram counts of the reference text, one axis per character
+        smoothing (float): Pseudo-count added to every n-gram, default 1
+    returns:
+        log_probs (np.ndarray): Array of the same shape, e.g. log_probs[a, b] = log P(b | a)
+    """
+    freqs = counts.astype(np.float64) + smoothing
+    return np.log(freqs) - np.log(freqs.sum(axis=-1, keepdims=True))
+
+
+def log_prob_matrix(freq_dict, smoothing=1.0):
+    """
+    Converts the frequency dictionary of the reference text to a dense matrix of log transition
+    probabilities log P(b | a)
+    ----------
+    params:
+        freq_dict (dict): Dictionary of frequency counts generated from the reference text
+        smoothing (float): Pseudo-count added to every bigram, default 1
+    returns:
+        log_probs (np.ndarray): 27x27 matrix where log_probs[a, b] = log P(b | a)
+    """
+    return log_probs_from_counts(freq_dict_counts(freq_dict), smoothing)
+
+
+def key_to_perm(key):
+    """
+    Converts a decryption cipher to its permutation representation
+    ----------
+    params:
+        key (str): String representation of the decryption cipher
+    returns:
+        perm (np.ndarray): Integer array of length 27 where perm[a] is the class that the
+                           encrypted class a is decrypted to (the space class maps to itself)
+    """
+    return np.array([_CLASS_INDEX[letter] for letter in key] + [SPACE], dtype=np.intp)
+
+
+def perm_to_key(perm):
+    """
+    Converts the permutation representation of a decryption cipher back to a string
+    ----------
+    params:
+        perm (np.ndarray): Permutation representation of the decryption cipher
+    returns:
+        key (str): String representation of the decryption cipher
+    """
+    return "".join(ALPHABET[c] for c in perm[:SPACE])
+
+
+def letter_counts(counts):
+    """
+    Number of occurrences of every character class in a text, from its statistics
+    ----------
+    params:
+        counts (np.ndarray or NgramCounts): Statistics of the encrypted text
+    returns:
+        letters (np.ndarray): Occurrences of each of the 27 classes as the first character of an
+                              n-gram (the last few characters of the text are not counted)
+    """
+    if isinstance(counts, NgramCounts):
+        return np.bincount(counts.grams[:, 0], weights=counts.weights, minlength=N_CLASSES)
+    return np.asarray(counts, dtype=float).sum(axis=1)
+
+
+def frequency_perm(letters, reference):
+    """
+    Decryption cipher that maps the k-th most frequent letter of the encrypted text to the k-th
+    most frequent letter of the reference text, a much better starting point than a random one
+    ----------
+    params:
+        letters (np.ndarray): Occurrences of every class in the encrypted text, see letter_counts
+        reference (np.ndarray): Occurrences of every class in the reference text, e.g.
+                                model.LanguageModel.letter_counts
+    returns:
+        perm (np.ndarray): Permutation representation of the decryption cipher
+    """
+    # Stable sorts, so letters with equal counts keep their alphabetical order
+    encrypted = np.argsort(-np.asarray(letters[:SPACE], dtype=float), kind='stable')
+    plain = np.argsort(-np.asarray(reference[:SPACE], dtype=float), kind='stable')
+
+    perm = np.empty(N_CLASSES, dtype=np.intp)
+    perm[encrypted] = plain
+    perm[SPACE] = SPACE
+    return perm
+
+
+def score_perm(perm, counts, log_probs):
+    """
+    Calculates the log likelihood of a decryption cipher from the precomputed statistics
+    ----------
+    params:
+        perm (np.ndarray): Permutation representation of the decryption cipher
+        counts (np.ndarray or NgramCounts): Statistics of the encrypted text
+        log_probs (np.ndarray or model.SparseLogProbs): Log transition probabilities of the
+                                                        reference text
+    returns:
+        score (float): log likelihood of the decryption cipher
+    """
+    if isinstance(counts, NgramCounts):
+        return float(np.sum(counts.weights * lookup_log_probs(log_probs, perm[counts.grams])))
+
+    return float(np.sum(counts * log_probs[perm[:, None], perm]))
+
+
+class ChainState:
+    """
+    State of a single Markov chain. Holds the permutation representation of the current
+    decryption cipher together with its cached log likelihood so that two-letter swaps can be
+    scored incrementally with delta_score.
+    ----------
+    params:
+        perm (np.ndarray): Permutation representation of the decryption cipher
+        counts (np.ndarray or NgramCounts): Statistics of the encrypted text
+        log_probs (np.ndarray or model.SparseLogProbs): Log transition probabilities of the
+                                                        reference text
+    """
+    def __init__(self, perm, counts, log_probs):
+        self.perm = np.array(perm, dtype=np.intp)
+        self.counts = counts
+        self.log_probs = log_probs
+        self.score = score_perm(self.perm, counts, log_probs)
+
+    @property
+    def key(self):
+        """String representation of the current decryption cipher"""
+        return perm_to_key(self.perm)
+
+    def swap(self, i, j, delta):
+        """
+        Swaps the letters at positions i and j of the cipher and updates the cached score
+        ----------
+        params:
+            i, j (int): Positions in the cipher to swap
+            delta (float): Change in score returned by delta_score(self, i, j)
+        returns:
+            None
+        """
+        self.perm[i], self.perm[j] = self.perm[j], self.perm[i]
+        self.score += delta
+
+
+def delta_score(state, i, j):
+    """
+    Calculates the change in log likelihood caused by swapping the letters at positions i and j
+    of the current decryption cipher. Only the rows and columns of the bigram count matrix that
+    belong to the two swapped letters are visited (for longer n-grams, only the n-grams that
+    contain one of them), the state itself is left unchanged.
+    ----------
+    params:
+        state (ChainState): Current state of the chain
+        i, j (int): Positions in the cipher to swap
+    returns:
+        delta (float): Score of the swapped cipher minus the score of the current cipher
+    """
+    perm, counts, log_probs = state.perm, state.counts, state.log_probs
+
+    swapped = perm.copy()
+    swapped[i], swapped[j] = perm[j], perm[i]
+
+    if isinstance(counts, NgramCounts):
+        # n-grams containing the letter at position i, plus those containing j but not i
+        with_j = counts.by_class[j]
+        affected = np.concatenate((counts.by_class[i], with_j[~counts.contains[with_j, i]]))
+        grams = counts.grams[affected]
+        diff = lookup_log_probs(log_probs, swapped[grams]) - lookup_log_probs(log_probs, perm[grams])
+        return float(np.sum(counts.weights[affected] * diff))
+
+    idx = [i, j]
+
+    # Bigrams starting with one of the swapped letters
+    rows = counts[idx] * (log_probs[swapped[idx, None], swapped] - log_probs[perm[idx, None], perm])
+
+    # Bigrams ending with one of the swapped letters
+    cols = counts[:, idx] * (log_probs[swapped[:, None], swapped[idx]] - log_probs[perm[:, None], perm[idx]])
+
+    # Bigrams made of two swapped letters are in both the rows and columns
+    block = cols[idx]
+
+    return float(rows.sum() + cols.sum() - block.sum())
+
+
+def score_perms(perms, counts, log_probs):
+    """
+    Vectorized score_perm for an ensemble of decryption ciphers
+    ----------
+    params:
+        perms (np.ndarray): (N, 27) array with one permutation per row
+        counts (np.ndarray or NgramCounts): Statistics of the encrypted text
+        log_probs (np.ndarray or model.SparseLogProbs): Log transition probabilities of the
+                                                        reference text
+    returns:
+        scores (np.ndarray): log likelihood of every decryption cipher
+    """
+    if isinstance(counts, NgramCounts):
+        return np.sum(counts.weights * lookup_log_probs(log_probs, perms[:, counts.grams]), axis=1)
+
+    return np.sum(counts * log_probs[perms[:, :, None], perms[:, None, :]], axis=(1, 2))
+
+
+def delta_scores(perms, i, j, counts, log_probs):
+    """
+    Vectorized delta_score for an ensemble of decryption ciphers, where every row of perms
+    proposes its own swap of positions i[n] and j[n]. The permutations are left unchanged.
+    ----------
+    params:
+        perms (np.ndarray): (N, 27) array with one permutation per row
+        i, j (np.ndarray): (N,) arrays with the positions to swap in each row
+        counts (np.ndarray or NgramCounts): Statistics of the encrypted text
+        log_probs (np.ndarray or model.SparseLogProbs): Log transition probabilities of the
+                                                        reference text
+    returns:
+        deltas (np.ndarray): Score of every swapped cipher minus the score of its current cipher
+    """
+    chains = np.arange(len(perms))
+
+    if isinstance(counts, NgramCounts):
+        swapped = perms.copy()
+        swapped[chains, i] = perms[chains, j]
+        swapped[chains, j] = perms[chains, i]
+
+        # n-grams without a swapped letter contribute zero
+        grams = counts.grams
+        diff = lookup_log_probs(log_probs, swapped[:, grams]) - lookup_log_probs(log_probs, perms[:, grams])
+        return np.sum(counts.weights * diff, axis=1)
+
+    # Work on (N, 27) rows instead of (N, 2, 27) blocks: a swap moves letter x from position i
+    # to j and letter y the other way, so every bigram with one swapped end changes by
+    # (count at i - count at j) * (log P with y - log P with x). Bigrams with both ends swapped
+    # are taken out of those sums and added back exactly from the 2x2 block
+    flat = log_probs.ravel()
+    counts = np.asarray(counts, dtype=float)
+    x = perms[chains, i]
+    y = perms[chains, j]
+    first = perms * N_CLASSES
+    row_diff = flat.take(y[:, None] * N_CLASSES + perms) - flat.take(x[:, None] * N_CLASSES + perms)
+    col_diff = flat.take(first + y[:, None]) - flat.take(first + x[:, None])
+    partial = (np.einsum('nb,nb->n', counts[i] - counts[j], row_diff)
+               + np.einsum('nb,nb->n', counts.T[i] - counts.T[j], col_diff))
+
+    # Bigrams made of two swapped letters
+    lxx = flat.take(x * N_CLASSES + x)
+    lxy = flat.take(x * N_CLASSES + y)
+    lyx = flat.take(y * N_CLASSES + x)
+    lyy = flat.take(y * N_CLASSES + y)
+    cii, cij, cji, cjj = counts[i, i], counts[i, j], counts[j, i], counts[j, j]
+    counted = ((cii - cji) * (lyx - lxx) + (cii - cij) * (lxy - lxx)
+               + (cij - cjj) * (lyy - lxy) + (cji - cjj) * (lyy - lyx))
+    block = (cii - cjj) * (lyy - lxx) + (cij - cji) * (lyx - lxy)
+
+    return partial - counted + block
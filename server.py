@@ -0,0 +1,435 @@
+"""
+File containing a small local decipher service.
+
+The service keeps a warm pool of worker processes with the language model already loaded, so
+other tools can submit encrypted texts without paying for Python startup and model loading on
+every request. It is built on asyncio and the standard library only, and listens on localhost
+(or on a Unix socket):
+
+    $ python server.py --port 8765 --workers 4
+    $ curl -X POST localhost:8765/jobs -d '{"text": "XLMW MW E XIWX"}'
+    $ curl localhost:8765/jobs/<id>
+
+Routes
+    POST   /jobs        Submits a job, {"text": ..., "iters", "chains", "patience", "seed"}.
+                        Answers 202 with the job id, or 503 when the queue is full
+    GET    /jobs/<id>   Status of a job (queued, running, done, cancelled or failed) and its
+                        result once done
+    DELETE /jobs/<id>   Cancels a job. Queued jobs never run, running jobs stop their chains
+                        within a few hundred iterations
+    GET    /metrics     Queue depth, running and finished jobs, and queue wait and run latencies
+    GET    /health      Liveness check
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import batch
+import runner
+import stopping
+
+
+# Maximum size of a request body in bytes
+MAX_BODY = 1 << 20
+
+# Number of finished jobs kept for status polling
+MAX_FINISHED = 10000
+
+# Number of recent jobs the latency metrics are computed over
+LATENCY_WINDOW = 1000
+
+# Reason phrases of the status codes used by the service
+REASONS = {
+    200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found',
+    405: 'Method Not Allowed', 413: 'Payload Too Large', 503: 'Service Unavailable',
+}
+
+
+class Cancelled:
+    """
+    Stopping criterion that fires once a job is cancelled
+    ----------
+    params:
+        event (multiprocessing.Event): Cancellation flag of the job, shared with the server
+        every (int): Number of iterations between two checks of the flag, default 500
+    """
+    def __init__(self, event, every=500):
+        self.event = event
+        self.every = every
+
+    def update(self, iteration, score, changed):
+        return iteration % self.every == 0 and self.event.is_set()
+
+    def __deepcopy__(self, memo):
+        # The flag is shared with the server, copies of the criterion must keep watching it
+        return Cancelled(self.event, self.every)
+
+
+def _init_worker(model_path=None):
+    """
+    Pool initializer that loads the model, the server alone handles interrupts and shuts the
+    workers down
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    runner._init_worker(model_path)
+
+
+def _warm(delay=0.1):
+    """
+    Trivial task used to start every worker process (and load the model) ahead of the first job
+    """
+    time.sleep(delay)
+    return os.getpid()
+
+
+class Job:
+    """
+    Decipher job and its lifecycle
+    ----------
+    params:
+        text (str): Encrypted text
+        options (dict): Number of iterations, chains, patience and seed of the job
+        cancel (multiprocessing.Event): Cancellation flag shared with the worker
+    """
+    __slots__ = ('id', 'text', 'options', 'cancel', 'status', 'result', 'error',
+                 'submitted', 'started', 'finished')
+
+    def __init__(self, text, options, cancel):
+        self.id = uuid.uuid4().hex
+        self.text = text
+        self.options = options
+        self.cancel = cancel
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        """JSON representation of the job"""
+        job = {'id': self.id, 'status': self.status, 'submitted': self.submitted,
+               'started': self.started, 'finished': self.finished}
+        if self.result is not None:
+            job['result'] = self.result
+        if self.error is not None:
+            job['error'] = self.error
+        return job
+
+
+class DecipherService:
+    """
+    Bounded job queue in front of a warm pool of worker processes
+    ----------
+    params:
+        workers (int): Number of worker processes, defaults to the number of CPUs
+        queue_size (int): Maximum number of queued jobs, submissions beyond it are refused with
+                          503 until the queue drains (cancelled jobs free their slot at once),
+                          default 100
+        model_path (str): Directory of the compiled language model, see model.load_model
+    """
+    def __init__(self, workers=None, queue_size=100, model_path=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.model_path = model_path
+        self.jobs = OrderedDict()
+        self.queue = None
+        self.queued = 0
+        self.running = 0
+        self.completed = dict.fromkeys(('done', 'cancelled', 'failed'), 0)
+        self.rejected = 0
+        self.waits = deque(maxlen=LATENCY_WINDOW)
+        self.runtimes = deque(maxlen=LATENCY_WINDOW)
+        self._executor = None
+        self._manager = None
+        self._tasks = []
+
+    async def start(self):
+        """Starts the worker processes, waits for them to load the model and starts consuming jobs"""
+        loop = asyncio.get_running_loop()
+        # Unbounded, the limit is enforced on the live jobs only: cancelled jobs free their slot
+        # at once and are skipped by the consumers when they reach them
+        self.queue = asyncio.Queue()
+        self._manager = multiprocessing.Manager()
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_init_worker, initargs=(self.model_path,)
+        )
+        await asyncio.gather(*(loop.run_in_executor(self._executor, _warm) for _ in range(self.workers)))
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Cancels the consumers and shuts the worker processes down"""
+        for job in self.jobs.values():
+            if job.status in ('queued', 'running'):
+                job.cancel.set()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._manager.shutdown()
+
+    def submit(self, text, options):
+        """
+        Queues a new job
+        ----------
+        params:
+            text (str): Encrypted text
+            options (dict): Number of iterations, chains, patience and seed of the job
+        returns:
+            job (Job): The queued job, None when the queue is full
+        """
+        if self.queued >= self.queue_size:
+            self.rejected += 1
+            return None
+
+        job = Job(text, options, self._manager.Event())
+        self.queue.put_nowait(job)
+        self.queued += 1
+        self.jobs[job.id] = job
+        return job
+
+    def cancel(self, job_id):
+        """
+        Cancels a queued or running job
+        ----------
+        params:
+            job_id (str): Id of the job
+        returns:
+            job (Job): The job, None when it does not exist
+        """
+        job = self.jobs.get(job_id)
+        if job is not None and job.status in ('queued', 'running'):
+            job.cancel.set()
+            if job.status == 'queued':
+                self.queued -= 1
+                self._finish(job, 'cancelled')
+        return job
+
+    def _finish(self, job, status):
+        """Marks a job as finished and forgets the oldest finished jobs"""
+        job.status = status
+        job.finished = time.time()
+        self.completed[status] += 1
+
+        while len(self.jobs) > MAX_FINISHED:
+            oldest = next(iter(self.jobs.values()))
+            if oldest.status in ('queued', 'running'):
+                break
+            self.jobs.popitem(last=False)
+
+    async def _consume(self):
+        """Runs queued jobs on the pool one at a time, one consumer per worker process"""
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            if job.status == 'cancelled':
+                continue
+
+            self.queued -= 1
+            job.status = 'running'
+            job.started = time.time()
+            self.waits.append(job.started - job.submitted)
+            self.running += 1
+
+            options = job.options
+            stop = [Cancelled(job.cancel)]
+            if options['patience']:
+                stop.append(stopping.ScorePlateau(options['patience']))
+
+            try:
+                job.result = await loop.run_in_executor(
+                    self._executor, batch.decipher, job.text,
+                    np.random.SeedSequence(options['seed']), options['iters'], options['chains'], stop
+                )
+                self._finish(job, 'cancelled' if job.cancel.is_set() else 'done')
+            except Exception as error:
+                job.error = f'{type(error).__name__}: {error}'
+                self._finish(job, 'failed')
+            finally:
+                self.running -= 1
+                self.runtimes.append(time.time() - job.started)
+
+    def metrics(self):
+        """
+        Current queue depth, job counters and latency percentiles
+        ----------
+        returns:
+            metrics (dict): Metrics of the service, latencies in seconds over the last
+                            LATENCY_WINDOW jobs
+        """
+        def summary(values):
+            if not values:
+                return None
+            values = np.fromiter(values, dtype=float)
+            return {'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+                    'p95': float(np.percentile(values, 95)), 'max': float(values.max())}
+
+        return {
+            'workers': self.workers,
+            'queue_depth': self.queued,
+            'queue_size': self.queue_size,
+            'running': self.running,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'queue_wait': summary(self.waits),
+            'run_time': summary(self.runtimes),
+        }
+
+
+def parse_options(body):
+    """
+    Validates the body of a submission
+    ----------
+    params:
+        body (dict): Decoded JSON body
+    returns:
+        (str, dict): Encrypted text and job options
+    """
+    if not isinstance(body, dict) or not isinstance(body.get('text'), str):
+        raise ValueError('expected an object with a "text" string')
+
+    options = {'iters': 20000, 'chains': 4, 'patience': 5000, 'seed': None}
+    for name, default in options.items():
+        value = body.get(name, default)
+        if name == 'seed' and value is None:
+            pass
+        elif not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError(f'"{name}" must be an integer')
+        elif name in ('iters', 'chains') and value < 1:
+            raise ValueError(f'"{name}" must be a positive integer')
+        elif value < 0:
+            raise ValueError(f'"{name}" must be a non-negative integer')
+        options[name] = value
+
+    if options['seed'] is None:
+        options['seed'] = np.random.SeedSequence().entropy
+    return body['text'], options
+
+
+async def handle(service, reader, writer):
+    """
+    Serves one HTTP request and closes the connection
+    """
+    async def respond(status, payload, headers=()):
+        body = json.dumps(payload).encode('utf-8')
+        head = [f'HTTP/1.1 {status} {REASONS[status]}', 'Content-Type: application/json',
+                f'Content-Length: {len(body)}', 'Connection: close', *headers]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('ascii') + body)
+        await writer.drain()
+
+    try:
+        request = await reader.readline()
+        method, target, _ = request.decode('latin-1').split(' ', 2)
+
+        # Headers, only the body length is used
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+
+        if length > MAX_BODY:
+            return await respond(413, {'error': 'request body too large'})
+        body = await reader.readexactly(length) if length else b''
+
+        path = target.split('?', 1)[0].rstrip('/')
+        parts = path.split('/')[1:]
+
+        if path == '/health':
+            return await respond(200, {'status': 'ok'})
+
+        if path == '/metrics':
+            return await respond(200, service.metrics())
+
+        if path == '/jobs':
+            if method != 'POST':
+                return await respond(405, {'error': f'{method} not allowed on {path}'})
+            try:
+                text, options = parse_options(json.loads(body or b'null'))
+            except ValueError as error:
+                return await respond(400, {'error': str(error)})
+
+            job = service.submit(text, options)
+            if job is None:
+                return await respond(503, {'error': 'queue is full'}, ['Retry-After: 1'])
+            return await respond(202, job.to_dict(), [f'Location: /jobs/{job.id}'])
+
+        if len(parts) == 2 and parts[0] == 'jobs':
+            if method == 'GET':
+                job = service.jobs.get(parts[1])
+            elif method == 'DELETE':
+                job = service.cancel(parts[1])
+            else:
+                return await respond(405, {'error': f'{method} not allowed on {path}'})
+
+            if job is None:
+                return await respond(404, {'error': f'no job {parts[1]}'})
+            return await respond(200, job.to_dict())
+
+        return await respond(404, {'error': f'no route {path}'})
+    except (ValueError, asyncio.IncompleteReadError):
+        return await respond(400, {'error': 'malformed request'})
+    finally:
+        writer.close()
+
+
+async def serve(port=8765, unix=None, workers=None, queue_size=100, model_path=None):
+    """
+    Runs the service until it is interrupted
+    ----------
+    params:
+        port (int): Port to listen on at 127.0.0.1, default 8765
+        unix (str): Path of a Unix socket to listen on instead, default None
+        workers (int): Number of worker processes, defaults to the number of CPUs
+        queue_size (int): Maximum number of queued jobs, default 100
+        model_path (str): Directory of the compiled language model, see model.load_model
+    returns:
+        None
+    """
+    service = DecipherService(workers, queue_size, model_path)
+    await service.start()
+
+    def connected(reader, writer):
+        return handle(service, reader, writer)
+
+    if unix is not None:
+        server = await asyncio.start_unix_server(connected, path=unix)
+    else:
+        server = await asyncio.start_server(connected, host='127.0.0.1', port=port)
+
+    address = unix or f'http://127.0.0.1:{port}'
+    print(f'Serving on {address} with {service.workers} warm worker(s)', flush=True)
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Local decipher service with a warm worker pool')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on at 127.0.0.1')
+    parser.add_argument('--unix', default=None, help='listen on this Unix socket instead')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--queue-size', type=int, default=100, help='maximum number of queued jobs')
+    parser.add_argument('--model', default=None, help='directory of the compiled language model')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.port, args.unix, args.workers, args.queue_size, args.model))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,149 @@
+"""
+File containing the stopping criteria used to end MCMC runs early once they have converged.
+
+Every criterion is updated once per iteration with the iteration number, the current score and
+whether the decryption cipher changed, and returns True once it fires. The samplers that run an
+ensemble of chains pass arrays with one entry per chain instead: per-chain criteria then return
+one flag per chain, while GelmanRubin returns a single flag for the whole ensemble.
+"""
+import numpy as np
+
+
+class ScorePlateau:
+    """
+    Fires once the best score has not improved by more than tol for window iterations
+    ----------
+    params:
+        window (int): Number of iterations without improvement, default 1000
+        tol (float): Minimum improvement of the best score that resets the window, default 1e-6
+    """
+    def __init__(self, window=1000, tol=1e-6):
+        self.window = window
+        self.tol = tol
+        self._best = None
+        self._since = None
+
+    def update(self, iteration, score, changed):
+        score = np.asarray(score, dtype=float)
+        if self._best is None:
+            self._best = score.copy()
+            self._since = np.full(score.shape, iteration)
+
+        improved = score > self._best + self.tol
+        self._best = np.where(improved, score, self._best)
+        self._since = np.where(improved, iteration, self._since)
+
+        return iteration - self._since >= self.window
+
+
+class NoKeyChange:
+    """
+    Fires once the decryption cipher has not changed for k iterations
+    ----------
+    params:
+        k (int): Number of iterations without an accepted proposal, default 1000
+    """
+    def __init__(self, k=1000):
+        self.k = k
+        self._unchanged = None
+
+    def update(self, iteration, score, changed):
+        changed = np.asarray(changed)
+        if self._unchanged is None:
+            self._unchanged = np.zeros(changed.shape, dtype=int)
+
+        self._unchanged = np.where(changed, 0, self._unchanged + 1)
+        return self._unchanged >= self.k
+
+
+class ScoreTarget:
+    """
+    Fires once the score reaches a target, e.g. the score of the true decryption cipher when
+    benchmarking the time to solve a known encrypted text
+    ----------
+    params:
+        target (float): Score at which the run is stopped
+        tol (float): Tolerance for rounding errors of the incremental scores, default 1e-6
+    """
+    def __init__(self, target, tol=1e-6):
+        self.target = target
+        self.tol = tol
+
+    def update(self, iteration, score, changed):
+        return np.asarray(score) >= self.target - self.tol
+
+
+class GelmanRubin:
+    """
+    Fires once the split Gelman-Rubin statistic (R-hat) of the score traces over the last window
+    iterations drops below threshold. Every trace is split in two halves, so the criterion also
+    works for a single chain, but it is meant for ensembles: chains stuck in different local
+    optima keep R-hat high.
+    ----------
+    params:
+        threshold (float): R-hat below which the chains are considered converged, default 1.01
+        window (int): Number of most recent iterations used, default 1000
+        every (int): Number of iterations between two evaluations of R-hat, default 100
+    """
+    def __init__(self, threshold=1.01, window=1000, every=100):
+        self.threshold = threshold
+        self.window = window
+        self.every = every
+        self.rhat = np.inf
+        self._traces = None
+        self._filled = 0
+
+    def update(self, iteration, score, changed):
+        score = np.atleast_1d(np.asarray(score, dtype=float))
+        if self._traces is None:
+            self._traces = np.empty((self.window, len(score)))
+
+        # Ring buffer of the most recent scores
+        self._traces[self._filled % self.window] = score
+        self._filled += 1
+
+        if self._filled < self.window or self._filled % self.every != 0:
+            return False
+
+        self.rhat = gelman_rubin(np.roll(self._traces, -(self._filled % self.window), axis=0))
+        return self.rhat < self.threshold
+
+
+def gelman_rubin(traces):
+    """
+    Calculates the split Gelman-Rubin statistic of a set of score traces
+    ----------
+    params:
+        traces (np.ndarray): (iterations, chains) array of scores
+    returns:
+        rhat (float): Potential scale reduction factor, close to 1 once the chains agree
+    """
+    half = len(traces) // 2
+    splits = np.concatenate((traces[:half], traces[half:2 * half]), axis=1)
+
+    within = splits.var(axis=0, ddof=1).mean()
+    between = half * splits.mean(axis=0).var(ddof=1)
+
+    if within == 0:
+        return 1.0 if between == 0 else np.inf
+
+    pooled = (half - 1) / half * within + between / half
+    return float(np.sqrt(pooled / within))
+
+
+def check(criteria, iteration, score, changed):
+    """
+    Updates every criterion and combines their results
+    ----------
+    params:
+        criteria (iterable): Stopping criteria
+        iteration (int): Number of iterations run so far
+        score (float or np.ndarray): Current score of the chain(s)
+        changed (bool or np.ndarray): Whether the decryption cipher(s) changed this iteration
+    returns:
+        stop (bool or np.ndarray): True where at least one criterion fired
+    """
+    stop = False
+    for criterion in criteria:
+        stop = np.logical_or(stop, criterion.update(iteration, score, changed))
+    return stop
@@ -0,0 +1,211 @@
+"""
+File containing the streaming ingestion of encrypted texts too large to hold in memory.
+
+An encrypted text is read from a file (or any iterable of string chunks) and reduced in a single
+pass to the sufficient statistics the samplers score against, the same counts scoring.text_statistics
+computes from the whole string. Only the statistics and the last few characters of every chunk are
+kept, so memory does not grow with the size of the input. The decrypted text is produced at the end,
+chunk by chunk, straight to an output file:
+
+    $ python streaming.py ciphertext.txt -o plaintext.txt
+"""
+import os
+import sys
+
+import numpy as np
+
+import scoring
+from cipher import Cipher
+
+
+# Number of characters read at once
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+
+def read_chunks(source, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Reads an encrypted text in chunks
+    ----------
+    params:
+        source (str, file or iterable): Path of a text file, open text file, or iterable of
+                                        string chunks
+        chunk_size (int): Number of characters read at once from files, default 1,048,576
+    returns:
+        chunks (generator): Consecutive chunks of the text
+    """
+    if isinstance(source, (str, os.PathLike)):
+        # Newlines are kept as they are, so the decrypted text lines up with the file
+        with open(source, encoding='utf-8', errors='replace', newline='') as f:
+            yield from iter(lambda: f.read(chunk_size), '')
+    elif hasattr(source, 'read'):
+        yield from iter(lambda: source.read(chunk_size), '')
+    else:
+        yield from source
+
+
+class StreamingStatistics:
+    """
+    Accumulates the n-gram statistics of a text fed in chunks. The result is identical to
+    scoring.text_statistics on the concatenated chunks, including the n-grams that straddle two
+    chunks and the leading and trailing non-letters that are ignored.
+    ----------
+    params:
+        order (int): Order of the language model, default 2
+    """
+    def __init__(self, order=2):
+        self.order = order
+        self.characters = 0
+        self._started = False
+
+        # Classes at the end of the text seen so far that do not end a counted n-gram yet: the
+        # last order - 1 classes up to the last letter, followed by the non-letters after it
+        self._carry = np.empty(0, dtype=np.int64)
+
+        # N-grams of non-letters only, taken out of a long run of non-letters in the carry
+        self._spaces = 0
+
+        if order == 2:
+            self._dense = np.zeros(scoring.N_CLASSES ** 2, dtype=np.int64)
+        else:
+            self._codes = np.empty(0, dtype=np.int64)
+            self._weights = np.empty(0, dtype=np.int64)
+
+    def update(self, chunk):
+        """
+        Adds the next chunk of the text
+        ----------
+        params:
+            chunk (str): Some string of text
+        returns:
+            None
+        """
+        self.characters += len(chunk)
+        classes = scoring.text_to_classes(chunk).astype(np.int64)
+
+        # Skip the leading non-letters of the text
+        if not self._started:
+            letters = np.flatnonzero(classes != scoring.SPACE)
+            if len(letters) == 0:
+                return
+            classes = classes[letters[0]:]
+            self._started = True
+
+        n = self.order
+        text = np.concatenate((self._carry, classes))
+        end = np.flatnonzero(text != scoring.SPACE)[-1] + 1
+
+        # Only the n-grams ending at or before the last letter are counted, trailing non-letters
+        # are ignored unless a letter comes after them in a later chunk
+        windows = max(end - n + 1, 0)
+        codes = np.zeros(windows, dtype=np.int64)
+        for k in range(n):
+            codes = codes * scoring.N_CLASSES + text[k:k + windows]
+        self._add(codes)
+
+        # Non-letter n-grams taken out of the carry are counted once a letter follows them
+        if end > len(self._carry) and self._spaces:
+            self._add(np.full(self._spaces, scoring.N_CLASSES ** n - 1, dtype=np.int64))
+            self._spaces = 0
+
+        # Keep at most 2 (n - 1) trailing non-letters: n-grams further inside the run are made of
+        # non-letters only and are just counted
+        self._carry = text[windows:]
+        excess = len(text) - end - 2 * (n - 1)
+        if excess > 0:
+            self._spaces += excess
+            self._carry = self._carry[:len(self._carry) - excess]
+
+    def _add(self, codes):
+        """Adds n-grams encoded with scoring.encode_ngrams to the counts"""
+        if self.order == 2:
+            self._dense += np.bincount(codes, minlength=len(self._dense))
+            return
+
+        codes, weights = np.unique(codes, return_counts=True)
+        codes, inverse = np.unique(np.concatenate((self._codes, codes)), return_inverse=True)
+        self._weights = np.bincount(inverse, np.concatenate((self._weights, weights)))
+        self._weights = self._weights.astype(np.int64)
+        self._codes = codes
+
+    def counts(self):
+        """
+        Statistics of the text fed so far, see scoring.text_statistics
+        ----------
+        returns:
+            counts (np.ndarray or scoring.NgramCounts): Statistics of the text
+        """
+        if self.order == 2:
+            return self._dense.reshape(scoring.N_CLASSES, scoring.N_CLASSES).copy()
+        return scoring.NgramCounts(scoring.decode_ngrams(self._codes, self.order), self._weights.copy())
+
+
+def text_statistics(source, order=2, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Reduces an encrypted text to its sufficient statistics in a single streaming pass. The
+    result can be passed to the samplers (and runner.run_chains) in place of the text.
+    ----------
+    params:
+        source (str, file or iterable): Path of a text file, open text file, or iterable of
+                                        string chunks
+        order (int): Order of the language model, default 2
+        chunk_size (int): Number of characters read at once from files, default 1,048,576
+    returns:
+        counts (np.ndarray or scoring.NgramCounts): Statistics of the text
+    """
+    statistics = StreamingStatistics(order)
+    for chunk in read_chunks(source, chunk_size):
+        statistics.update(chunk)
+    return statistics.counts()
+
+
+def decrypt(key, source, output, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Decrypts an encrypted text chunk by chunk, exactly like utils.applyKey on the whole text
+    ----------
+    params:
+        key (str or Cipher): Decryption cipher
+        source (str, file or iterable): Path of a text file, open text file, or iterable of
+                                        string chunks
+        output (str or file): Path of the output file, or open text file
+        chunk_size (int): Number of characters read at once from files, default 1,048,576
+    returns:
+        count (int): Number of characters written
+    """
+    cipher = Cipher.from_key(key)
+    count = 0
+
+    f = open(output, 'w', encoding='ascii', newline='') if isinstance(output, (str, os.PathLike)) else output
+    try:
+        for chunk in read_chunks(source, chunk_size):
+            count += f.write(cipher.apply(chunk))
+    finally:
+        if f is not output:
+            f.close()
+
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from runner import run_chains
+    import model
+
+    parser = argparse.ArgumentParser(description='Decipher a large encrypted text file in a streaming pass')
+    parser.add_argument('input', help='encrypted text file')
+    parser.add_argument('-o', '--output', default='-', help='decrypted text file, default stdout')
+    parser.add_argument('--iters', type=int, default=10000, help='iterations per chain')
+    parser.add_argument('--chains', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--model', default=None, help='directory of the compiled language model')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='characters read at once')
+    args = parser.parse_args()
+
+    order = model.load_model(args.model).order
+    counts = text_statistics(args.input, order, args.chunk_size)
+    results = run_chains(counts, args.chains, args.iters, args.workers, args.seed, args.model)
+    best = max(results, key=lambda result: result.best_score)
+    print(f'Best key: {best.best_key} (score {best.best_score:.2f})', file=sys.stderr)
+
+    decrypt(best.best_key, args.input, sys.stdout if args.output == '-' else args.output, args.chunk_size)
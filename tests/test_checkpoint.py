@@ -0,0 +1,75 @@
+"""
+Regression checks of checkpoint.py: a run killed after a checkpoint and resumed with the same
+arguments ends exactly where the uninterrupted run ends.
+"""
+import numpy as np
+import pytest
+
+import model
+import observers as obs
+from checkpoint import Checkpointer
+from cipher import Cipher
+from mcmc import mcmc
+
+# Encrypted text of the checks, a few sentences of the reference text
+TEXT = Cipher.random(np.random.default_rng(0)).encrypt(
+    'it was in july and the speaker was the well known anna pavlovna scherer maid of honour '
+    'and favourite of the empress marya fedorovna with these words she greeted prince vasili '
+    'a man of high rank and importance who was the first to arrive at her reception'
+)
+KEY = ''.join(np.random.default_rng(1).permutation(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ')))
+ITERS = 3000
+
+
+class Kill(Exception):
+    """Stands for the process being killed"""
+
+
+class Killer(obs.Observer):
+    """Observer that kills the run at a given iteration"""
+    def __init__(self, iteration):
+        super().__init__(every=100)
+        self.iteration = iteration
+
+    def notify(self, event):
+        if event.iteration == self.iteration:
+            raise Kill
+
+
+@pytest.fixture(scope='module')
+def log_probs():
+    return model.load_model().log_probs
+
+
+def checkpointer(path):
+    # Checkpoints every 500 iterations however long they take to write
+    return Checkpointer(str(path), every=500, max_overhead=float('inf'))
+
+
+def test_resume_is_bit_identical(tmp_path, log_probs):
+    expected = mcmc(KEY, TEXT, np.random.default_rng(2), ITERS, log_probs)
+
+    # Killed between the checkpoints at iterations 1500 and 2000
+    path = tmp_path / 'chain.npz'
+    with pytest.raises(Kill):
+        mcmc(KEY, TEXT, np.random.default_rng(2), ITERS, log_probs, observers=[Killer(1700)],
+             checkpoint=checkpointer(path))
+    assert path.exists()
+
+    resumed = mcmc(KEY, TEXT, np.random.default_rng(2), ITERS, log_probs,
+                   checkpoint=checkpointer(path))
+
+    assert resumed.key == expected.key
+    assert resumed.score == expected.score
+    assert resumed.iterations == expected.iterations
+    assert resumed.best_key == expected.best_key
+    assert resumed.best_score == expected.best_score
+    assert np.array_equal(resumed.history, expected.history)
+
+
+def test_checkpoint_of_another_run_is_refused(tmp_path, log_probs):
+    path = tmp_path / 'chain.npz'
+    mcmc(KEY, TEXT, np.random.default_rng(2), 1000, log_probs, checkpoint=checkpointer(path))
+
+    with pytest.raises(ValueError, match='different run'):
+        mcmc(KEY, TEXT, np.random.default_rng(3), 1000, log_probs, checkpoint=checkpointer(path))
@@ -0,0 +1,47 @@
+"""
+Regression checks of streaming.py: the statistics of a text fed in chunks equal
+scoring.text_statistics on the whole text, however the text is cut.
+"""
+import io
+
+import numpy as np
+import pytest
+
+import scoring
+import streaming
+
+# Leading, trailing and long runs of non-letters, so that chunks end inside them
+TEXT = (
+    '  ... "Well, Prince, so Genoa and Lucca are now just family estates of the Buonapartes.\n\n'
+    'But I warn you,   if you don\'t tell me that this means war -- I will have nothing more '
+    'to do with you!!!      And you are no longer my friend," said Anna Pavlovna.  42  \n'
+)
+
+
+def chunked(text, rng):
+    """Cuts a text at random places, including empty and single character chunks"""
+    cuts = np.sort(rng.integers(0, len(text) + 1, size=rng.integers(1, 40)))
+    return [text[a:b] for a, b in zip(np.r_[0, cuts], np.r_[cuts, len(text)])]
+
+
+def assert_same_statistics(actual, expected):
+    if isinstance(expected, np.ndarray):
+        assert np.array_equal(actual, expected)
+    else:
+        assert np.array_equal(actual.grams, expected.grams)
+        assert np.array_equal(actual.weights, expected.weights)
+
+
+@pytest.mark.parametrize('order', [2, 3, 4])
+def test_random_chunkings_match_whole_text(order):
+    expected = scoring.text_statistics(TEXT, order)
+    rng = np.random.default_rng(order)
+    for _ in range(50):
+        assert_same_statistics(streaming.text_statistics(chunked(TEXT, rng), order), expected)
+
+
+@pytest.mark.parametrize('order', [2, 3])
+def test_file_chunks_match_whole_text(order):
+    # Chunks shorter than the n-grams
+    actual = streaming.text_statistics(io.StringIO(TEXT), order, chunk_size=1)
+    assert_same_statistics(actual, scoring.text_statistics(TEXT, order))
@@ -0,0 +1,70 @@
+"""
+Regression checks of transposition.py: the counts TranspositionState updates boundary by boundary
+equal a full recount of the decrypted text, and the ciphers decrypt what they encrypt.
+"""
+import numpy as np
+import pytest
+
+import model
+import scoring
+from cipher import Cipher
+from transposition import (ColumnarTransposition, SubstitutionTransposition, TranspositionProposals,
+                           TranspositionState)
+
+# Length that is not a multiple of most numbers of columns, so the last row is incomplete
+TEXT = (
+    'it was in july and the speaker was the well known anna pavlovna scherer maid of honour '
+    'and favourite of the empress marya fedorovna with these words she greeted prince vasili '
+    'a man of high rank and importance who was the first to arrive at her reception'
+)
+
+
+@pytest.fixture(scope='module')
+def log_probs():
+    return model.load_model().log_probs
+
+
+def recount(state):
+    """Bigram counts of the encrypted text with the transposition of the state undone"""
+    classes = state.classes[ColumnarTransposition(state.order).gather(len(state.classes))]
+    codes = classes[:-1] * scoring.N_CLASSES + classes[1:]
+    return np.bincount(codes, minlength=scoring.N_CLASSES ** 2).reshape(scoring.N_CLASSES, -1)
+
+
+@pytest.mark.parametrize('n_columns', [2, 5, 7, 12])
+def test_incremental_counts_match_recount(n_columns, log_probs):
+    rng = np.random.default_rng(n_columns)
+    encrypted = SubstitutionTransposition.random(rng, n_columns).encrypt(TEXT)
+    classes = scoring.text_to_classes(encrypted)
+
+    perm = np.r_[rng.permutation(26), scoring.SPACE]
+    state = TranspositionState(classes, rng.permutation(n_columns), perm, log_probs)
+    proposals = TranspositionProposals(rng, n_columns)
+
+    for step in range(300):
+        # Rearrangements of the columns mixed with swaps of the substitution
+        if step % 3:
+            _, index, _ = proposals.draw()
+            delta, change = state.delta_rearrange(index)
+            state.rearrange(change, delta)
+        else:
+            i, j = rng.choice(26, size=2, replace=False)
+            state.swap(i, j, scoring.delta_score(state, i, j))
+
+        counts = recount(state)
+        assert np.array_equal(state.counts, counts)
+        assert state.score == pytest.approx(scoring.score_perm(state.perm, counts, log_probs))
+
+
+@pytest.mark.parametrize('n_columns', [2, 3, 7, 12])
+@pytest.mark.parametrize('length', [12, 50, len(TEXT)])
+def test_encrypt_decrypt_round_trip(n_columns, length):
+    rng = np.random.default_rng(length + n_columns)
+    text = TEXT[:length]
+    normalized = Cipher(np.arange(26)).apply(text)
+
+    transposition = ColumnarTransposition.random(rng, n_columns)
+    assert transposition.decrypt(transposition.encrypt(text)) == normalized
+
+    cipher = SubstitutionTransposition.random(rng, n_columns)
+    assert cipher.decrypt(cipher.encrypt(text)) == normalized
@@ -0,0 +1,381 @@
+"""
+File containing columnar transposition ciphers and the chain state used to search for them.
+
+A columnar transposition writes the text row by row into a grid of n_columns columns (the last
+row may be incomplete) and reads it back column by column in the order given by its key. Like
+utils.applyKey, texts are first upper cased with every non-letter turned into a space, and the
+spaces are transposed with the letters. Stacked with a substitution cipher, it gives the
+substitution-transposition cipher. All three cipher families share the same interface (key,
+encrypt, decrypt and random):
+
+    cipher = SubstitutionTransposition(Cipher.random(rng), ColumnarTransposition.random(rng, 7))
+    assert cipher.decrypt(cipher.encrypt('SOME TEXT')) == 'SOME TEXT'
+
+Decrypting with a transposition is a single gather of the encrypted text through a precomputed
+index array. To search for the transposition, the bigram counts of the decrypted text are split
+by column boundary: the bigrams made of the k-th characters of two neighbouring columns of the
+grid (and those that wrap from the last column of a row to the first column of the next). A
+rearrangement of the columns only changes the boundaries whose two columns now hold different
+parts of the encrypted text, so only their bigrams are counted again. The counts are the ones
+scoring.ChainState keeps, so substitution swaps are scored by scoring.delta_score as usual.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+import scoring
+from cipher import Cipher
+
+
+# Substitution that only normalizes a text (upper case, non-letters to spaces)
+_NORMALIZE = Cipher(np.arange(26))
+
+# Byte value of the character of every class
+_CHARACTERS = np.frombuffer((scoring.ALPHABET + ' ').encode('ascii'), dtype=np.uint8)
+
+
+def column_lengths(n_columns, length):
+    """
+    Number of characters in every column of the grid of a text
+    ----------
+    params:
+        n_columns (int): Number of columns of the grid
+        length (int): Number of characters of the text
+    returns:
+        lengths (np.ndarray): Length of every column, the first length % n_columns columns hold
+                              one more character than the others
+    """
+    rows, extra = divmod(length, n_columns)
+    return rows + (np.arange(n_columns) < extra)
+
+
+def column_starts(layout, lengths):
+    """
+    Position in the encrypted text where every column of the grid starts
+    ----------
+    params:
+        layout (np.ndarray): Number of the column in the reading order, for every column of the
+                             grid (the inverse permutation of the key)
+        lengths (np.ndarray): Length of every column, see column_lengths
+    returns:
+        starts (np.ndarray): Start of every column in the encrypted text
+    """
+    order = np.argsort(layout)
+    offsets = np.concatenate(([0], np.cumsum(lengths[order])[:-1]))
+    return offsets[layout]
+
+
+@lru_cache(maxsize=256)
+def _gather(order, length):
+    """Memoized ColumnarTransposition.gather, the key is a tuple"""
+    n_columns = len(order)
+    lengths = column_lengths(n_columns, length)
+    starts = column_starts(np.argsort(order), lengths)
+
+    # Row i of column c of the grid is character starts[c] + i of the encrypted text, read row by
+    # row (the incomplete last row only holds the first, longer, columns)
+    rows = -(-length // n_columns)
+    index = (starts[None, :] + np.arange(rows)[:, None]).ravel()[:length]
+    index.flags.writeable = False
+    return index
+
+
+class ColumnarTransposition:
+    """
+    Columnar transposition cipher
+    ----------
+    params:
+        order (array-like): Permutation of range(n_columns), the columns of the grid in the order
+                            they are read out
+    """
+    __slots__ = ('order',)
+
+    def __init__(self, order):
+        order = np.array(order, dtype=np.intp)
+        if order.ndim != 1 or not np.array_equal(np.sort(order), np.arange(len(order))):
+            raise ValueError('A columnar transposition is a permutation of the columns')
+        order.flags.writeable = False
+        self.order = order
+
+    @classmethod
+    def random(cls, rng, n_columns):
+        """Draws a uniformly random transposition from a seeded random number generator"""
+        return cls(rng.permutation(n_columns))
+
+    @property
+    def n_columns(self):
+        """Number of columns of the grid"""
+        return len(self.order)
+
+    @property
+    def key(self):
+        """String representation of the transposition, the reading order of the columns"""
+        return ' '.join(str(column) for column in self.order)
+
+    def gather(self, length):
+        """
+        Index array that decrypts texts of a given length
+        ----------
+        params:
+            length (int): Number of characters of the text
+        returns:
+            index (np.ndarray): Read-only array where character p of the decrypted text is
+                                character index[p] of the encrypted text
+        """
+        return _gather(tuple(self.order.tolist()), length)
+
+    def encrypt(self, text):
+        """Encrypts a text with this transposition"""
+        text = np.frombuffer(_NORMALIZE.apply(text).encode('ascii'), dtype=np.uint8)
+        encrypted = np.empty_like(text)
+        encrypted[self.gather(len(text))] = text
+        return encrypted.tobytes().decode('ascii')
+
+    def decrypt(self, text):
+        """Decrypts a text encrypted with this transposition"""
+        text = np.frombuffer(_NORMALIZE.apply(text).encode('ascii'), dtype=np.uint8)
+        return text[self.gather(len(text))].tobytes().decode('ascii')
+
+    def __str__(self):
+        return self.key
+
+    def __repr__(self):
+        return f'ColumnarTransposition({self.order.tolist()!r})'
+
+    def __eq__(self, other):
+        if isinstance(other, ColumnarTransposition):
+            return np.array_equal(self.order, other.order)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(tuple(self.order.tolist()))
+
+
+class SubstitutionTransposition:
+    """
+    Substitution cipher followed by a columnar transposition
+    ----------
+    params:
+        substitution (Cipher): Encryption cipher of the substitution
+        transposition (ColumnarTransposition): The transposition
+    """
+    __slots__ = ('substitution', 'transposition')
+
+    def __init__(self, substitution, transposition):
+        self.substitution = Cipher.from_key(substitution)
+        self.transposition = transposition
+
+    @classmethod
+    def random(cls, rng, n_columns):
+        """Draws a uniformly random cipher from a seeded random number generator"""
+        return cls(Cipher.random(rng), ColumnarTransposition.random(rng, n_columns))
+
+    @property
+    def key(self):
+        """String representation of the cipher, the substitution key then the transposition key"""
+        return f'{self.substitution.key} {self.transposition.key}'
+
+    def encrypt(self, text):
+        """Encrypts a text with this cipher"""
+        return self.transposition.encrypt(self.substitution.encrypt(text))
+
+    def decrypt(self, text):
+        """Decrypts a text encrypted with this cipher"""
+        return self.substitution.decrypt(self.transposition.decrypt(text))
+
+    def __str__(self):
+        return self.key
+
+    def __repr__(self):
+        return f'SubstitutionTransposition({self.substitution!r}, {self.transposition!r})'
+
+
+class TranspositionProposals:
+    """
+    Buffered source of random rearrangements of the columns of a grid, each paired with log(u)
+    for a uniform u used in the acceptance test. A rearrangement is a column swap (two columns
+    exchange places), a reversal (a run of neighbouring columns is reversed) or a slide (a run of
+    neighbouring columns moves elsewhere, keeping its own boundaries). Every move is drawn with
+    the same probability as the move that undoes it, so no Hastings correction is needed.
+    ----------
+    params:
+        rng (generator): Seeded random number generator the proposal streams are spawned from
+        n_columns (int): Number of columns of the grid
+        weights (tuple): Relative frequencies of swaps, reversals and slides, default (1, 1, 1)
+        block_size (int): Number of proposals drawn at once, default 4096
+    """
+    KINDS = ('swap', 'reverse', 'slide')
+
+    def __init__(self, rng, n_columns, weights=(1, 1, 1), block_size=4096):
+        if n_columns < 2:
+            raise ValueError('A transposition needs at least 2 columns')
+        self.n_columns = n_columns
+        self.block_size = block_size
+        self.weights = np.asarray(weights, dtype=float) / np.sum(weights)
+
+        # Independent streams for the moves and the uniforms, as in proposals.SwapProposals
+        move_seed, uniform_seed = np.random.SeedSequence(rng.integers(0, 2**63, size=4)).spawn(2)
+        self._move_rng = np.random.default_rng(move_seed)
+        self._uniform_rng = np.random.default_rng(uniform_seed)
+
+        self._kinds = self._draws = self._log_u = []
+        self._pos = 0
+
+    def _refill(self):
+        """
+        Draws the next block of proposals into the buffer
+        """
+        kinds = self._move_rng.choice(len(self.KINDS), size=self.block_size, p=self.weights)
+        draws = self._move_rng.random((self.block_size, 3))
+        log_u = np.log1p(-self._uniform_rng.random(self.block_size))
+
+        # Python lists make indexing single proposals cheap
+        self._kinds, self._draws, self._log_u = kinds.tolist(), draws.tolist(), log_u.tolist()
+        self._pos = 0
+
+    def draw(self):
+        """
+        Takes the next proposal from the buffer
+        ----------
+        returns:
+            (str, list, float): Kind of the move, the rearrangement (column c of the new grid
+                                is column index[c] of the current one) and log(u)
+        """
+        if self._pos == len(self._kinds):
+            self._refill()
+        k = self._pos
+        self._pos += 1
+
+        kind, (u0, u1, u2), n = self.KINDS[self._kinds[k]], self._draws[k], self.n_columns
+        index = list(range(n))
+        if kind == 'slide':
+            # Run of size columns starting at first, moved to start at target
+            size = 1 + int(u0 * (n - 1))
+            first = int(u1 * (n - size + 1))
+            target = int(u2 * (n - size))
+            target += target >= first
+            run, rest = index[first:first + size], index[:first] + index[first + size:]
+            index = rest[:target] + run + rest[target:]
+        else:
+            # Two distinct columns, uniformly over the pairs
+            i, j = int(u0 * n), int(u1 * (n - 1))
+            j += j >= i
+            i, j = min(i, j), max(i, j)
+            if kind == 'swap':
+                index[i], index[j] = j, i
+            else:
+                index[i:j + 1] = index[i:j + 1][::-1]
+
+        return kind, index, self._log_u[k]
+
+
+class TranspositionState(scoring.ChainState):
+    """
+    State of a Markov chain over substitution-transposition decryptions. On top of the
+    substitution held by scoring.ChainState, holds the layout of the columns of the grid and the
+    bigram counts of the encrypted text once the transposition is undone, both updated
+    incrementally by rearrange. Only bigram models are supported.
+    ----------
+    params:
+        classes (np.ndarray): Character classes of the encrypted text, see
+                              scoring.text_to_classes
+        layout (np.ndarray): Number of the column in the reading order, for every column of the
+                             grid (the inverse permutation of the transposition key)
+        perm (np.ndarray): Permutation representation of the decryption cipher of the
+                           substitution
+        log_probs (np.ndarray): 27x27 log transition probabilities of the reference text
+    """
+    def __init__(self, classes, layout, perm, log_probs):
+        if np.ndim(log_probs) != 2:
+            raise ValueError('Transposition ciphers are only supported with bigram models')
+
+        self.classes = np.asarray(classes, dtype=np.intp)
+        self.layout = np.array(layout, dtype=np.intp)
+        self.lengths = column_lengths(len(self.layout), len(self.classes))
+        if self.lengths.min() < 1:
+            raise ValueError('The text is shorter than the number of columns')
+
+        # Number of bigrams on every boundary: between column c and c + 1 of the same row, and
+        # from the last column of a row to the first column of the next
+        following = np.roll(self.lengths, -1)
+        following[-1] -= 1
+        self.pairs = np.minimum(self.lengths, following)
+
+        self.starts = column_starts(self.layout, self.lengths)
+        self.boundaries = self._boundaries(self.starts)
+
+        counts = self._count(self.boundaries)
+        super().__init__(perm, counts, log_probs)
+
+    @property
+    def order(self):
+        """Transposition key, the columns of the grid in the order they are read out"""
+        return np.argsort(self.layout)
+
+    def _boundaries(self, starts):
+        """
+        Every boundary as (start of its first characters, start of its second characters, number
+        of bigrams) in the encrypted text. Two boundaries with the same triple hold the same bigrams.
+        """
+        second = np.roll(starts, -1)
+        second[-1] += 1
+        return set(zip(starts.tolist(), second.tolist(), self.pairs.tolist()))
+
+    def _count(self, boundaries):
+        """
+        Bigram count matrix of a collection of boundaries
+        """
+        if not boundaries:
+            return np.zeros((scoring.N_CLASSES, scoring.N_CLASSES), dtype=np.int64)
+        codes = np.concatenate([
+            self.classes[first:first + n] * scoring.N_CLASSES + self.classes[second:second + n]
+            for first, second, n in boundaries
+        ])
+        return np.bincount(codes, minlength=scoring.N_CLASSES ** 2).reshape(scoring.N_CLASSES, -1)
+
+    def delta_rearrange(self, index):
+        """
+        Calculates the change in log likelihood caused by rearranging the columns of the grid.
+        Only the boundaries that change are counted, the state itself is left unchanged.
+        ----------
+        params:
+            index (list): Column c of the rearranged grid is column index[c] of the current
+                          one, see TranspositionProposals.draw
+        returns:
+            delta (float): Score of the rearranged decryption minus the score of the current one
+            change (tuple): The rearrangement to pass to rearrange if it is accepted
+        """
+        layout = self.layout[index]
+        starts = column_starts(layout, self.lengths)
+        boundaries = self._boundaries(starts)
+
+        # Boundaries whose bigrams are gone, and new ones
+        diff = self._count(boundaries - self.boundaries) - self._count(self.boundaries - boundaries)
+
+        # Score is linear in the counts
+        delta = scoring.score_perm(self.perm, diff, self.log_probs)
+        return delta, (layout, starts, boundaries, diff)
+
+    def rearrange(self, change, delta):
+        """
+        Rearranges the columns of the grid and updates the cached counts and score
+        ----------
+        params:
+            change (tuple): Rearrangement returned by delta_rearrange
+            delta (float): Change in score returned by delta_rearrange
+        returns:
+            None
+        """
+        self.layout, self.starts, self.boundaries, diff = change
+        self.counts += diff
+        self.score += delta
+
+    def decrypt(self):
+        """
+        Decrypted text of the current state
+        ----------
+        returns:
+            text (str): The encrypted text with the transposition and the substitution undone
+        """
+        classes = self.perm[self.classes[_gather(tuple(self.order.tolist()), len(self.classes))]]
+        return _CHARACTERS[classes].tobytes().decode('ascii')
@@ -1,20 +1,26 @@
+import os
 import pickle
 import numpy as np
-import matplotlib.pyplot as plt
 from statistics import mean, median, stdev
-from collections import defaultdict
+import scoring
+import recording
+from cipher import Cipher
 
 
-def loadFreqDict():
+def loadFreqDict(path=None):
     """
-    Loads the generated frequency dictionary, used later during MCMC
+    Loads the generated frequency dictionary. MCMC uses the compiled model built from it
+    (see model.py) instead.
     --------
     params:
-        None:
+        path (str): Path to the pickled dictionary, defaults to data/freq_dict.pkl
     returns:
         freq_dict (dict): Dictionary that contains the frequency counts of bigram character pairs
     """
-    with open('./data/freq_dict.pkl', 'rb') as f:
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'freq_dict.pkl')
+
+    with open(path, 'rb') as f:
         return pickle.load(f)
 
 
@@ -29,11 +35,8 @@ def mapKey(key):
     returns:
         mapping (dict): New mapping between cipher letters and alphabet letters
     """
-    alphabet = ['A','B','C','D','E','F','G','H','I','J','K','L','M',
-                'N','O','P','Q','R','S','T','U','V','W','X','Y','Z']
-    
     # Return the mapping between the cipher and alphabet
-    return {alphabet[i] : key[i] for i in range(len(key))}
+    return dict(zip(scoring.ALPHABET, str(key)))
 
 
 def applyKey(key, text):
@@ -42,38 +45,21 @@ def applyKey(key, text):
     encrypted or decrypted text.
     --------
     params:
-        key (str): An encryption or decryption cipher
+        key (str or Cipher): An encryption or decryption cipher
         text (str): Some string of text
     --------
     returns:
         transformed (str): The transformed text
     """
-    transformed = ""
-
-    # Convert the text to a list
-    text = list(text)
-
-    # Get the mapping from mapKey
-    mapping = mapKey(key)
-
-    # Apply the mapping to the input text
-    for letter in text:
-        letter = str.upper(letter)
-        # Apply the switch
-        if letter in mapping: 
-            transformed += mapping[letter]
-        # Otherwise add a space
-        else:
-            transformed += " "
-    
-    # Return the final transformed text
-    return transformed
+    # Translate the whole text with the precompiled tables of the cipher
+    return Cipher.from_key(key).apply(text)
 
 
 def score(key, text, freq_dict):
     """
     Calculates the score of a decryption cipher based on its log likelihood with the
-    reference text transition
+    reference text transition. This rebuilds the bigram statistics on every call, use the
+    functions in scoring.py directly when scoring many ciphers against the same text.
     ----------
     params:
         key (str): Decryption cipher
@@ -83,43 +69,9 @@ def score(key, text, freq_dict):
     returns:
         score (float): log likelihood of the decryption cipher based on the encrypted text
     """
-    alphabet = ['A','B','C','D','E','F','G','H','I','J','K','L','M',
-                'N','O','P','Q','R','S','T','U','V','W','X','Y','Z']
-
-    # Decode the given text
-    decoded = applyKey(key, text)
-
-    # Initialize score and target frequencies
-    score = 0
-    targetFreq = defaultdict(int)
-    
-    # Strip the text
-    stripped = decoded.strip()
-
-    # Count the number of two letter pairs in the next target
-    for i in range(len(stripped) - 1):
-        bigram = stripped[i] + stripped[i+1]
-
-        # Non-letter + letter
-        if (stripped[i] not in alphabet) and (stripped[i+1] in alphabet):
-            bigram = ' ' + stripped[i+1]
-
-        # Letter + non-letter
-        elif (stripped[i] in alphabet) and (stripped[i+1] not in alphabet):
-            bigram = stripped[i+1] + ' '
-
-        # Two non-letters
-        elif (stripped[i] not in alphabet) and (stripped[i+1] not in alphabet):
-            bigram = '  '
-
-        targetFreq[bigram] += 1
-
-    # Calculate the log likelihood score
-    for key, value in targetFreq.items():
-        if key in freq_dict:
-            score += np.log(value) + np.log(freq_dict[key])
-
-    return score
+    counts = scoring.bigram_counts(text)
+    log_probs = scoring.log_prob_matrix(freq_dict)
+    return scoring.score_perm(scoring.key_to_perm(key), counts, log_probs)
 
 
 def proposeKey(key, rng):
@@ -133,32 +85,11 @@ def proposeKey(key, rng):
     returns:
         proposal (str): new proposed cipher
     """
-    proposal = ''
-    chars = ['A','B','C','D','E','F','G','H','I','J','K','L','M',
-               'N','O','P','Q','R','S','T','U','V','W','X','Y','Z']
-
     # Randomly swap two characters
-    char1, char2 = rng.choice(chars, size=2, replace=False)
-
-    # Create the new proposal
-    new_key = list(key)
-
-    # Mark the spots in the key that contained the proposed characters to swap
-    for i in range(len(new_key)):
-        if new_key[i] == char1:
-            index1 = i
-        if new_key[i] == char2:
-            index2 = i
+    char1, char2 = rng.choice(list(scoring.ALPHABET), size=2, replace=False)
 
-    # Swap the characters in the original key
-    new_key[index1] = char2
-    new_key[index2] = char1
-
-    # Generate the new proposal based on the new key
-    for letter in new_key:
-        proposal += letter
-
-    return proposal
+    # Generate the new proposal by swapping the characters in the original key
+    return key.translate(str.maketrans(char1 + char2, char2 + char1))
 
 
 def generateEncryptionCipher(rng):
@@ -170,16 +101,8 @@ def generateEncryptionCipher(rng):
     returns:
         cipher (str): An encryption cipher
     """
-    alphabet = ['A','B','C','D','E','F','G','H','I','J','K','L','M',
-                'N','O','P','Q','R','S','T','U','V','W','X','Y','Z']
-
-    cipher = ''
-    encryption = list(rng.choice(alphabet, size=26, replace=False))
-
-    for char in encryption:
-        cipher += char
-
-    return cipher
+    # Same draws as a list of letters, so seeded ciphers do not change
+    return ''.join(rng.choice(list(scoring.ALPHABET), size=26, replace=False))
 
 
 def testCipher(encrypt_key, base, decrypt_key):
@@ -187,39 +110,61 @@ def testCipher(encrypt_key, base, decrypt_key):
     Test function that evaluates the quality of the decryption cipher. Based on the number of correct letter assignments
     --------
     params:
-        encrypt_key (str): String representation of the encryption cipher used
+        encrypt_key (str or Cipher): String representation of the encryption cipher used
         
         base (str): String representation of what we are trying to decipher
 
-        decrypt_key (str): String representation of the decryption cipher 
-                           generated during MCMC
+        decrypt_key (str or Cipher): String representation of the decryption cipher 
+                                     generated during MCMC
     returns:
         (str, int, float): The decrypted base text and number 
                            percentage of correct letters
     """
     # Apply encode then decode the base text
-    test = applyKey(encrypt_key, base)
-    guess = applyKey(decrypt_key, test)
-    correct, total = 0, 0
+    test = Cipher.from_key(encrypt_key).apply(base)
+    guess = Cipher.from_key(decrypt_key).apply(test)
 
     # Count correct letters
-    for i in range(len(base)):
-        if base[i] == guess[i]:
-            correct += 1
-        total += 1
-    
+    correct, total = sum(map(str.__eq__, base, guess)), len(base)
+
     # Return the total number of correct and percentage (as a tuple)
     return guess, correct, correct/total
 
 
-# TODO: Convert decryption key to potential energy representation
-def toPosition(decrypt_key):
-    return 
+def toPosition(decrypt_key, scale=1.0):
+    """
+    Converts a decryption cipher to a position of Hamiltonian Monte Carlo (see relaxation.py)
+    --------
+    params:
+        decrypt_key (str): String representation of the decryption cipher
+        scale (float): Value of the entries of the cipher, larger values give a relaxed cipher
+                       closer to the decryption cipher, default 1
+    returns:
+        position (np.ndarray): 26x26 matrix that is scale where cipher letter a decrypts to
+                               plain letter x and 0 elsewhere
+    """
+    perm = scoring.key_to_perm(decrypt_key)[:scoring.SPACE]
+    position = np.zeros((scoring.SPACE, scoring.SPACE))
+    position[np.arange(scoring.SPACE), perm] = scale
+    return position
 
 
-# TODO: Convert potential energy representation to decrypt key
-def toDecryptKey(potential):
-    return
+def toDecryptKey(position):
+    """
+    Rounds a position of Hamiltonian Monte Carlo to the closest decryption cipher, the
+    permutation maximizing the sum of its entries (Hungarian algorithm). Sinkhorn normalization
+    only adds constants to the rows and columns of the log of the relaxed cipher, so this is
+    also the most likely permutation under the relaxed cipher.
+    --------
+    params:
+        position (np.ndarray): 26x26 real matrix
+    returns:
+        decrypt_key (str): String representation of the decryption cipher
+    """
+    from scipy.optimize import linear_sum_assignment
+
+    _, perm = linear_sum_assignment(position, maximize=True)
+    return scoring.perm_to_key(perm)
 
 
 def summary(encrypt_key, base, ciphers):
@@ -233,11 +178,15 @@ def summary(encrypt_key, base, ciphers):
         - Max
     -----------
     params:
-        histories (iterable): An iterable of MCMC scores corresponding to each run of the MCMC function.
+        encrypt_key (str or Cipher): Encryption cipher used
+        base (str): Text the accuracy of the decryption ciphers is measured on
+        ciphers (iterable): (decryption cipher, score) pairs of the MCMC runs, where the
+                            decryption ciphers are strings or Cipher objects
     returns:
         None
     """
     # Generate normalized accuracy for each cipher
+    encrypt_key = Cipher.from_key(encrypt_key)
     data = [100 * (testCipher(encrypt_key, base, decrypt_key))[2] for decrypt_key, _ in ciphers]
 
     # Output summary stats
@@ -250,30 +199,86 @@ def summary(encrypt_key, base, ciphers):
     print(f'Min: {min(data):.2f}')
 
 
+# Function that downsamples a history curve
+def decimate(samples, history, max_points, log=False):
+    """
+    Min/max decimation of a curve: the samples are split into max_points // 2 buckets and only
+    the lowest and highest score of every bucket are kept, in their original order. The extremes
+    (and so the shape of the curve) survive, while the number of points drawn no longer depends
+    on the length of the history. Every bucket is a view, so memory mapped histories are read
+    through once without being loaded in memory.
+    ----------
+    params:
+        samples (np.ndarray): Sample number of every score, in increasing order
+        history (np.ndarray): Score of every sample
+        max_points (int): Maximum number of points kept
+        log (bool): Space the buckets evenly on a log scale instead of a linear one, default False
+    returns:
+        samples, history (np.ndarray, np.ndarray): The kept sample numbers and scores
+    """
+    if len(history) <= max_points:
+        return np.asarray(samples), np.asarray(history)
+
+    # Bucket edges, buckets that would fall between two samples are merged
+    n_buckets = max(max_points // 2, 1)
+    first, last = float(samples[0]), float(samples[-1])
+    edges = np.geomspace(first, last, n_buckets + 1) if log else np.linspace(first, last, n_buckets + 1)
+    edges = np.unique(np.searchsorted(samples, edges[1:-1]))
+    bounds = np.concatenate(([0], edges[edges > 0], [len(history)]))
+
+    keep = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        bucket = history[start:end]
+        low, high = start + int(np.argmin(bucket)), start + int(np.argmax(bucket))
+        keep.extend(sorted({low, high}))
+
+    keep = np.array(keep)
+    return np.asarray(samples[keep]), np.asarray(history[keep])
+
+
 # Function that visualizes history curve
-def plotHistories(histories, filepath):
+def plotHistories(histories, filepath, max_points=None, dpi=400):
     """
     Helper function that reads through some collection of histories (i.e., runs of different MCMC) and plots them 
-    along the number of samples drawn. Function saves the plot in the plots folder
+    along the number of samples drawn. Function saves the plot in the plots folder. The figure is drawn on the
+    non-interactive Agg backend without going through pyplot, so no GUI is needed and matplotlib is only imported
+    when plotting
     params:
-        histories (iterable): An iterable of history arrays that record the MCMC run's score at each iteration
+        histories (iterable): An iterable of history arrays that record the MCMC run's score at each iteration,
+                              recording.History objects (which know which iterations they kept) or paths to
+                              .npy files written by a recording.History, read lazily through a memory map
+        filepath (str): Path of the image file
+        max_points (int): Downsample every one-dimensional history to at most this many points with min/max
+                          decimation, default None (plot every sample)
+        dpi (int): Resolution of the image, default 400
     returns:
         None
     """
-    plt.rcParams["figure.figsize"] = (10,6)
-    plt.gcf().set_dpi(400)
+    from matplotlib.figure import Figure
 
-    # Find number of samples
-    samples = [i for i in range(1, len(histories[0])+1)]
+    fig = Figure(figsize=(10, 6), dpi=dpi)
+    ax = fig.subplots()
 
     # Plot lines
     for idx, history in enumerate(histories):
-        plt.plot(samples, history, label=f'Run {idx+1}')
+        if isinstance(history, str):
+            history = np.load(history, mmap_mode='r')
+
+        # Find the sample numbers
+        if isinstance(history, recording.History):
+            samples, history = history.iterations, history.array
+        else:
+            samples = np.arange(1, len(history)+1)
+
+        if max_points is not None and np.ndim(history) == 1:
+            samples, history = decimate(samples, history, max_points, log=True)
+
+        ax.plot(samples, history, label=f'Run {idx+1}')
     
     # Set figure parameters
-    plt.legend()
-    plt.xlabel('Sample Size m')
-    plt.ylabel('Score')
-    plt.xscale('log')
-    plt.title('Scores Across MCMC Runs')
-    plt.savefig(filepath)
\ No newline at end of file
+    ax.legend()
+    ax.set_xlabel('Sample Size m')
+    ax.set_ylabel('Score')
+    ax.set_xscale('log')
+    ax.set_title('Scores Across MCMC Runs')
+    fig.savefig(filepath)